@@ -115,13 +115,15 @@ def main(args):
 			nrof_images = len(paths)
 			nrof_batches = int(np.ceil(1.0*nrof_images / batch_size))
 			emb_array = np.zeros((nrof_images, embedding_size))
+			image_loader = facenet.ImageLoader(image_size)
 			for i in xrange(nrof_batches):
 				start_index = i*batch_size
 				end_index = min((i+1)*batch_size, nrof_images)
 				paths_batch = paths[start_index:end_index]
-				images = facenet.load_data(paths_batch, do_random_crop=False, do_random_flip=False, image_size=image_size, do_prewhiten=True)
+				images = image_loader.load(paths_batch)
 				feed_dict = { images_placeholder:images, phase_train_placeholder:False}
 				emb_array[start_index:end_index,:] = sess.run(embeddings, feed_dict=feed_dict)
+			image_loader.close()
 
 			time_avg_forward_pass = (time.time() - start_time) / float(nrof_images)
 			print("Forward pass took avg of %.3f[seconds/image] for %d images\n" % (time_avg_forward_pass, nrof_images))
@@ -136,11 +136,10 @@ def align_data(image_list, image_size, margin, pnet, rnet, onet):
                     bb[3] = np.minimum(det[3] + margin / 2, img_size[0])
                     cropped = image_list[x][bb[1]:bb[3], bb[0]:bb[2], :]
                     aligned = misc.imresize(cropped, (image_size, image_size), interp='bilinear')
-                    prewhitened = facenet.prewhiten(aligned)
-                    img_list.append(prewhitened)
+                    img_list.append(aligned)
 
     if len(img_list) > 0:
-        images = np.stack(img_list)
+        images = facenet.prewhiten_batch(np.stack(img_list))
         return images
     else:
         return None
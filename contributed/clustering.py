@@ -165,13 +165,15 @@ def compute_facial_encodings(sess,images_placeholder,embeddings,phase_train_plac
 
     """
 
+    image_loader = facenet.ImageLoader(image_size)
     for i in range(nrof_batches):
         start_index = i*batch_size
         end_index = min((i+1)*batch_size, nrof_images)
         paths_batch = paths[start_index:end_index]
-        images = facenet.load_data(paths_batch, False, False, image_size)
+        images = image_loader.load(paths_batch)
         feed_dict = { images_placeholder:images, phase_train_placeholder:False }
         emb_array[start_index:end_index,:] = sess.run(embeddings, feed_dict=feed_dict)
+    image_loader.close()
 
     facial_encodings = {}
     for x in range(nrof_images):
@@ -99,6 +99,7 @@ def main(args):
             embedding_size = embeddings.get_shape()[1]
             emb_array = np.zeros((nrof_images, embedding_size))
             start_time = time.time()
+            image_loader = facenet.ImageLoader(args.image_size)
 
             for i in range(nrof_batches):
                 if i == nrof_batches -1:
@@ -107,7 +108,7 @@ def main(args):
                     n = i*batch_size + batch_size
                 # Get images for the batch
                 if args.is_aligned is True:
-                    images = facenet.load_data(image_list[i*batch_size:n], False, False, args.image_size)
+                    images = image_loader.load(image_list[i*batch_size:n])
                 else:
                     images = load_and_align_data(image_list[i*batch_size:n], args.image_size, args.margin, args.gpu_memory_fraction)
                 feed_dict = { images_placeholder: images, phase_train_placeholder:False }
@@ -115,6 +116,7 @@ def main(args):
                 embed = sess.run(embeddings, feed_dict=feed_dict)
                 emb_array[i*batch_size:n, :] = embed
                 print('Completed batch', i+1, 'of', nrof_batches)
+            image_loader.close()
 
             run_time = time.time() - start_time
             print('Run time: ', run_time)
@@ -156,9 +158,8 @@ def load_and_align_data(image_paths, image_size, margin, gpu_memory_fraction):
         bb[3] = np.minimum(det[3]+margin/2, img_size[0])
         cropped = img[bb[1]:bb[3],bb[0]:bb[2],:]
         aligned = misc.imresize(cropped, (image_size, image_size), interp='bilinear')
-        prewhitened = facenet.prewhiten(aligned)
-        img_list[i] = prewhitened
-    images = np.stack(img_list)
+        img_list[i] = aligned
+    images = facenet.prewhiten_batch(np.stack(img_list))
     return images
 
 def parse_arguments(argv):
@@ -107,10 +107,10 @@ class Encoder:
         embeddings = tf.get_default_graph().get_tensor_by_name("embeddings:0")
         phase_train_placeholder = tf.get_default_graph().get_tensor_by_name("phase_train:0")
 
-        prewhiten_face = facenet.prewhiten(face.image)
+        prewhiten_faces = facenet.prewhiten_batch(face.image[np.newaxis])
 
         # Run forward pass to calculate embeddings
-        feed_dict = {images_placeholder: [prewhiten_face], phase_train_placeholder: False}
+        feed_dict = {images_placeholder: prewhiten_faces, phase_train_placeholder: False}
         return self.sess.run(embeddings, feed_dict=feed_dict)[0]
 
 
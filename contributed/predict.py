@@ -104,9 +104,8 @@ def load_and_align_data(image_paths, image_size, margin, gpu_memory_fraction):
                 bb[3] = np.minimum(det[3]+margin/2, img_size[0])
                 cropped = img[bb[1]:bb[3],bb[0]:bb[2],:]
                 aligned = misc.imresize(cropped, (image_size, image_size), interp='bilinear')
-                prewhitened = facenet.prewhiten(aligned)
-                img_list.append(prewhitened)		
-    images = np.stack(img_list)
+                img_list.append(aligned)
+    images = facenet.prewhiten_batch(np.stack(img_list))
     return images, count_per_image, nrof_samples
 
 def parse_arguments(argv):
@@ -33,10 +33,23 @@ import tensorflow as tf
 import numpy as np
 import facenet
 import align.detect_face
+import align.manifest
 import random
+import multiprocessing
+import socket
+import errno
+import shutil
+import time
+import threading
+import collections
+import functools
+from multiprocessing.pool import ThreadPool
 from time import sleep
 
 def main(args):
+    if args.nrof_workers > 0:
+        align_parallel(args)
+        return
     sleep(random.random())
     output_dir = os.path.expanduser(args.output_dir)
     if not os.path.exists(output_dir):
@@ -46,31 +59,40 @@ def main(args):
     facenet.store_revision_info(src_path, output_dir, ' '.join(sys.argv))
     dataset = facenet.get_dataset(args.input_dir)
     
+    manifest = None
+    manifest_entries = None
+    if args.manifest:
+        manifest = align.manifest.AlignmentManifest(os.path.expanduser(args.manifest))
+        manifest_entries = manifest.load()
+        print('Manifest: %d images' % len(manifest_entries))
+
+    packed_source_paths = None
+    if args.output_format=='packed':
+        packed_source_paths = get_packed_source_paths(output_dir)
+
     print('Creating networks and loading parameters')
-    
-    with tf.Graph().as_default():
-        gpu_options = tf.GPUOptions(per_process_gpu_memory_fraction=args.gpu_memory_fraction)
-        sess = tf.Session(config=tf.ConfigProto(gpu_options=gpu_options, log_device_placement=False))
-        with sess.as_default():
-            pnet, rnet, onet = align.detect_face.create_mtcnn(sess, None)
-    
-    minsize = 20 # minimum size of face
-    threshold = [ 0.6, 0.7, 0.7 ]  # three steps's threshold
-    factor = 0.709 # scale factor
+    pnet, rnet, onet = create_detector(args)
 
     # Add a random key to the filename to allow alignment using multiple processes
     random_key = np.random.randint(0, high=99999)
     bounding_boxes_filename = os.path.join(output_dir, 'bounding_boxes_%05d.txt' % random_key)
     
+    writer = None
+    if args.output_format=='packed':
+        writer = facenet.PackedShardWriter(output_dir, 'pack_%05d' % random_key,
+            os.path.join(output_dir, facenet.PACKED_INDEX_FILENAME), (args.image_size, args.image_size, 3), args.pack_size)
+    
     with open(bounding_boxes_filename, "w") as text_file:
         nrof_images_total = 0
         nrof_successfully_aligned = 0
+        images_to_align = []
         if args.random_order:
             random.shuffle(dataset)
         for cls in dataset:
             output_class_dir = os.path.join(output_dir, cls.name)
             if not os.path.exists(output_class_dir):
-                os.makedirs(output_class_dir)
+                if writer is None:
+                    os.makedirs(output_class_dir)
                 if args.random_order:
                     random.shuffle(cls.image_paths)
             for image_path in cls.image_paths:
@@ -78,64 +100,570 @@ def main(args):
                 filename = os.path.splitext(os.path.split(image_path)[1])[0]
                 output_filename = os.path.join(output_class_dir, filename+'.png')
                 print(image_path)
-                if not os.path.exists(output_filename):
-                    try:
-                        img = misc.imread(image_path)
-                    except (IOError, ValueError, IndexError) as e:
-                        errorMessage = '{}: {}'.format(image_path, e)
-                        print(errorMessage)
+                if needs_alignment(image_path, output_filename, manifest_entries, args, packed_source_paths):
+                    if args.nrof_decode_threads>0:
+                        images_to_align.append((image_path, output_filename))
                     else:
-                        if img.ndim<2:
-                            print('Unable to align "%s"' % image_path)
-                            text_file.write('%s\n' % (output_filename))
-                            continue
-                        if img.ndim == 2:
-                            img = facenet.to_rgb(img)
-                        img = img[:,:,0:3]
-    
-                        bounding_boxes, _ = align.detect_face.detect_face(img, minsize, pnet, rnet, onet, threshold, factor)
-                        nrof_faces = bounding_boxes.shape[0]
-                        if nrof_faces>0:
-                            det = bounding_boxes[:,0:4]
-                            det_arr = []
-                            img_size = np.asarray(img.shape)[0:2]
-                            if nrof_faces>1:
-                                if args.detect_multiple_faces:
-                                    for i in range(nrof_faces):
-                                        det_arr.append(np.squeeze(det[i]))
-                                else:
-                                    bounding_box_size = (det[:,2]-det[:,0])*(det[:,3]-det[:,1])
-                                    img_center = img_size / 2
-                                    offsets = np.vstack([ (det[:,0]+det[:,2])/2-img_center[1], (det[:,1]+det[:,3])/2-img_center[0] ])
-                                    offset_dist_squared = np.sum(np.power(offsets,2.0),0)
-                                    index = np.argmax(bounding_box_size-offset_dist_squared*2.0) # some extra weight on the centering
-                                    det_arr.append(det[index,:])
-                            else:
-                                det_arr.append(np.squeeze(det))
-
-                            for i, det in enumerate(det_arr):
-                                det = np.squeeze(det)
-                                bb = np.zeros(4, dtype=np.int32)
-                                bb[0] = np.maximum(det[0]-args.margin/2, 0)
-                                bb[1] = np.maximum(det[1]-args.margin/2, 0)
-                                bb[2] = np.minimum(det[2]+args.margin/2, img_size[1])
-                                bb[3] = np.minimum(det[3]+args.margin/2, img_size[0])
-                                cropped = img[bb[1]:bb[3],bb[0]:bb[2],:]
-                                scaled = misc.imresize(cropped, (args.image_size, args.image_size), interp='bilinear')
-                                nrof_successfully_aligned += 1
-                                filename_base, file_extension = os.path.splitext(output_filename)
-                                if args.detect_multiple_faces:
-                                    output_filename_n = "{}_{}{}".format(filename_base, i, file_extension)
-                                else:
-                                    output_filename_n = "{}{}".format(filename_base, file_extension)
-                                misc.imsave(output_filename_n, scaled)
-                                text_file.write('%s %d %d %d %d\n' % (output_filename_n, bb[0], bb[1], bb[2], bb[3]))
-                        else:
-                            print('Unable to align "%s"' % image_path)
-                            text_file.write('%s\n' % (output_filename))
+                        nrof_successfully_aligned += align_image(image_path, output_filename, args, pnet, rnet, onet, text_file,
+                                                                 manifest, writer)
+        if images_to_align:
+            counters = StageCounters()
+            nrof_successfully_aligned += align_images_pipelined(images_to_align, args, pnet, rnet, onet, text_file, counters,
+                                                                manifest=manifest, writer=writer)
+            print(counters)
+    if writer is not None:
+        writer.close()
+    if manifest is not None:
+        manifest.close()
                             
     print('Total number of images: %d' % nrof_images_total)
     print('Number of successfully aligned images: %d' % nrof_successfully_aligned)
+
+def create_detector(args, nrof_threads=0):
+    """Creates the MTCNN networks in a new session. nrof_threads bounds the number of threads
+    used by the session (0 lets TensorFlow decide).
+    """
+    with tf.Graph().as_default():
+        gpu_options = tf.GPUOptions(per_process_gpu_memory_fraction=args.gpu_memory_fraction)
+        sess = tf.Session(config=tf.ConfigProto(gpu_options=gpu_options, log_device_placement=False,
+            intra_op_parallelism_threads=nrof_threads, inter_op_parallelism_threads=nrof_threads))
+        with sess.as_default():
+            return align.detect_face.create_mtcnn(sess, None)
+
+def align_image(image_path, output_filename, args, pnet, rnet, onet, text_file, manifest=None, writer=None):
+    """Aligns the face(s) in an image, stores the thumbnails (as files, or in the packed shards
+    of writer if it is set) and writes their bounding boxes to text_file. The result is also
+    recorded in the manifest, if any, once the thumbnails are stored. Returns the number of
+    aligned faces.
+    """
+    img = load_image(image_path)
+    if img is None:
+        record_faces(manifest, image_path, None)
+        return 0
+    faces = detect_faces(img, image_path, output_filename, args, pnet, rnet, onet)
+    if writer is None:
+        text_file.write(save_faces(output_filename, faces))
+    else:
+        text_file.write(pack_faces(writer, image_path, output_filename, faces))
+    record_faces(manifest, image_path, faces, writer)
+    return len(faces)
+
+def record_faces(manifest, image_path, faces, writer=None):
+    """Records the faces from detect_faces in the manifest, or that the image could not be read
+    if faces is None. Faces that were added to the packed shards of writer are only recorded
+    when their shard has been written, so that an interrupted run aligns them again.
+    """
+    if manifest is None:
+        return
+    if writer is not None and faces:
+        writer.call_after_flush(functools.partial(record_faces, manifest, image_path, faces))
+    elif faces is None:
+        manifest.record(image_path, align.manifest.UNREADABLE)
+    elif faces:
+        manifest.record(image_path, align.manifest.ALIGNED, [face[2] for face in faces], [face[3] for face in faces])
+    else:
+        manifest.record(image_path, align.manifest.NO_FACE)
+
+def needs_alignment(image_path, output_filename, manifest_entries, args, packed_source_paths=None):
+    """Returns true if an image must be aligned. Without a manifest this is the case if the
+    thumbnail does not exist, or for packed output if the image is not in the packed index
+    (packed_source_paths from get_packed_source_paths). With a manifest (manifest_entries from
+    AlignmentManifest.load) the images that are not in it are aligned, or with --reprocess_failed
+    only the images that failed before. With --validate_manifest also images whose size or mtime
+    have changed since they were aligned, or whose thumbnails are missing, are aligned again.
+    """
+    if manifest_entries is None:
+        if packed_source_paths is not None:
+            return image_path not in packed_source_paths
+        return not os.path.exists(output_filename)
+    entry = manifest_entries.get(image_path)
+    if args.reprocess_failed:
+        return entry is not None and entry[2]!=align.manifest.ALIGNED
+    if entry is None:
+        # The shard of a packed image can be written before its row in the manifest is committed
+        return packed_source_paths is None or image_path not in packed_source_paths
+    if args.validate_manifest:
+        stat = os.stat(image_path)
+        if (stat.st_mtime, stat.st_size)!=entry[0:2]:
+            return True
+        if entry[2]==align.manifest.ALIGNED:
+            if packed_source_paths is not None:
+                return image_path not in packed_source_paths
+            return not os.path.exists(get_face_filename(output_filename, 0, args))
+    return False
+
+def get_packed_source_paths(output_dir):
+    """Returns the set of the source image paths in the packed index of output_dir"""
+    index_filename = os.path.join(output_dir, facenet.PACKED_INDEX_FILENAME)
+    if not os.path.exists(index_filename):
+        return set()
+    with open(index_filename, 'r') as f:
+        return set(line.split('\t')[2] for line in f)
+
+def get_face_filename(output_filename, face_index, args):
+    """Returns the thumbnail filename of a face, which is numbered with --detect_multiple_faces"""
+    if not args.detect_multiple_faces:
+        return output_filename
+    filename_base, file_extension = os.path.splitext(output_filename)
+    return "{}_{}{}".format(filename_base, face_index, file_extension)
+
+def load_image(image_path):
+    """Reads an image to align, or returns None if it cannot be read"""
+    try:
+        img = misc.imread(image_path)
+    except (IOError, ValueError, IndexError) as e:
+        errorMessage = '{}: {}'.format(image_path, e)
+        print(errorMessage)
+        return None
+    return img
+
+def detect_faces(img, image_path, output_filename, args, pnet, rnet, onet):
+    """Detects the face(s) to align in an image and returns a list with the output filename,
+    the thumbnail, the bounding box and the landmarks of each face.
+    """
+    minsize = 20 # minimum size of face
+    threshold = [ 0.6, 0.7, 0.7 ]  # three steps's threshold
+    factor = 0.709 # scale factor
+
+    faces = []
+    if img.ndim<2:
+        print('Unable to align "%s"' % image_path)
+        return faces
+    if img.ndim == 2:
+        img = facenet.to_rgb(img)
+    img = img[:,:,0:3]
+
+    bounding_boxes, points = align.detect_face.detect_face(img, minsize, pnet, rnet, onet, threshold, factor)
+    nrof_faces = bounding_boxes.shape[0]
+    if nrof_faces>0:
+        det = bounding_boxes[:,0:4]
+        det_arr = []
+        face_indices = []
+        img_size = np.asarray(img.shape)[0:2]
+        if nrof_faces>1:
+            if args.detect_multiple_faces:
+                for i in range(nrof_faces):
+                    det_arr.append(np.squeeze(det[i]))
+                    face_indices.append(i)
+            else:
+                bounding_box_size = (det[:,2]-det[:,0])*(det[:,3]-det[:,1])
+                img_center = img_size / 2
+                offsets = np.vstack([ (det[:,0]+det[:,2])/2-img_center[1], (det[:,1]+det[:,3])/2-img_center[0] ])
+                offset_dist_squared = np.sum(np.power(offsets,2.0),0)
+                index = np.argmax(bounding_box_size-offset_dist_squared*2.0) # some extra weight on the centering
+                det_arr.append(det[index,:])
+                face_indices.append(index)
+        else:
+            det_arr.append(np.squeeze(det))
+            face_indices.append(0)
+
+        for i, det in enumerate(det_arr):
+            det = np.squeeze(det)
+            bb = np.zeros(4, dtype=np.int32)
+            bb[0] = np.maximum(det[0]-args.margin/2, 0)
+            bb[1] = np.maximum(det[1]-args.margin/2, 0)
+            bb[2] = np.minimum(det[2]+args.margin/2, img_size[1])
+            bb[3] = np.minimum(det[3]+args.margin/2, img_size[0])
+            cropped = img[bb[1]:bb[3],bb[0]:bb[2],:]
+            scaled = misc.imresize(cropped, (args.image_size, args.image_size), interp='bilinear')
+            faces.append((get_face_filename(output_filename, i, args), scaled, bb, points[:,face_indices[i]]))
+    else:
+        print('Unable to align "%s"' % image_path)
+    return faces
+
+def save_faces(output_filename, faces):
+    """Stores the thumbnails from detect_faces and returns the lines for the bounding box file"""
+    if not faces:
+        return '%s\n' % (output_filename)
+    lines = ''
+    for output_filename_n, scaled, bb, _ in faces:
+        misc.imsave(output_filename_n, scaled)
+        lines += '%s %d %d %d %d\n' % (output_filename_n, bb[0], bb[1], bb[2], bb[3])
+    return lines
+
+def pack_faces(writer, image_path, output_filename, faces):
+    """Adds the thumbnails from detect_faces to the shards of a PackedShardWriter and returns the
+    lines for the bounding box file. The faces of an image are stored in the same shard, so that
+    an image is either completely in the packed index or not at all.
+    """
+    if not faces:
+        return '%s\n' % (output_filename)
+    class_name = os.path.basename(os.path.dirname(output_filename))
+    writer.reserve(len(faces))
+    lines = ''
+    for _, scaled, bb, _ in faces:
+        packed_path = writer.add(scaled, class_name, image_path, bb)
+        lines += '%s %d %d %d %d\n' % (packed_path, bb[0], bb[1], bb[2], bb[3])
+    return lines
+
+class StageCounters(object):
+    """Thread safe counters of the number of images processed by each stage of
+    align_images_pipelined and of the time the stage was busy with them.
+    """
+  
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.start_time = time.time()
+        self.counts = {}
+        self.times = {}
+  
+    def add(self, stage, duration):
+        with self.lock:
+            self.counts[stage] = self.counts.get(stage, 0) + 1
+            self.times[stage] = self.times.get(stage, 0.0) + duration
+  
+    def __str__(self):
+        elapsed = time.time()-self.start_time
+        return '  '.join('%s: %d images, %.1f images/s (%.1f images/s per thread)' % (stage, self.counts[stage],
+            self.counts[stage]/elapsed, self.counts[stage]/max(self.times[stage], 1e-6)) for stage in ('decode', 'detect', 'write')
+            if stage in self.counts)
+
+def timed_call(counters, stage, fun, *args):
+    start_time = time.time()
+    result = fun(*args)
+    counters.add(stage, time.time()-start_time)
+    return result
+
+def align_images_pipelined(images, args, pnet, rnet, onet, text_file, counters, callback=None, manifest=None, writer=None):
+    """Aligns a list of (image path, output filename) like align_image, but the images are
+    decoded in a pool of args.nrof_decode_threads threads and the thumbnails are encoded and
+    stored in a pool of args.nrof_write_threads threads while the detector runs on this thread.
+    At most args.pipeline_queue_size images wait between two stages. The detections and the
+    bounding box file are done in the order of the images, so the output is identical to
+    aligning the images one by one. callback is called (without arguments) after each image.
+    The results are recorded in the manifest, if any, once the thumbnails are stored. With a
+    writer the thumbnails are packed in order on this thread instead.
+    Returns the number of aligned faces.
+    """
+    decode_pool = ThreadPool(args.nrof_decode_threads)
+    write_pool = ThreadPool(args.nrof_write_threads)
+    try:
+        return _align_images_pipelined(images, args, pnet, rnet, onet, text_file, counters, callback, manifest, writer,
+                                       decode_pool, write_pool)
+    finally:
+        decode_pool.close()
+        write_pool.close()
+
+def _align_images_pipelined(images, args, pnet, rnet, onet, text_file, counters, callback, manifest, writer,
+                            decode_pool, write_pool):
+    decoded = collections.deque()
+    written = collections.deque()
+    nrof_successfully_aligned = 0
+    next_image = 0
+    while next_image<len(images) or decoded:
+        while next_image<len(images) and len(decoded)<args.pipeline_queue_size:
+            image_path, output_filename = images[next_image]
+            decoded.append((image_path, output_filename, decode_pool.apply_async(timed_call,
+                (counters, 'decode', load_image, image_path))))
+            next_image += 1
+        image_path, output_filename, result = decoded.popleft()
+        img = result.get()
+        if callback is not None:
+            callback()
+        if img is None:
+            record_faces(manifest, image_path, None)
+            continue
+        faces = timed_call(counters, 'detect', detect_faces, img, image_path, output_filename, args, pnet, rnet, onet)
+        nrof_successfully_aligned += len(faces)
+        if writer is None:
+            lines = write_pool.apply_async(timed_call, (counters, 'write', save_faces, output_filename, faces)).get
+        else:
+            lines = functools.partial(timed_call, counters, 'write', pack_faces, writer, image_path, output_filename, faces)
+        written.append((image_path, faces, lines))
+        while len(written)>args.pipeline_queue_size:
+            write_result(written.popleft(), text_file, manifest, writer)
+    while written:
+        write_result(written.popleft(), text_file, manifest, writer)
+    return nrof_successfully_aligned
+
+def write_result(result, text_file, manifest, writer=None):
+    image_path, faces, get_lines = result
+    text_file.write(get_lines())
+    record_faces(manifest, image_path, faces, writer)
+
+def align_parallel(args):
+    """Aligns the dataset with args.nrof_workers processes. The images are split into
+    args.nrof_shards shards in a deterministic order, and the workers lease the shards one at a
+    time through lease files in the output directory. Each finished shard gets its own bounding
+    box file, and the files are merged into bounding_boxes.txt when all shards are done. Since
+    the leases are plain files the same command can be run on several hosts that share the
+    output directory, and a run that is restarted skips the finished shards.
+    """
+    if args.manifest:
+        raise ValueError('--manifest can not be used with --nrof_workers, the workers resume the alignment per shard')
+    output_dir = os.path.expanduser(args.output_dir)
+    shard_dir = os.path.join(output_dir, 'shards')
+    if not os.path.exists(shard_dir):
+        os.makedirs(shard_dir)
+    src_path,_ = os.path.split(os.path.realpath(__file__))
+    facenet.store_revision_info(src_path, output_dir, ' '.join(sys.argv))
+    dataset = facenet.get_dataset(args.input_dir)
+    shards = get_shards(dataset, args.nrof_shards)
+
+    workers = [multiprocessing.Process(target=align_shards, args=(args, shards, worker_index))
+               for worker_index in range(args.nrof_workers)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    nrof_failed = sum(worker.exitcode!=0 for worker in workers)
+    if nrof_failed>0:
+        raise RuntimeError('%d of %d workers failed, the shards they leased are taken over by the next run after --lease_timeout' %
+                           (nrof_failed, len(workers)))
+
+    shard_filenames = [get_shard_filename(shard_dir, shard_index) for shard_index in range(len(shards))]
+    nrof_done = sum(os.path.exists(filename) for filename in shard_filenames)
+    if nrof_done<len(shards):
+        print('%d of %d shards are done. The remaining shards are leased by other workers or failed' % (nrof_done, len(shards)))
+        return
+    nrof_images_total = sum(len(shard) for shard in shards)
+    nrof_successfully_aligned = merge_files(shard_filenames, os.path.join(output_dir, 'bounding_boxes.txt'))
+    if args.output_format=='packed':
+        merge_files([get_shard_filename(shard_dir, shard_index, 'index') for shard_index in range(len(shards))],
+            os.path.join(output_dir, facenet.PACKED_INDEX_FILENAME))
+    print('Total number of images: %d' % nrof_images_total)
+    print('Number of successfully aligned images: %d' % nrof_successfully_aligned)
+
+def merge_files(filenames, output_filename):
+    """Concatenates text files into output_filename, which is replaced atomically. Returns the
+    number of lines with more than one field, i.e. the number of faces for bounding box files.
+    """
+    nrof_lines = 0
+    with open(output_filename + '.' + get_worker_id(), 'w') as output_file:
+        for filename in filenames:
+            with open(filename, 'r') as f:
+                for line in f:
+                    output_file.write(line)
+                    nrof_lines += len(line.split())>1
+    os.rename(output_file.name, output_filename)
+    return nrof_lines
+
+def get_shards(dataset, nrof_shards):
+    """Splits the images of the dataset into nrof_shards lists of (class name, image path) of
+    (almost) equal length. The split only depends on the file names, so that every worker and
+    host gets the same shards.
+    """
+    images = [(cls.name, image_path) for cls in dataset for image_path in sorted(cls.image_paths)]
+    return [images[len(images)*i//nrof_shards:len(images)*(i+1)//nrof_shards] for i in range(nrof_shards)]
+
+def get_shard_filename(shard_dir, shard_index, name='bounding_boxes'):
+    return os.path.join(shard_dir, '%s_%05d.txt' % (name, shard_index))
+
+def get_worker_id():
+    return '%s.%d' % (socket.gethostname(), os.getpid())
+
+def align_shards(args, shards, worker_index):
+    """Worker process of align_parallel that aligns the shards it can lease"""
+    output_dir = os.path.expanduser(args.output_dir)
+    shard_dir = os.path.join(output_dir, 'shards')
+    worker_id = get_worker_id()
+    pnet, rnet, onet = create_detector(args, args.nrof_threads_per_worker)
+    nrof_shards = len(shards)
+    nrof_images_total = 0
+    nrof_successfully_aligned = 0
+    counters = StageCounters()
+    # Start the workers at different shards so that they rarely try to lease the same shard
+    first_shard = worker_index*nrof_shards//args.nrof_workers
+    for i in range(nrof_shards):
+        shard_index = (first_shard+i) % nrof_shards
+        shard_filename = get_shard_filename(shard_dir, shard_index)
+        lease_filename = shard_filename + '.lease'
+        if os.path.exists(shard_filename) or not lease_shard(lease_filename, worker_id, args.lease_timeout):
+            continue
+        lease = ShardLease(lease_filename, worker_id, args.lease_timeout)
+        if os.path.exists(shard_filename):
+            # The shard was finished by the worker that held the lease before
+            lease.release()
+            continue
+        try:
+            nrof_images, nrof_faces = align_shard(args, shards[shard_index], shard_index, lease, pnet, rnet, onet, counters)
+        except LeaseLostError as e:
+            print('Worker %s: %s' % (worker_id, e))
+            continue
+        nrof_images_total += nrof_images
+        nrof_successfully_aligned += nrof_faces
+        print('Worker %s: shard %d done' % (worker_id, shard_index))
+    print('Worker %s: %d images, %d faces aligned' % (worker_id, nrof_images_total, nrof_successfully_aligned))
+    if args.nrof_decode_threads>0:
+        print('Worker %s: %s' % (worker_id, counters))
+
+def align_shard(args, shard, shard_index, lease, pnet, rnet, onet, counters):
+    """Aligns the images of a leased shard. The bounding box file, the packed index and the packed
+    shards are written under temporary names with the worker id, and the thumbnail files to a
+    temporary directory with the worker id. They are moved into place after the lease has been
+    renewed, so that they are only kept if the lease is still held. If the lease is lost the
+    temporary files are removed and LeaseLostError is raised.
+    Returns the number of images and the number of aligned faces.
+    """
+    output_dir = os.path.expanduser(args.output_dir)
+    shard_dir = os.path.join(output_dir, 'shards')
+    shard_filename = get_shard_filename(shard_dir, shard_index)
+    index_filename = get_shard_filename(shard_dir, shard_index, 'index')
+    images_to_align = []
+    nrof_successfully_aligned = 0
+    writer = None
+    face_dir = None
+    if args.output_format=='packed':
+        writer = facenet.PackedShardWriter(output_dir, 'pack_%05d' % shard_index, index_filename + '.' + lease.worker_id,
+            (args.image_size, args.image_size, 3), args.pack_size, temp_suffix=lease.worker_id)
+    else:
+        face_dir = os.path.join(shard_dir, 'faces_%05d.%s' % (shard_index, lease.worker_id))
+    text_filename = shard_filename + '.' + lease.worker_id
+    try:
+        with open(text_filename, 'w') as text_file:
+            for class_name, image_path in shard:
+                output_class_dir = os.path.join(face_dir or output_dir, class_name)
+                if writer is None and not os.path.exists(output_class_dir):
+                    os.makedirs(output_class_dir)
+                filename = os.path.splitext(os.path.split(image_path)[1])[0]
+                output_filename = os.path.join(output_class_dir, filename+'.png')
+                if args.nrof_decode_threads>0:
+                    images_to_align.append((image_path, output_filename))
+                    continue
+                nrof_successfully_aligned += align_image(image_path, output_filename, args, pnet, rnet, onet, text_file,
+                                                         writer=writer)
+                lease.renew()
+            if images_to_align:
+                nrof_successfully_aligned += align_images_pipelined(images_to_align, args, pnet, rnet, onet, text_file,
+                                                                    counters, lease.renew, writer=writer)
+        if writer is not None:
+            writer.close()
+        # A fresh lease can not be taken over for lease_timeout seconds, which leaves the time to rename the files
+        lease.renew(force=True)
+        if writer is not None:
+            writer.rename_shards()
+            if os.path.exists(writer.index_filename):
+                os.rename(writer.index_filename, index_filename)
+            else:
+                open(index_filename, 'w').close()
+        else:
+            move_faces(face_dir, output_dir, text_filename)
+        # The bounding box file is renamed last since it marks the shard as done
+        os.rename(text_filename, shard_filename)
+    except LeaseLostError:
+        temp_filenames = [text_filename]
+        if writer is not None:
+            writer.remove_shards()
+            temp_filenames.append(writer.index_filename)
+        else:
+            shutil.rmtree(face_dir, ignore_errors=True)
+        for filename in temp_filenames:
+            try:
+                os.remove(filename)
+            except OSError:
+                pass
+        raise
+    lease.release()
+    return len(shard), nrof_successfully_aligned
+
+def move_faces(face_dir, output_dir, text_filename):
+    """Moves the thumbnails that align_shard has written to face_dir into the class directories
+    of output_dir, and replaces their paths in the bounding box file text_filename.
+    """
+    for class_name in os.listdir(face_dir):
+        output_class_dir = os.path.join(output_dir, class_name)
+        if not os.path.exists(output_class_dir):
+            try:
+                os.makedirs(output_class_dir)
+            except OSError as e:
+                # Another worker may have created it in the meantime
+                if e.errno != errno.EEXIST:
+                    raise
+        for filename in os.listdir(os.path.join(face_dir, class_name)):
+            os.rename(os.path.join(face_dir, class_name, filename), os.path.join(output_class_dir, filename))
+    shutil.rmtree(face_dir)
+    with open(text_filename, 'r') as f:
+        lines = f.readlines()
+    with open(text_filename, 'w') as f:
+        for line in lines:
+            if line.startswith(face_dir + os.sep):
+                line = output_dir + line[len(face_dir):]
+            f.write(line)
+
+class LeaseLostError(Exception):
+    """Raised by ShardLease when another worker has taken over the lease"""
+
+class ShardLease(object):
+    """Renews the lease of a shard while it is aligned so that other workers do not take it over.
+    A worker that is too slow to renew its lease can lose it to another worker, so the lease
+    file, which holds the id of the worker that created it, is checked before the lease is
+    renewed or released.
+    """
+  
+    def __init__(self, lease_filename, worker_id, lease_timeout):
+        self.lease_filename = lease_filename
+        self.worker_id = worker_id
+        self.lease_timeout = lease_timeout
+        self.renew_time = time.time()
+  
+    def is_held(self):
+        return get_lease_owner(self.lease_filename)==self.worker_id
+  
+    def renew(self, force=False):
+        """Renews the lease if a quarter of the timeout has passed since the last renewal, or
+        always if force is set. Raises LeaseLostError if the lease is no longer held.
+        """
+        if force or time.time()-self.renew_time > self.lease_timeout/4:
+            if not self.is_held():
+                raise LeaseLostError('The lease %s was taken over by another worker' % self.lease_filename)
+            try:
+                os.utime(self.lease_filename, None)
+            except OSError as e:
+                raise LeaseLostError('The lease %s could not be renewed: %s' % (self.lease_filename, e))
+            self.renew_time = time.time()
+  
+    def release(self):
+        """Removes the lease file if it still holds the lease of this worker"""
+        if self.is_held():
+            try:
+                os.remove(self.lease_filename)
+            except OSError:
+                pass
+
+def get_lease_owner(lease_filename):
+    """Returns the id of the worker that created a lease file, or None if it does not exist"""
+    try:
+        with open(lease_filename, 'r') as f:
+            return f.read().strip()
+    except (IOError, OSError):
+        return None
+
+def lease_shard(lease_filename, worker_id, lease_timeout):
+    """Tries to get the lease for a shard by creating its lease file, which is atomic also on
+    shared filesystems. A lease that has not been renewed for lease_timeout seconds belongs to
+    a worker that has died (or is too slow), and is broken by renaming it (which only one worker
+    can do) and leased again. Returns True if the lease was acquired.
+    """
+    try:
+        fd = os.open(lease_filename, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            raise
+        stale_filename = '%s.stale.%s' % (lease_filename, worker_id)
+        try:
+            mtime = os.path.getmtime(lease_filename)
+            if time.time()-mtime < lease_timeout:
+                return False
+            owner = get_lease_owner(lease_filename)
+            os.rename(lease_filename, stale_filename)
+        except OSError:
+            # The lease was released or broken by another worker
+            return False
+        # Another worker can break the stale lease and lease the shard again between the check
+        # and the rename, and then it is the new lease that was renamed. It is put back unless
+        # yet another worker has leased the shard in the meantime. In that case the owner of the
+        # renamed lease notices that it has lost the lease when it renews it.
+        if os.path.getmtime(stale_filename)!=mtime or get_lease_owner(stale_filename)!=owner:
+            if not os.path.exists(lease_filename):
+                os.rename(stale_filename, lease_filename)
+            else:
+                os.remove(stale_filename)
+            return False
+        os.remove(stale_filename)
+        return lease_shard(lease_filename, worker_id, lease_timeout)
+    with os.fdopen(fd, 'w') as f:
+        f.write('%s\n' % worker_id)
+    return True
             
 
 def parse_arguments(argv):
@@ -153,6 +681,33 @@ def parse_arguments(argv):
         help='Upper bound on the amount of GPU memory that will be used by the process.', default=1.0)
     parser.add_argument('--detect_multiple_faces', type=bool,
                         help='Detect and align multiple faces per image.', default=False)
+    parser.add_argument('--output_format', type=str, choices=['png', 'packed'],
+        help='Store the thumbnails as png files in class directories, or packed in memory mappable .npy shards with ' +
+        'an index (index.txt) that facenet.get_dataset can read.', default='png')
+    parser.add_argument('--pack_size', type=int,
+        help='Number of thumbnails per shard with --output_format packed.', default=1000)
+    parser.add_argument('--manifest', type=str,
+        help='SQLite file that records the status, bounding boxes and landmarks of every image. When the file ' +
+        'exists the images in it are skipped, instead of checking if their thumbnails exist.', default=None)
+    parser.add_argument('--reprocess_failed', 
+        help='Only align the images that could not be read or where no face was found according to --manifest.', action='store_true')
+    parser.add_argument('--validate_manifest', 
+        help='Also align the images in --manifest again whose size or modification time has changed, or whose thumbnails are missing.', action='store_true')
+    parser.add_argument('--nrof_workers', type=int,
+        help='Number of worker processes that align the dataset in shards. To also use other hosts, run the same ' +
+        'command on them with the output directory on a shared filesystem. 0 aligns in this process.', default=0)
+    parser.add_argument('--nrof_shards', type=int,
+        help='Number of shards the dataset is split into for the workers. Must be the same for all hosts and restarts.', default=256)
+    parser.add_argument('--nrof_threads_per_worker', type=int,
+        help='Number of threads used by the TensorFlow session of each worker (0 lets TensorFlow decide).', default=1)
+    parser.add_argument('--nrof_decode_threads', type=int,
+        help='Number of threads that decode the images while the faces are detected. 0 aligns the images one by one.', default=0)
+    parser.add_argument('--nrof_write_threads', type=int,
+        help='Number of threads that encode and store the thumbnails when --nrof_decode_threads is set.', default=2)
+    parser.add_argument('--pipeline_queue_size', type=int,
+        help='Maximum number of images waiting between the decode, detect and write stages.', default=32)
+    parser.add_argument('--lease_timeout', type=float,
+        help='Time in seconds after which the shard of a worker that stopped renewing its lease is taken over.', default=600.0)
     return parser.parse_args(argv)
 
 if __name__ == '__main__':
@@ -33,6 +33,7 @@ import tensorflow as tf
 #from math import floor
 import cv2
 import os
+import time
 
 def layer(op):
     """Decorator for composable network layers."""
@@ -69,6 +70,8 @@ class Network(object):
         self.layers = dict(inputs)
         # If true, the resulting variables are set as trainable
         self.trainable = trainable
+        # Mapping from names of fully connected layers with spatial input to the input shape
+        self.fc_input_shapes = {}
 
         self.setup()
 
@@ -76,23 +79,47 @@ class Network(object):
         """Construct the network. """
         raise NotImplementedError('Must be implemented by the subclass.')
 
-    def load(self, data_path, session, ignore_missing=False):
+    def load(self, data_path, session, ignore_missing=False, row_major=False):
         """Load network weights.
         data_path: The path to the numpy-serialized network weights
         session: The current TensorFlow session
         ignore_missing: If true, serialized weights for missing layers are ignored.
+        row_major: If true, the weights are converted with to_row_major when loaded.
+        All variables are initialized in a single run call by feeding the weights to their
+        initializers, so no assign ops are added to the graph.
         """
         data_dict = np.load(data_path, encoding='latin1').item() #pylint: disable=no-member
+        if row_major:
+            data_dict = self.to_row_major(data_dict)
 
+        initializers = []
+        feed_dict = {}
         for op_name in data_dict:
             with tf.variable_scope(op_name, reuse=True):
                 for param_name, data in iteritems(data_dict[op_name]):
                     try:
                         var = tf.get_variable(param_name)
-                        session.run(var.assign(data))
+                        initializers.append(var.initializer)
+                        feed_dict[var.initializer.inputs[1]] = data
                     except ValueError:
                         if not ignore_missing:
                             raise
+        session.run(initializers, feed_dict=feed_dict)
+
+    def to_row_major(self, data_dict):
+        """Converts weights for inputs in caffe's (width, height) layout to weights for inputs in
+        (height, width) layout. The convolution kernels are transposed and the rows of the weights
+        of fully connected layers with spatial input are permuted to the row-major flattening order.
+        """
+        for op_name in data_dict:
+            params = data_dict[op_name]
+            if op_name in self.fc_input_shapes:
+                h, w, c = self.fc_input_shapes[op_name]
+                weights = np.reshape(params['weights'], (w, h, c, -1))
+                params['weights'] = np.reshape(np.transpose(weights, (1, 0, 2, 3)), (h*w*c, -1))
+            elif 'weights' in params and params['weights'].ndim == 4:
+                params['weights'] = np.transpose(params['weights'], (1, 0, 2, 3))
+        return data_dict
 
     def feed(self, *args):
         """Set the input(s) for the next operation by replacing the terminal nodes.
@@ -186,6 +213,7 @@ class Network(object):
             input_shape = inp.get_shape()
             if input_shape.ndims == 4:
                 # The input is spatial. Vectorize it first.
+                self.fc_input_shapes[name] = [int(d) for d in input_shape[1:].as_list()]
                 dim = 1
                 for d in input_shape[1:].as_list():
                     dim *= int(d)
@@ -273,74 +301,547 @@ class ONet(Network):
         (self.feed('prelu5') #pylint: disable=no-value-for-parameter
              .fc(10, relu=False, name='conv6-3'))
 
-def create_mtcnn(sess, model_path):
+# Names of the output nodes of pnet, rnet and onet, as needed to freeze them
+MTCNN_OUTPUT_NODES = ['pnet/conv4-2/BiasAdd', 'pnet/prob1', 'rnet/conv5-2/conv5-2', 'rnet/prob1',
+                      'onet/conv6-2/conv6-2', 'onet/conv6-3/conv6-3', 'onet/prob1']
+
+def create_mtcnn(sess, model_path, row_major=False):
+    """Creates pnet, rnet and onet and loads their weights.
+    model_path: directory with the det1.npy, det2.npy and det3.npy weights (the directory of this
+      file if None), or a frozen graph (.pb) written by freeze_mtcnn.py, which is imported as it
+      is and is the fastest to load.
+    row_major: if true, the weights are converted at load time so that the networks take
+      images in (height, width) layout and detect_face must be called with row_major=True.
+      Otherwise the networks take images in caffe's (width, height) layout. For a frozen graph
+      the layout is the one it was frozen with.
+    """
     if not model_path:
         model_path,_ = os.path.split(os.path.realpath(__file__))
 
+    if os.path.isfile(model_path):
+        with tf.gfile.GFile(model_path, 'rb') as f:
+            graph_def = tf.GraphDef()
+            graph_def.ParseFromString(f.read())
+        tf.import_graph_def(graph_def, name='')
+    else:
+        load_mtcnn_weights(sess, model_path, row_major)
+        
+    pnet_fun = lambda img : sess.run(('pnet/conv4-2/BiasAdd:0', 'pnet/prob1:0'), feed_dict={'pnet/input:0':img})
+    rnet_fun = lambda img : sess.run(('rnet/conv5-2/conv5-2:0', 'rnet/prob1:0'), feed_dict={'rnet/input:0':img})
+    onet_fun = lambda img : sess.run(('onet/conv6-2/conv6-2:0', 'onet/conv6-3/conv6-3:0', 'onet/prob1:0'), feed_dict={'onet/input:0':img})
+    return pnet_fun, rnet_fun, onet_fun
+
+def load_mtcnn_weights(sess, model_path, row_major=False):
+    """Creates the pnet, rnet and onet graphs and loads their weights from model_path"""
     with tf.variable_scope('pnet'):
         data = tf.placeholder(tf.float32, (None,None,None,3), 'input')
         pnet = PNet({'data':data})
-        pnet.load(os.path.join(model_path, 'det1.npy'), sess)
+        pnet.load(os.path.join(model_path, 'det1.npy'), sess, row_major=row_major)
     with tf.variable_scope('rnet'):
         data = tf.placeholder(tf.float32, (None,24,24,3), 'input')
         rnet = RNet({'data':data})
-        rnet.load(os.path.join(model_path, 'det2.npy'), sess)
+        rnet.load(os.path.join(model_path, 'det2.npy'), sess, row_major=row_major)
     with tf.variable_scope('onet'):
         data = tf.placeholder(tf.float32, (None,48,48,3), 'input')
         onet = ONet({'data':data})
-        onet.load(os.path.join(model_path, 'det3.npy'), sess)
-        
-    pnet_fun = lambda img : sess.run(('pnet/conv4-2/BiasAdd:0', 'pnet/prob1:0'), feed_dict={'pnet/input:0':img})
-    rnet_fun = lambda img : sess.run(('rnet/conv5-2/conv5-2:0', 'rnet/prob1:0'), feed_dict={'rnet/input:0':img})
-    onet_fun = lambda img : sess.run(('onet/conv6-2/conv6-2:0', 'onet/conv6-3/conv6-3:0', 'onet/prob1:0'), feed_dict={'onet/input:0':img})
-    return pnet_fun, rnet_fun, onet_fun
+        onet.load(os.path.join(model_path, 'det3.npy'), sess, row_major=row_major)
+
+def freeze_mtcnn(sess, model_path, row_major=False):
+    """Creates pnet, rnet and onet with the weights from model_path (as for create_mtcnn) in the
+    graph of sess and returns a GraphDef of them with the weights as constants.
+    """
+    if not model_path:
+        model_path,_ = os.path.split(os.path.realpath(__file__))
+    load_mtcnn_weights(sess, model_path, row_major)
+    return tf.graph_util.convert_variables_to_constants(sess, sess.graph.as_graph_def(), MTCNN_OUTPUT_NODES)
+
+# Number of bilinear samples per output pixel and axis used by the in-graph crop and resize
+CROP_SUPERSAMPLING = 4
+
+def create_crop_and_resize(sess, row_major=False):
+    """Creates a function that crops and resamples all candidate boxes of an image in one run call.
+    The crops are computed with tf.image.crop_and_resize on a CROP_SUPERSAMPLING times finer grid
+    followed by average pooling, which approximates the area interpolation of imresample. The
+    parts of a box outside the image are zero, like the padding done by pad(). The patches are
+    normalized and returned in the (caffe) layout expected by rnet/onet as float32.
+    Compared to the per-box path the patch values differ by on average less than one gray level
+    (out of 255) with the largest differences for boxes smaller than the patch size, which
+    imresample upsamples more sharply. The resulting boxes and scores therefore agree with the
+    per-box path within that tolerance but are not bit exact.
+    row_major: if true, the patches are returned in (height, width) layout for networks
+      created with create_mtcnn(..., row_major=True).
+    """
+    with tf.variable_scope('crop'):
+        image = tf.placeholder(tf.uint8, (None,None,3), 'image')
+        boxes = tf.placeholder(tf.float32, (None,4), 'boxes')
+        size = tf.placeholder(tf.int32, (), 'size')
+        patches = crop_patches(image, boxes, size, row_major=row_major, name='patches')
+
+    # The scope is uniquified if there is more than one crop function in the graph, so use the
+    # names of the tensors as created
+    def crop_fun(img, total_boxes, box_size):
+        feed_dict = {image.name:img, boxes.name:total_boxes[:,0:4], size.name:box_size}
+        return sess.run(patches.name, feed_dict=feed_dict)
+    return crop_fun
+
+def crop_patches(image, boxes, size, row_major=False, name=None):
+    """Crops the boxes [x1, y1, x2, y2] (one based, inclusive) from an image tensor and resamples
+    them to normalized size x size patches, in caffe's (width, height) layout unless row_major is set.
+    The sampling boxes are chosen such that the samples end up at the pixel centers of the
+    supersampled output grid, which is how cv2.resize maps output pixels to the input image.
+    """
+    n = size*CROP_SUPERSAMPLING
+    shape = tf.shape(image)
+    h = tf.cast(shape[0], tf.float32)
+    w = tf.cast(shape[1], tf.float32)
+    nf = tf.cast(n, tf.float32)
+    x = boxes[:,0]-1
+    y = boxes[:,1]-1
+    tmpw = boxes[:,2]-boxes[:,0]+1
+    tmph = boxes[:,3]-boxes[:,1]+1
+    x1 = (x + 0.5*tmpw/nf - 0.5) / tf.maximum(w-1, 1)
+    y1 = (y + 0.5*tmph/nf - 0.5) / tf.maximum(h-1, 1)
+    x2 = (x + (nf-0.5)*tmpw/nf - 0.5) / tf.maximum(w-1, 1)
+    y2 = (y + (nf-0.5)*tmph/nf - 0.5) / tf.maximum(h-1, 1)
+    crop_boxes = tf.stack([y1, x1, y2, x2], axis=1)
+    box_ind = tf.zeros(tf.shape(boxes)[0:1], dtype=tf.int32)
+    patches = tf.image.crop_and_resize(tf.expand_dims(image, 0), crop_boxes, box_ind, [n, n])
+    patches = tf.nn.avg_pool(patches, ksize=[1, CROP_SUPERSAMPLING, CROP_SUPERSAMPLING, 1],
+        strides=[1, CROP_SUPERSAMPLING, CROP_SUPERSAMPLING, 1], padding='VALID')
+    patches = (patches-127.5)*0.0078125
+    if row_major:
+        return tf.identity(patches, name=name)
+    return tf.transpose(patches, (0,2,1,3), name=name)
+
+def create_mtcnn_fused(sess, model_path):
+    """Creates a detector that runs the complete cascade in a single session run.
+    The scale pyramid, pnet, bounding box generation, nms, cropping of the candidates, rnet, onet
+    and the bounding box regression are all part of the graph and share the weights loaded by
+    create_mtcnn, converted to row-major layout so that no transposes are needed in the graph.
+    The pyramid levels are resampled with tf.image.resize_area and the candidates
+    with crop_patches, so the results agree with detect_face within the tolerance described for
+    create_crop_and_resize but are not bit exact.
+    Returns a function fused_fun(img, minsize, threshold, factor) that takes the same arguments
+    as detect_face and returns the bounding boxes and points in the same format.
+    model_path: directory with the det1.npy, det2.npy and det3.npy weights (the directory of this
+      file if None). Frozen graphs are not supported since the networks are rebuilt in the graph.
+    """
+    if model_path and os.path.isfile(model_path):
+        raise ValueError('The fused detector is built from the det1.npy, det2.npy and det3.npy weights and '
+                         'cannot use the frozen graph %s, pass the directory with the weights instead' % model_path)
+    create_mtcnn(sess, model_path, row_major=True)
+
+    with tf.name_scope('mtcnn'):
+        image = tf.placeholder(tf.uint8, (None,None,3), 'image')
+        minsize = tf.placeholder(tf.float64, (), 'minsize')
+        threshold = tf.placeholder(tf.float32, (3,), 'threshold')
+        factor = tf.placeholder(tf.float64, (), 'factor')
+
+        # first stage
+        shape = tf.shape(image)
+        h = tf.cast(shape[0], tf.float64)
+        w = tf.cast(shape[1], tf.float64)
+        m = 12.0/minsize
+        img = tf.expand_dims(image, 0)
+
+        def pnet_scale(factor_count, minl, boxes_array):
+            scale = m*tf.pow(factor, tf.cast(factor_count, tf.float64))
+            hs = tf.cast(tf.ceil(h*scale), tf.int32)
+            ws = tf.cast(tf.ceil(w*scale), tf.int32)
+            im_data = tf.image.resize_area(img, tf.stack([hs, ws]))
+            im_data = (im_data-127.5)*0.0078125
+            with tf.variable_scope('pnet', reuse=True):
+                pnet = PNet({'data':im_data})
+            boxes, scores, reg = _tf_generate_bounding_box(pnet.layers['prob1'][0,:,:,1],
+                pnet.layers['conv4-2'][0], tf.cast(scale, tf.float32), threshold[0])
+            # inter-scale nms
+            pick = _tf_nms(boxes, scores, 0.5, 'Union')
+            boxes = tf.concat([tf.gather(boxes, pick), tf.expand_dims(tf.gather(scores, pick), 1), tf.gather(reg, pick)], 1)
+            return factor_count+1, minl*factor, boxes_array.write(factor_count+1, boxes)
+
+        boxes_array = tf.TensorArray(tf.float32, size=1, dynamic_size=True, infer_shape=False)
+        boxes_array = boxes_array.write(0, tf.zeros((0,9)))
+        _, _, boxes_array = tf.while_loop(lambda factor_count, minl, _: minl>=12, pnet_scale,
+            [0, tf.minimum(h, w)*m, boxes_array])
+        total_boxes = boxes_array.concat()
+
+        pick = _tf_nms(total_boxes[:,0:4], total_boxes[:,4], 0.7, 'Union')
+        total_boxes = tf.gather(total_boxes, pick)
+        regw = total_boxes[:,2]-total_boxes[:,0]
+        regh = total_boxes[:,3]-total_boxes[:,1]
+        boxes = total_boxes[:,0:4] + total_boxes[:,5:9]*tf.stack([regw, regh, regw, regh], 1)
+        boxes = _tf_fix(_tf_rerec(boxes))
+        scores = total_boxes[:,4]
+
+        # second stage
+        with tf.variable_scope('rnet', reuse=True):
+            rnet = RNet({'data':crop_patches(image, boxes, 24, row_major=True)})
+        ipass = tf.where(rnet.layers['prob1'][:,1]>threshold[1])[:,0]
+        boxes = tf.gather(boxes, ipass)
+        scores = tf.gather(rnet.layers['prob1'][:,1], ipass)
+        mv = tf.gather(rnet.layers['conv5-2'], ipass)
+        pick = _tf_nms(boxes, scores, 0.7, 'Union')
+        boxes = _tf_rerec(_tf_bbreg(tf.gather(boxes, pick), tf.gather(mv, pick)))
+        scores = tf.gather(scores, pick)
+
+        # third stage
+        boxes = _tf_fix(boxes)
+        with tf.variable_scope('onet', reuse=True):
+            onet = ONet({'data':crop_patches(image, boxes, 48, row_major=True)})
+        ipass = tf.where(onet.layers['prob1'][:,1]>threshold[2])[:,0]
+        boxes = tf.gather(boxes, ipass)
+        scores = tf.gather(onet.layers['prob1'][:,1], ipass)
+        mv = tf.gather(onet.layers['conv6-2'], ipass)
+        points = tf.gather(onet.layers['conv6-3'], ipass)
+        bw = tf.expand_dims(boxes[:,2]-boxes[:,0]+1, 1)
+        bh = tf.expand_dims(boxes[:,3]-boxes[:,1]+1, 1)
+        points = tf.concat([bw*points[:,0:5] + tf.expand_dims(boxes[:,0], 1)-1,
+                            bh*points[:,5:10] + tf.expand_dims(boxes[:,1], 1)-1], 1)
+        boxes = _tf_bbreg(boxes, mv)
+        pick = _tf_nms(boxes, scores, 0.7, 'Min')
+        total_boxes = tf.concat([tf.gather(boxes, pick), tf.expand_dims(tf.gather(scores, pick), 1)], 1, name='total_boxes')
+        points = tf.transpose(tf.gather(points, pick), name='points')
+
+    fused_fun = lambda img, minsize_value, threshold_value, factor_value : sess.run((total_boxes.name, points.name),
+        feed_dict={image.name:img, minsize.name:minsize_value, threshold.name:threshold_value, factor.name:factor_value})
+    return fused_fun
+
+def _tf_fix(x):
+    """In-graph version of np.fix"""
+    return tf.sign(x)*tf.floor(tf.abs(x))
+
+def _tf_generate_bounding_box(imap, reg, scale, t):
+    """In-graph version of generateBoundingBox for pnet outputs in (y, x) layout.
+    Returns the boxes, their scores and their regression offsets.
+    """
+    stride=2
+    cellsize=12
 
-def detect_face(img, minsize, pnet, rnet, onet, threshold, factor):
+    yx = tf.where(imap >= t)
+    score = tf.gather_nd(imap, yx)
+    reg = tf.gather_nd(reg, yx)
+    bb = tf.cast(tf.reverse(yx, [1]), tf.float32)
+    q1 = _tf_fix((stride*bb+1)/scale)
+    q2 = _tf_fix((stride*bb+cellsize-1+1)/scale)
+    return tf.concat([q1, q2], 1), score, reg
+
+def _tf_nms(boxes, scores, threshold, method):
+    """In-graph version of nms. Returns the indices of the picked boxes."""
+    # The boxes may come from a TensorArray of unknown shape, which tf.while_loop does not accept
+    boxes = tf.reshape(boxes, [-1, 4])
+    scores = tf.reshape(scores, [-1])
+    x1, y1, x2, y2 = tf.unstack(boxes, 4, 1)
+    if method != 'Min':
+        # The boxes are inclusive, extend them by one so that the areas match nms
+        return tf.image.non_max_suppression(tf.stack([y1, x1, y2+1, x2+1], 1), scores,
+            tf.shape(scores)[0], iou_threshold=threshold)
+
+    # There is no op for the 'Min' overlap so go through the boxes greedily in order of
+    # decreasing score and let each picked box suppress the boxes after it.
+    nrof_boxes = tf.shape(scores)[0]
+    _, I = tf.nn.top_k(scores, nrof_boxes)
+    x1, y1, x2, y2 = [tf.gather(c, I) for c in (x1, y1, x2, y2)]
+    area = (x2-x1+1) * (y2-y1+1)
+    w = tf.maximum(0.0, tf.minimum(x2[:,None], x2[None,:])-tf.maximum(x1[:,None], x1[None,:])+1)
+    h = tf.maximum(0.0, tf.minimum(y2[:,None], y2[None,:])-tf.maximum(y1[:,None], y1[None,:])+1)
+    suppress = tf.greater(w*h / tf.minimum(area[:,None], area[None,:]), threshold)
+    suppress = tf.logical_and(suppress, tf.greater(tf.range(nrof_boxes)[None,:], tf.range(nrof_boxes)[:,None]))
+
+    def suppress_box(i, alive):
+        return i+1, tf.logical_and(alive, tf.logical_not(tf.logical_and(suppress[i], alive[i])))
+
+    _, alive = tf.while_loop(lambda i, _: i<nrof_boxes, suppress_box, [0, tf.ones([nrof_boxes], tf.bool)])
+    return tf.boolean_mask(I, alive)
+
+def _tf_rerec(boxes):
+    """In-graph version of rerec"""
+    h = boxes[:,3]-boxes[:,1]
+    w = boxes[:,2]-boxes[:,0]
+    l = tf.maximum(w, h)
+    x1 = boxes[:,0]+w*0.5-l*0.5
+    y1 = boxes[:,1]+h*0.5-l*0.5
+    return tf.stack([x1, y1, x1+l, y1+l], 1)
+
+def _tf_bbreg(boxes, reg):
+    """In-graph version of bbreg"""
+    w = boxes[:,2]-boxes[:,0]+1
+    h = boxes[:,3]-boxes[:,1]+1
+    return boxes + reg*tf.stack([w, h, w, h], 1)
+
+# Steps of the detection whose wall time is recorded in DetectionStats.times
+TIMED_STEPS = ('resize', 'pnet', 'rnet', 'onet', 'nms', 'crop')
+
+class DetectionStats(object):
+    """Per-image statistics of a detect_face or bulk_detect_face call: the number of pyramid
+    scales, the number of candidates after each step and the wall time (in seconds) spent in
+    each of TIMED_STEPS.
+    """
+  
+    def __init__(self):
+        self.nrof_scales = 0
+        # candidates from pnet and after the per-scale nms, one entry per scale
+        self.pnet_candidates = []
+        self.pnet_nms_candidates = []
+        # candidates after the nms over all scales ('pnet_nms') and after the score threshold
+        # and the nms of rnet and onet
+        self.stage_candidates = {}
+        self.nrof_faces = 0
+        self.times = dict.fromkeys(TIMED_STEPS, 0.0)
+
+class StatsCollector(object):
+    """Aggregates the DetectionStats of the images passed to detect_face or bulk_detect_face
+    with stats_collector=... Any object with an add(stats) method can be used as collector
+    instead, e.g. to log the statistics of every image.
+    """
+  
+    def __init__(self):
+        self.nrof_images = 0
+        self.nrof_scales = 0
+        self.pnet_candidates = 0
+        self.stage_candidates = {}
+        self.nrof_faces = 0
+        self.times = dict.fromkeys(TIMED_STEPS, 0.0)
+  
+    def add(self, stats):
+        self.nrof_images += 1
+        self.nrof_scales += stats.nrof_scales
+        self.pnet_candidates += sum(stats.pnet_candidates)
+        for step, count in iteritems(stats.stage_candidates):
+            self.stage_candidates[step] = self.stage_candidates.get(step, 0) + count
+        self.nrof_faces += stats.nrof_faces
+        for step, duration in iteritems(stats.times):
+            self.times[step] += duration
+  
+    def summary(self):
+        """Returns the per-image means of the counts and the times (in ms) as a string"""
+        n = max(self.nrof_images, 1)
+        lines = ['images: %d  scales: %.1f  pnet candidates: %.1f  faces: %.2f' % (
+            self.nrof_images, self.nrof_scales/n, self.pnet_candidates/n, self.nrof_faces/n)]
+        lines.append('candidates: ' + '  '.join('%s: %.1f' % (step, self.stage_candidates[step]/n)
+            for step in ('pnet_nms', 'rnet', 'rnet_nms', 'onet', 'onet_nms') if step in self.stage_candidates))
+        lines.append('time (ms): ' + '  '.join('%s: %.2f' % (step, 1000*self.times[step]/n) for step in TIMED_STEPS))
+        return '\n'.join(lines)
+
+class _StageTimer(object):
+    """Context manager that adds its wall time to stats.times[step]"""
+  
+    def __init__(self, stats, step):
+        self.stats = stats
+        self.step = step
+  
+    def __enter__(self):
+        self.start_time = time.time()
+  
+    def __exit__(self, *exc_info):
+        self.stats.times[self.step] += time.time()-self.start_time
+
+class _NoTimer(object):
+  
+    def __enter__(self):
+        pass
+  
+    def __exit__(self, *exc_info):
+        pass
+
+_NO_TIMER = _NoTimer()
+
+def timed(stats, step):
+    """Returns a context manager that records the time of step in stats, or that does nothing
+    if stats is None, so that the detection is not slowed down when no statistics are collected.
+    """
+    return _NO_TIMER if stats is None else _StageTimer(stats, step)
+
+def count_candidates(stats, step, count):
+    """Records the number of candidates after step in stats, if any"""
+    if stats is not None:
+        stats.stage_candidates[step] = count
+
+def detect_face(img, minsize, pnet, rnet, onet, threshold, factor, crop_fun=None, row_major=False, float32=False,
+                pyramid=None, boxes_only=False, stats_collector=None):
     """Detects faces in an image, and returns bounding boxes and points for them.
     img: input image
     minsize: minimum faces' size
     pnet, rnet, onet: caffemodel
     threshold: threshold=[th1, th2, th3], th1-3 are three steps's threshold
     factor: the factor used to create a scaling pyramid of face sizes to detect in the image.
+    crop_fun: optional function from create_crop_and_resize used to extract the inputs to
+      rnet and onet for all boxes at once instead of one box at a time.
+    row_major: true if the networks were created with create_mtcnn(..., row_major=True). The
+      images are then passed to the networks as they are, without transposes.
+    float32: if true, the pyramid images and the rnet/onet inputs are prepared in float32 in
+      buffers that are allocated once per call and reused, instead of in new float64 arrays.
+    pyramid: optional ImagePyramid of img built with the same minsize and factor that is used
+      instead of resampling every pyramid image from img.
+    boxes_only: if true, the detection stops after rnet and returns the bounding boxes from the
+      rnet regression (with the rnet scores) and no points. onet is then not used.
+    stats_collector: optional StatsCollector (or object with an add method) that gets the
+      DetectionStats of the image.
     """
-    factor_count=0
+    stats = DetectionStats() if stats_collector is not None else None
+    buffers = {}
     total_boxes=np.empty((0,9))
-    points=np.empty(0)
     h=img.shape[0]
     w=img.shape[1]
-    minl=np.amin([h, w])
-    m=12.0/minsize
-    minl=minl*m
-    # create scale pyramid
-    scales=[]
-    while minl>=12:
-        scales += [m*np.power(factor, factor_count)]
-        minl = minl*factor
-        factor_count += 1
+    if pyramid is None:
+        scales = scale_pyramid(h, w, minsize, factor)
+    elif pyramid.shape!=img.shape or pyramid.minsize!=minsize or pyramid.factor!=factor:
+        raise ValueError('The pyramid was not built for this image, minsize and factor')
+    else:
+        scales = pyramid.scales
 
     # first stage
-    for scale in scales:
-        hs=int(np.ceil(h*scale))
-        ws=int(np.ceil(w*scale))
-        im_data = imresample(img, (hs, ws))
-        im_data = (im_data-127.5)*0.0078125
-        img_x = np.expand_dims(im_data, 0)
-        img_y = np.transpose(img_x, (0,2,1,3))
-        out = pnet(img_y)
-        out0 = np.transpose(out[0], (0,2,1,3))
-        out1 = np.transpose(out[1], (0,2,1,3))
-        
-        boxes, _ = generateBoundingBox(out1[0,:,:,1].copy(), out0[0,:,:,:].copy(), scale, threshold[0])
+    for i, scale in enumerate(scales):
+        if pyramid is None:
+            hs=int(np.ceil(h*scale))
+            ws=int(np.ceil(w*scale))
+            with timed(stats, 'resize'):
+                im_data = imresample(img, (hs, ws))
+        else:
+            im_data = pyramid.levels[i]
+        boxes = run_pnet(im_data, pnet, scale, threshold[0], row_major, float32, buffers, stats)
         
         # inter-scale nms
-        pick = nms(boxes.copy(), 0.5, 'Union')
+        with timed(stats, 'nms'):
+            pick = fast_nms(boxes.copy(), 0.5, 'Union')
+        if stats is not None:
+            stats.pnet_nms_candidates.append(pick.size)
         if boxes.size>0 and pick.size>0:
             boxes = boxes[pick,:]
             total_boxes = np.append(total_boxes, boxes, axis=0)
 
+    total_boxes, points = refine_candidates(img, total_boxes, rnet, onet, threshold, crop_fun, row_major, float32,
+                                            buffers, boxes_only, stats)
+    if stats is not None:
+        stats.nrof_scales = len(scales)
+        stats.nrof_faces = total_boxes.shape[0]
+        stats_collector.add(stats)
+    return total_boxes, points
+
+# Approximate number of bytes per pixel of a pyramid image used by its normalized copies and the
+# activations of the first pnet layers
+PNET_BYTES_PER_PIXEL = 128
+
+def detect_face_tiled(img, minsize, pnet, rnet, onet, threshold, factor, memory_budget=256*1024*1024,
+                      crop_fun=None, row_major=False, float32=False):
+    """Detects faces like detect_face, but runs pnet on overlapping tiles of each pyramid image to
+    keep the memory used by the first stage below memory_budget (in bytes). This makes it possible
+    to process very large images. The tiles overlap by more than the pnet window so every window is
+    inside a tile, and the candidates of all tiles of a scale are merged with nms so that faces on
+    the seams are only kept once. Returns the bounding boxes and points like detect_face.
+    """
+    buffers = {}
+    total_boxes=np.empty((0,9))
+    h=img.shape[0]
+    w=img.shape[1]
+    # the largest square tile of a pyramid image that fits in the memory budget
+    tile_size = int(np.sqrt(memory_budget / PNET_BYTES_PER_PIXEL))
+
+    # first stage
+    for scale in scale_pyramid(h, w, minsize, factor):
+        # overlap (in image pixels) that fits a 12x12 window plus the pnet stride
+        overlap = int(np.ceil(14/scale))
+        step = int(tile_size/scale)-overlap
+        if step<1:
+            raise ValueError('memory_budget is too small to fit a tile of the pyramid image at scale %f' % scale)
+        scale_boxes = [np.empty((0,9))]
+        for y0 in range(0, max(h-overlap, 1), step):
+            for x0 in range(0, max(w-overlap, 1), step):
+                y1 = min(y0+step+overlap, h)
+                x1 = min(x0+step+overlap, w)
+                hs=int(np.ceil((y1-y0)*scale))
+                ws=int(np.ceil((x1-x0)*scale))
+                boxes = run_pnet(imresample(img[y0:y1,x0:x1,:], (hs, ws)), pnet, scale, threshold[0], row_major, float32, buffers)
+                if boxes.size>0:
+                    boxes[:,[0,2]] += x0
+                    boxes[:,[1,3]] += y0
+                    scale_boxes.append(boxes)
+        boxes = np.vstack(scale_boxes)
+        
+        # inter-scale nms, which also merges the candidates from overlapping tiles
+        pick = fast_nms(boxes.copy(), 0.5, 'Union')
+        if boxes.size>0 and pick.size>0:
+            boxes = boxes[pick,:]
+            total_boxes = np.append(total_boxes, boxes, axis=0)
+
+    return refine_candidates(img, total_boxes, rnet, onet, threshold, crop_fun, row_major, float32, buffers)
+
+class ImagePyramid(object):
+    """Scale pyramid of an image for detect_face where each level is resampled from a previous,
+    already downscaled level instead of from the full image, so the cost of a level scales with
+    the size of the level. The source of a level is the smallest previous level that is at least
+    twice as large, which keeps the levels within a fraction of a gray level on average from the
+    ones resampled directly from the image (resampling from the immediately previous level is
+    cheaper but blurs the small levels noticeably). The levels are kept so that the pyramid can
+    be reused, e.g. to run detect_face with different thresholds.
+    """
+  
+    def __init__(self, img, minsize, factor):
+        self.shape = img.shape
+        self.minsize = minsize
+        self.factor = factor
+        h = img.shape[0]
+        w = img.shape[1]
+        self.scales = scale_pyramid(h, w, minsize, factor)
+        self.levels = []
+        source = img
+        for scale in self.scales:
+            hs = int(np.ceil(h*scale))
+            ws = int(np.ceil(w*scale))
+            for level in self.levels:
+                if level.shape[0]>=2*hs and level.shape[1]>=2*ws:
+                    source = level
+            self.levels.append(imresample(source, (hs, ws)))
+  
+    def __len__(self):
+        return len(self.scales)
+
+def scale_pyramid(h, w, minsize, factor):
+    """Returns the scales of the pyramid images for an image of size h x w"""
+    factor_count=0
+    minl=np.amin([h, w])
+    m=12.0/minsize
+    minl=minl*m
+    scales=[]
+    while minl>=12:
+        scales += [m*np.power(factor, factor_count)]
+        minl = minl*factor
+        factor_count += 1
+    return scales
+
+def run_pnet(im_data, pnet, scale, threshold, row_major=False, float32=False, buffers=None, stats=None):
+    """Runs pnet on a resampled (uint8) pyramid image and returns the candidate boxes"""
+    with timed(stats, 'resize'):
+        if float32:
+            im_data = np.subtract(im_data, 127.5, out=reuse_buffer(buffers, 'pyramid', im_data.shape), dtype=np.float32)
+            im_data *= 0.0078125
+        else:
+            im_data = (im_data-127.5)*0.0078125
+    img_x = np.expand_dims(im_data, 0)
+    with timed(stats, 'pnet'):
+        if row_major:
+            out0, out1 = pnet(img_x)
+        else:
+            img_y = np.transpose(img_x, (0,2,1,3))
+            out = pnet(img_y)
+            out0 = np.transpose(out[0], (0,2,1,3))
+            out1 = np.transpose(out[1], (0,2,1,3))
+    
+    boxes, _ = generateBoundingBox(out1[0,:,:,1].copy(), out0[0,:,:,:].copy(), scale, threshold)
+    if stats is not None:
+        stats.pnet_candidates.append(boxes.shape[0])
+    return boxes
+
+def refine_candidates(img, total_boxes, rnet, onet, threshold, crop_fun=None, row_major=False, float32=False, buffers=None,
+                      boxes_only=False, stats=None):
+    """Runs the second and third stage of detect_face on the candidates from pnet and returns
+    the bounding boxes and points. The arguments are as for detect_face, stats is an optional
+    DetectionStats that gets the candidate counts and times of the stages.
+    """
+    points=np.empty(0)
     numbox = total_boxes.shape[0]
     if numbox>0:
-        pick = nms(total_boxes.copy(), 0.7, 'Union')
+        with timed(stats, 'nms'):
+            pick = fast_nms(total_boxes.copy(), 0.7, 'Union')
         total_boxes = total_boxes[pick,:]
         regw = total_boxes[:,2]-total_boxes[:,0]
         regh = total_boxes[:,3]-total_boxes[:,1]
@@ -351,83 +852,149 @@ def detect_face(img, minsize, pnet, rnet, onet, threshold, factor):
         total_boxes = np.transpose(np.vstack([qq1, qq2, qq3, qq4, total_boxes[:,4]]))
         total_boxes = rerec(total_boxes.copy())
         total_boxes[:,0:4] = np.fix(total_boxes[:,0:4]).astype(np.int32)
-        dy, edy, dx, edx, y, ey, x, ex, tmpw, tmph = pad(total_boxes.copy(), w, h)
 
     numbox = total_boxes.shape[0]
+    count_candidates(stats, 'pnet_nms', numbox)
     if numbox>0:
         # second stage
-        tempimg = np.zeros((24,24,3,numbox))
-        for k in range(0,numbox):
-            tmp = np.zeros((int(tmph[k]),int(tmpw[k]),3))
-            tmp[dy[k]-1:edy[k],dx[k]-1:edx[k],:] = img[y[k]-1:ey[k],x[k]-1:ex[k],:]
-            if tmp.shape[0]>0 and tmp.shape[1]>0 or tmp.shape[0]==0 and tmp.shape[1]==0:
-                tempimg[:,:,:,k] = imresample(tmp, (24, 24))
-            else:
-                return np.empty()
-        tempimg = (tempimg-127.5)*0.0078125
-        tempimg1 = np.transpose(tempimg, (3,1,0,2))
-        out = rnet(tempimg1)
+        tempimg1 = stage_input(img, total_boxes, 24, crop_fun, row_major, float32, buffers, stats)
+        with timed(stats, 'rnet'):
+            out = rnet(tempimg1)
         out0 = np.transpose(out[0])
         out1 = np.transpose(out[1])
         score = out1[1,:]
         ipass = np.where(score>threshold[1])
         total_boxes = np.hstack([total_boxes[ipass[0],0:4].copy(), np.expand_dims(score[ipass].copy(),1)])
         mv = out0[:,ipass[0]]
+        count_candidates(stats, 'rnet', total_boxes.shape[0])
         if total_boxes.shape[0]>0:
-            pick = nms(total_boxes, 0.7, 'Union')
+            with timed(stats, 'nms'):
+                pick = fast_nms(total_boxes, 0.7, 'Union')
             total_boxes = total_boxes[pick,:]
+            count_candidates(stats, 'rnet_nms', total_boxes.shape[0])
             total_boxes = bbreg(total_boxes.copy(), np.transpose(mv[:,pick]))
+            if boxes_only:
+                return total_boxes, points
             total_boxes = rerec(total_boxes.copy())
 
     numbox = total_boxes.shape[0]
-    if numbox>0:
+    if numbox>0 and not boxes_only:
         # third stage
         total_boxes = np.fix(total_boxes).astype(np.int32)
+        total_boxes, points = run_onet(img, total_boxes, onet, threshold[2], crop_fun, row_major, float32, buffers, stats)
+        count_candidates(stats, 'onet', total_boxes.shape[0])
+        if total_boxes.shape[0]>0:
+            with timed(stats, 'nms'):
+                pick = fast_nms(total_boxes.copy(), 0.7, 'Min')
+            total_boxes = total_boxes[pick,:]
+            points = points[:,pick]
+            count_candidates(stats, 'onet_nms', total_boxes.shape[0])
+                
+    return total_boxes, points
+
+def run_onet(img, total_boxes, onet, threshold, crop_fun=None, row_major=False, float32=False, buffers=None, stats=None):
+    """Runs onet on the boxes and returns the boxes with a score above threshold after the
+    bounding box regression, together with their points.
+    """
+    tempimg1 = stage_input(img, total_boxes, 48, crop_fun, row_major, float32, buffers, stats)
+    with timed(stats, 'onet'):
+        out = onet(tempimg1)
+    out0 = np.transpose(out[0])
+    out1 = np.transpose(out[1])
+    out2 = np.transpose(out[2])
+    score = out2[1,:]
+    points = out1
+    ipass = np.where(score>threshold)
+    points = points[:,ipass[0]]
+    total_boxes = np.hstack([total_boxes[ipass[0],0:4].copy(), np.expand_dims(score[ipass].copy(),1)])
+    mv = out0[:,ipass[0]]
+
+    w = total_boxes[:,2]-total_boxes[:,0]+1
+    h = total_boxes[:,3]-total_boxes[:,1]+1
+    points[0:5,:] = np.tile(w,(5, 1))*points[0:5,:] + np.tile(total_boxes[:,0],(5, 1))-1
+    points[5:10,:] = np.tile(h,(5, 1))*points[5:10,:] + np.tile(total_boxes[:,1],(5, 1))-1
+    if total_boxes.shape[0]>0:
+        total_boxes = bbreg(total_boxes.copy(), np.transpose(mv))
+    return total_boxes, points
+
+def refine_landmarks(img, boxes, onet, threshold=None, crop_fun=None, row_major=False, float32=False):
+    """Runs only the last stage of detect_face (onet) on boxes that are already known, e.g. from a
+    tracker or a previous frame, to get the facial landmarks for them.
+    img: input image
+    boxes: array with a box [x1, y1, x2, y2, ...] per row. Only the first four columns are used.
+    onet: caffemodel
+    threshold: optional onet score threshold. If None all boxes are kept, so that the rows of
+      the output correspond to the input boxes.
+    crop_fun, row_major, float32: as for detect_face
+    Returns the bounding boxes refined by onet (with the onet scores) and the points like detect_face.
+    """
+    if boxes.shape[0]==0:
+        return np.empty((0,5)), np.empty((10,0))
+    total_boxes = rerec(np.array(boxes[:,0:4], dtype=np.float64))
+    total_boxes = np.fix(total_boxes).astype(np.int32)
+    if threshold is None:
+        threshold = -np.inf
+    return run_onet(img, total_boxes, onet, threshold, crop_fun, row_major, float32, {})
+
+def stage_input(img, total_boxes, size, crop_fun=None, row_major=False, float32=False, buffers=None, stats=None):
+    """Crops the boxes from the image and returns them as size x size input for rnet/onet"""
+    with timed(stats, 'crop'):
+        return _stage_input(img, total_boxes, size, crop_fun, row_major, float32, buffers)
+
+def _stage_input(img, total_boxes, size, crop_fun, row_major, float32, buffers):
+    if crop_fun is not None:
+        return crop_fun(img, total_boxes, size)
+    if float32:
+        tempimg1 = crop_resize_float32(img, total_boxes, size, buffers)
+    else:
+        h, w = img.shape[0:2]
+        numbox = total_boxes.shape[0]
         dy, edy, dx, edx, y, ey, x, ex, tmpw, tmph = pad(total_boxes.copy(), w, h)
-        tempimg = np.zeros((48,48,3,numbox))
+        tempimg = np.zeros((numbox,size,size,3))
         for k in range(0,numbox):
             tmp = np.zeros((int(tmph[k]),int(tmpw[k]),3))
             tmp[dy[k]-1:edy[k],dx[k]-1:edx[k],:] = img[y[k]-1:ey[k],x[k]-1:ex[k],:]
             if tmp.shape[0]>0 and tmp.shape[1]>0 or tmp.shape[0]==0 and tmp.shape[1]==0:
-                tempimg[:,:,:,k] = imresample(tmp, (48, 48))
+                tempimg[k,:,:,:] = imresample(tmp, (size, size))
             else:
                 return np.empty()
-        tempimg = (tempimg-127.5)*0.0078125
-        tempimg1 = np.transpose(tempimg, (3,1,0,2))
-        out = onet(tempimg1)
-        out0 = np.transpose(out[0])
-        out1 = np.transpose(out[1])
-        out2 = np.transpose(out[2])
-        score = out2[1,:]
-        points = out1
-        ipass = np.where(score>threshold[2])
-        points = points[:,ipass[0]]
-        total_boxes = np.hstack([total_boxes[ipass[0],0:4].copy(), np.expand_dims(score[ipass].copy(),1)])
-        mv = out0[:,ipass[0]]
-
-        w = total_boxes[:,2]-total_boxes[:,0]+1
-        h = total_boxes[:,3]-total_boxes[:,1]+1
-        points[0:5,:] = np.tile(w,(5, 1))*points[0:5,:] + np.tile(total_boxes[:,0],(5, 1))-1
-        points[5:10,:] = np.tile(h,(5, 1))*points[5:10,:] + np.tile(total_boxes[:,1],(5, 1))-1
-        if total_boxes.shape[0]>0:
-            total_boxes = bbreg(total_boxes.copy(), np.transpose(mv))
-            pick = nms(total_boxes.copy(), 0.7, 'Min')
-            total_boxes = total_boxes[pick,:]
-            points = points[:,pick]
-                
-    return total_boxes, points
+        tempimg1 = (tempimg-127.5)*0.0078125
+    if not row_major:
+        tempimg1 = np.transpose(tempimg1, (0,2,1,3))
+    return tempimg1
 
 
-def bulk_detect_face(images, detection_window_size_ratio, pnet, rnet, onet, threshold, factor):
+def bulk_detect_face(images, detection_window_size_ratio, pnet, rnet, onet, threshold, factor, crop_fun=None, pnet_canvas_growth=None,
+                     row_major=False, stats_collector=None, max_stage_batch=None, max_pnet_candidates=None):
     """Detects faces in a list of images
     images: list containing input images
     detection_window_size_ratio: ratio of minimum face size to smallest image dimension
     pnet, rnet, onet: caffemodel
     threshold: threshold=[th1 th2 th3], th1-3 are three steps's threshold [0-1]
     factor: the factor used to create a scaling pyramid of face sizes to detect in the image.
+    crop_fun: optional function from create_crop_and_resize used to extract the inputs to
+      rnet and onet for all boxes of an image at once instead of one box at a time.
+    pnet_canvas_growth: if set, the pyramid images are zero padded at the bottom and right to
+      the next size in the geometric series of canvas sizes given by pnet_canvas_size, e.g. 1.25
+      for a series that grows by 25% per step. Pyramid levels of images with different sizes
+      then share a small fixed set of canvas sizes and are run through pnet in the same batch.
+      Only the output cells of the unpadded image are used. Windows touching the bottom or right
+      border of a pyramid level with odd size see one padded pixel and can get slightly
+      different scores.
+    row_major: true if the networks were created with create_mtcnn(..., row_major=True). The
+      images are then passed to the networks as they are, without transposes.
+    stats_collector: optional StatsCollector (or object with an add method) that gets the
+      DetectionStats of every image. The times of the batched network runs are split between
+      the images in proportion to their share of the batch.
+    max_stage_batch: if set, the candidates of all images are run through rnet and onet in
+      batches of at most this many boxes, which bounds the memory used by the second and third
+      stage. By default all candidates of a stage are run in one batch.
+    max_pnet_candidates: if set, only this many candidates with the highest pnet scores are kept
+      per image after the nms over all scales, e.g. to bound the work for crowd scenes.
     """
     all_scales = [None] * len(images)
     images_with_boxes = [None] * len(images)
+    all_stats = [DetectionStats() for _ in images] if stats_collector is not None else None
 
     for i in range(len(images)):
         images_with_boxes[i] = {'total_boxes': np.empty((0, 9))}
@@ -456,8 +1023,6 @@ def bulk_detect_face(images, detection_window_size_ratio, pnet, rnet, onet, thre
 
     images_obj_per_resolution = {}
 
-    # TODO: use some type of rounding to number module 8 to increase probability that pyramid images will have the same resolution across input images
-
     for index, scales in enumerate(all_scales):
         h = images[index].shape[0]
         w = images[index].shape[1]
@@ -466,28 +1031,58 @@ def bulk_detect_face(images, detection_window_size_ratio, pnet, rnet, onet, thre
             hs = int(np.ceil(h * scale))
             ws = int(np.ceil(w * scale))
 
-            if (ws, hs) not in images_obj_per_resolution:
-                images_obj_per_resolution[(ws, hs)] = []
-
-            im_data = imresample(images[index], (hs, ws))
-            im_data = (im_data - 127.5) * 0.0078125
-            img_y = np.transpose(im_data, (1, 0, 2))  # caffe uses different dimensions ordering
-            images_obj_per_resolution[(ws, hs)].append({'scale': scale, 'image': img_y, 'index': index})
+            if pnet_canvas_growth:
+                resolution = (pnet_canvas_size(ws, pnet_canvas_growth), pnet_canvas_size(hs, pnet_canvas_growth))
+            else:
+                resolution = (ws, hs)
+            if resolution not in images_obj_per_resolution:
+                images_obj_per_resolution[resolution] = []
+
+            with timed(all_stats and all_stats[index], 'resize'):
+                im_data = imresample(images[index], (hs, ws))
+                im_data = (im_data - 127.5) * 0.0078125
+            if row_major:
+                img_y = im_data
+            else:
+                img_y = np.transpose(im_data, (1, 0, 2))  # caffe uses different dimensions ordering
+            images_obj_per_resolution[resolution].append({'scale': scale, 'image': img_y, 'index': index})
 
     for resolution in images_obj_per_resolution:
-        images_per_resolution = [i['image'] for i in images_obj_per_resolution[resolution]]
+        if pnet_canvas_growth:
+            canvas_shape = (resolution[1], resolution[0]) if row_major else resolution
+            images_per_resolution = np.zeros((len(images_obj_per_resolution[resolution]),) + canvas_shape + (3,),
+                                             dtype=np.float32)
+            for index, image_obj in enumerate(images_obj_per_resolution[resolution]):
+                image_shape = image_obj['image'].shape
+                images_per_resolution[index, 0:image_shape[0], 0:image_shape[1], :] = image_obj['image']
+        else:
+            images_per_resolution = [i['image'] for i in images_obj_per_resolution[resolution]]
+        start_time = time.time()
         outs = pnet(images_per_resolution)
+        if all_stats is not None:
+            apportion_time(all_stats, 'pnet', time.time() - start_time,
+                           [(i['index'], i['image'].size) for i in images_obj_per_resolution[resolution]])
 
         for index in range(len(outs[0])):
             scale = images_obj_per_resolution[resolution][index]['scale']
             image_index = images_obj_per_resolution[resolution][index]['index']
-            out0 = np.transpose(outs[0][index], (1, 0, 2))
-            out1 = np.transpose(outs[1][index], (1, 0, 2))
+            # keep only the output cells of the unpadded pyramid image
+            image_shape = images_obj_per_resolution[resolution][index]['image'].shape
+            out0 = outs[0][index][0:pnet_output_size(image_shape[0]), 0:pnet_output_size(image_shape[1]), :]
+            out1 = outs[1][index][0:pnet_output_size(image_shape[0]), 0:pnet_output_size(image_shape[1]), :]
+            if not row_major:
+                out0 = np.transpose(out0, (1, 0, 2))
+                out1 = np.transpose(out1, (1, 0, 2))
 
             boxes, _ = generateBoundingBox(out1[:, :, 1].copy(), out0[:, :, :].copy(), scale, threshold[0])
 
             # inter-scale nms
-            pick = nms(boxes.copy(), 0.5, 'Union')
+            stats = all_stats and all_stats[image_index]
+            with timed(stats, 'nms'):
+                pick = fast_nms(boxes.copy(), 0.5, 'Union')
+            if stats is not None:
+                stats.pnet_candidates.append(boxes.shape[0])
+                stats.pnet_nms_candidates.append(pick.size)
             if boxes.size > 0 and pick.size > 0:
                 boxes = boxes[pick, :]
                 images_with_boxes[image_index]['total_boxes'] = np.append(images_with_boxes[image_index]['total_boxes'],
@@ -495,12 +1090,15 @@ def bulk_detect_face(images, detection_window_size_ratio, pnet, rnet, onet, thre
                                                                           axis=0)
 
     for index, image_obj in enumerate(images_with_boxes):
+        stats = all_stats and all_stats[index]
         numbox = image_obj['total_boxes'].shape[0]
         if numbox > 0:
-            h = images[index].shape[0]
-            w = images[index].shape[1]
-            pick = nms(image_obj['total_boxes'].copy(), 0.7, 'Union')
+            with timed(stats, 'nms'):
+                pick = fast_nms(image_obj['total_boxes'].copy(), 0.7, 'Union')
             image_obj['total_boxes'] = image_obj['total_boxes'][pick, :]
+            if max_pnet_candidates is not None and image_obj['total_boxes'].shape[0] > max_pnet_candidates:
+                keep = np.argsort(-image_obj['total_boxes'][:, 4], kind='mergesort')[0:max_pnet_candidates]
+                image_obj['total_boxes'] = image_obj['total_boxes'][np.sort(keep), :]
             regw = image_obj['total_boxes'][:, 2] - image_obj['total_boxes'][:, 0]
             regh = image_obj['total_boxes'][:, 3] - image_obj['total_boxes'][:, 1]
             qq1 = image_obj['total_boxes'][:, 0] + image_obj['total_boxes'][:, 5] * regw
@@ -510,43 +1108,27 @@ def bulk_detect_face(images, detection_window_size_ratio, pnet, rnet, onet, thre
             image_obj['total_boxes'] = np.transpose(np.vstack([qq1, qq2, qq3, qq4, image_obj['total_boxes'][:, 4]]))
             image_obj['total_boxes'] = rerec(image_obj['total_boxes'].copy())
             image_obj['total_boxes'][:, 0:4] = np.fix(image_obj['total_boxes'][:, 0:4]).astype(np.int32)
-            dy, edy, dx, edx, y, ey, x, ex, tmpw, tmph = pad(image_obj['total_boxes'].copy(), w, h)
-
-            numbox = image_obj['total_boxes'].shape[0]
-            tempimg = np.zeros((24, 24, 3, numbox))
-
-            if numbox > 0:
-                for k in range(0, numbox):
-                    tmp = np.zeros((int(tmph[k]), int(tmpw[k]), 3))
-                    tmp[dy[k] - 1:edy[k], dx[k] - 1:edx[k], :] = images[index][y[k] - 1:ey[k], x[k] - 1:ex[k], :]
-                    if tmp.shape[0] > 0 and tmp.shape[1] > 0 or tmp.shape[0] == 0 and tmp.shape[1] == 0:
-                        tempimg[:, :, :, k] = imresample(tmp, (24, 24))
-                    else:
-                        return np.empty()
-
-                tempimg = (tempimg - 127.5) * 0.0078125
-                image_obj['rnet_input'] = np.transpose(tempimg, (3, 1, 0, 2))
+            image_obj['rnet_input_count'] = image_obj['total_boxes'].shape[0]
+        count_candidates(stats, 'pnet_nms', image_obj['total_boxes'].shape[0])
 
     # # # # # # # # # # # # #
     # second stage - refinement of face candidates with rnet
     # # # # # # # # # # # # #
 
-    bulk_rnet_input = np.empty((0, 24, 24, 3))
-    for index, image_obj in enumerate(images_with_boxes):
-        if 'rnet_input' in image_obj:
-            bulk_rnet_input = np.append(bulk_rnet_input, image_obj['rnet_input'], axis=0)
-
-    out = rnet(bulk_rnet_input)
+    out = run_stage_batched(rnet, 'rnet', 24, images, [image_obj['total_boxes'] if 'rnet_input_count' in image_obj else None
+                                                      for image_obj in images_with_boxes],
+                            max_stage_batch, crop_fun, row_major, all_stats)
     out0 = np.transpose(out[0])
     out1 = np.transpose(out[1])
     score = out1[1, :]
 
     i = 0
     for index, image_obj in enumerate(images_with_boxes):
-        if 'rnet_input' not in image_obj:
+        if 'rnet_input_count' not in image_obj:
             continue
 
-        rnet_input_count = image_obj['rnet_input'].shape[0]
+        stats = all_stats and all_stats[index]
+        rnet_input_count = image_obj['rnet_input_count']
         score_per_image = score[i:i + rnet_input_count]
         out0_per_image = out0[:, i:i + rnet_input_count]
 
@@ -555,31 +1137,18 @@ def bulk_detect_face(images, detection_window_size_ratio, pnet, rnet, onet, thre
                                               np.expand_dims(score_per_image[ipass].copy(), 1)])
 
         mv = out0_per_image[:, ipass[0]]
+        count_candidates(stats, 'rnet', image_obj['total_boxes'].shape[0])
 
         if image_obj['total_boxes'].shape[0] > 0:
-            h = images[index].shape[0]
-            w = images[index].shape[1]
-            pick = nms(image_obj['total_boxes'], 0.7, 'Union')
+            with timed(stats, 'nms'):
+                pick = fast_nms(image_obj['total_boxes'], 0.7, 'Union')
             image_obj['total_boxes'] = image_obj['total_boxes'][pick, :]
+            count_candidates(stats, 'rnet_nms', image_obj['total_boxes'].shape[0])
             image_obj['total_boxes'] = bbreg(image_obj['total_boxes'].copy(), np.transpose(mv[:, pick]))
             image_obj['total_boxes'] = rerec(image_obj['total_boxes'].copy())
 
-            numbox = image_obj['total_boxes'].shape[0]
-
-            if numbox > 0:
-                tempimg = np.zeros((48, 48, 3, numbox))
-                image_obj['total_boxes'] = np.fix(image_obj['total_boxes']).astype(np.int32)
-                dy, edy, dx, edx, y, ey, x, ex, tmpw, tmph = pad(image_obj['total_boxes'].copy(), w, h)
-
-                for k in range(0, numbox):
-                    tmp = np.zeros((int(tmph[k]), int(tmpw[k]), 3))
-                    tmp[dy[k] - 1:edy[k], dx[k] - 1:edx[k], :] = images[index][y[k] - 1:ey[k], x[k] - 1:ex[k], :]
-                    if tmp.shape[0] > 0 and tmp.shape[1] > 0 or tmp.shape[0] == 0 and tmp.shape[1] == 0:
-                        tempimg[:, :, :, k] = imresample(tmp, (48, 48))
-                    else:
-                        return np.empty()
-                tempimg = (tempimg - 127.5) * 0.0078125
-                image_obj['onet_input'] = np.transpose(tempimg, (3, 1, 0, 2))
+            image_obj['total_boxes'] = np.fix(image_obj['total_boxes']).astype(np.int32)
+            image_obj['onet_input_count'] = image_obj['total_boxes'].shape[0]
 
         i += rnet_input_count
 
@@ -587,12 +1156,9 @@ def bulk_detect_face(images, detection_window_size_ratio, pnet, rnet, onet, thre
     # third stage - further refinement and facial landmarks positions with onet
     # # # # # # # # # # # # #
 
-    bulk_onet_input = np.empty((0, 48, 48, 3))
-    for index, image_obj in enumerate(images_with_boxes):
-        if 'onet_input' in image_obj:
-            bulk_onet_input = np.append(bulk_onet_input, image_obj['onet_input'], axis=0)
-
-    out = onet(bulk_onet_input)
+    out = run_stage_batched(onet, 'onet', 48, images, [image_obj['total_boxes'] if 'onet_input_count' in image_obj else None
+                                                      for image_obj in images_with_boxes],
+                            max_stage_batch, crop_fun, row_major, all_stats)
 
     out0 = np.transpose(out[0])
     out1 = np.transpose(out[1])
@@ -603,11 +1169,12 @@ def bulk_detect_face(images, detection_window_size_ratio, pnet, rnet, onet, thre
     i = 0
     ret = []
     for index, image_obj in enumerate(images_with_boxes):
-        if 'onet_input' not in image_obj:
+        if 'onet_input_count' not in image_obj:
             ret.append(None)
             continue
 
-        onet_input_count = image_obj['onet_input'].shape[0]
+        stats = all_stats and all_stats[index]
+        onet_input_count = image_obj['onet_input_count']
 
         out0_per_image = out0[:, i:i + onet_input_count]
         score_per_image = score[i:i + onet_input_count]
@@ -627,11 +1194,14 @@ def bulk_detect_face(images, detection_window_size_ratio, pnet, rnet, onet, thre
         points_per_image[5:10, :] = np.tile(h, (5, 1)) * points_per_image[5:10, :] + np.tile(
             image_obj['total_boxes'][:, 1], (5, 1)) - 1
 
+        count_candidates(stats, 'onet', image_obj['total_boxes'].shape[0])
         if image_obj['total_boxes'].shape[0] > 0:
             image_obj['total_boxes'] = bbreg(image_obj['total_boxes'].copy(), np.transpose(mv))
-            pick = nms(image_obj['total_boxes'].copy(), 0.7, 'Min')
+            with timed(stats, 'nms'):
+                pick = fast_nms(image_obj['total_boxes'].copy(), 0.7, 'Min')
             image_obj['total_boxes'] = image_obj['total_boxes'][pick, :]
             points_per_image = points_per_image[:, pick]
+            count_candidates(stats, 'onet_nms', image_obj['total_boxes'].shape[0])
 
             ret.append((image_obj['total_boxes'], points_per_image))
         else:
@@ -639,8 +1209,110 @@ def bulk_detect_face(images, detection_window_size_ratio, pnet, rnet, onet, thre
 
         i += onet_input_count
 
+    if all_stats is not None:
+        for index, stats in enumerate(all_stats):
+            stats.nrof_scales = len(all_scales[index])
+            stats.nrof_faces = 0 if ret[index] is None else ret[index][0].shape[0]
+            stats_collector.add(stats)
     return ret
 
+def run_stage_batched(net, step, size, images, boxes, max_batch=None, crop_fun=None, row_major=False, all_stats=None):
+    """Runs rnet or onet (net, with size x size inputs) on the boxes of all images in batches of at
+    most max_batch boxes and returns the outputs for all boxes in order. boxes is a list with the
+    boxes of each image, or None for images without candidates. The inputs of a batch are cropped
+    into one preallocated array that is reused for all batches, so the memory used does not grow
+    with the number of candidates when max_batch is set.
+    """
+    counts = [0 if b is None else b.shape[0] for b in boxes]
+    total_count = sum(counts)
+    if max_batch is None:
+        max_batch = max(total_count, 1)
+    elif max_batch < 1:
+        raise ValueError('The maximum stage batch size must be positive')
+
+    # split the boxes into batches of (image index, start, end) slices
+    batches = [[]]
+    batch_count = 0
+    for index, count in enumerate(counts):
+        start = 0
+        while start < count:
+            if batch_count == max_batch:
+                batches.append([])
+                batch_count = 0
+            end = min(count, start + max_batch - batch_count)
+            batches[-1].append((index, start, end))
+            batch_count += end - start
+            start = end
+
+    batch_input = np.empty((min(max_batch, total_count), size, size, 3), dtype=np.float32)
+    outs = []
+    for batch in batches:
+        n = 0
+        for index, start, end in batch:
+            batch_input[n:n + end - start] = stage_input(images[index], boxes[index][start:end], size, crop_fun, row_major,
+                                                         stats=all_stats and all_stats[index])
+            n += end - start
+        start_time = time.time()
+        outs.append(net(batch_input[0:n]))
+        if all_stats is not None:
+            apportion_time(all_stats, step, time.time() - start_time, [(index, end - start) for index, start, end in batch])
+    if len(outs) == 1:
+        return outs[0]
+    return [np.concatenate(out, axis=0) for out in zip(*outs)]
+
+def apportion_time(all_stats, step, duration, weights):
+    """Splits the time of a batched step between the images in proportion to their weights,
+    given as (image index, weight) pairs, e.g. the number of network inputs of each image.
+    """
+    total_weight = float(sum(weight for _, weight in weights))
+    for index, weight in weights:
+        if total_weight > 0:
+            all_stats[index].times[step] += duration * weight / total_weight
+
+
+def reuse_buffer(buffers, name, shape):
+    """Returns a float32 array with the given shape that uses the memory of buffers[name].
+    The buffer is only reallocated when it is too small for the shape.
+    """
+    size = int(np.prod(shape))
+    if name not in buffers or buffers[name].size < size:
+        buffers[name] = np.empty(size, dtype=np.float32)
+    return buffers[name][0:size].reshape(shape)
+
+def crop_resize_float32(img, total_boxes, size, buffers):
+    """Float32 version of the per-box crop and resize used for the rnet/onet inputs.
+    The padded boxes and the normalized size x size patches are written into reused buffers,
+    the patches are returned in (height, width) layout.
+    """
+    h, w = img.shape[0:2]
+    numbox = total_boxes.shape[0]
+    dy, edy, dx, edx, y, ey, x, ex, tmpw, tmph = pad(total_boxes.copy(), w, h)
+    tempimg = reuse_buffer(buffers, 'stage', (numbox, size, size, 3))
+    for k in range(0,numbox):
+        tmp = reuse_buffer(buffers, 'box', (int(tmph[k]), int(tmpw[k]), 3))
+        tmp.fill(0)
+        tmp[dy[k]-1:edy[k],dx[k]-1:edx[k],:] = img[y[k]-1:ey[k],x[k]-1:ex[k],:]
+        cv2.resize(tmp, (size, size), dst=tempimg[k], interpolation=cv2.INTER_AREA) #@UndefinedVariable
+    tempimg -= 127.5
+    tempimg *= 0.0078125
+    return tempimg
+
+def pnet_canvas_size(n, growth):
+    """Smallest canvas size of at least n in the series 12, 12*growth, 12*growth**2, ... with
+    every size rounded up to an even number of pixels
+    """
+    if growth <= 1.0:
+        raise ValueError('The canvas growth must be larger than one, got %g' % growth)
+    k = max(int(np.floor(np.log(n / 12.0) / np.log(growth))), 0)
+    while True:
+        size = int(np.ceil(12.0 * np.power(growth, k) / 2.0)) * 2
+        if size >= n:
+            return size
+        k += 1
+
+def pnet_output_size(n):
+    """Size of the pnet output map along an input dimension of size n"""
+    return int(np.ceil((n - 2) / 2.0)) - 4
 
 # function [boundingbox] = bbreg(boundingbox,reg)
 def bbreg(boundingbox,reg):
@@ -716,6 +1388,61 @@ def nms(boxes, threshold, method):
     pick = pick[0:counter]
     return pick
 
+def fast_nms(boxes, threshold, method):
+    """Same as nms but only compares each picked box with the boxes that can overlap it.
+    The boxes are sorted on x1 within classes of boxes with similar width. A box can then only
+    overlap the boxes of a class with x1 in [x1-1-maxw, x2+1], maxw being the largest width in
+    the class, which are found with a binary search. Returns the same picks as nms.
+    """
+    if boxes.size==0:
+        return np.empty(0, dtype=np.intp)
+    x1 = boxes[:,0]
+    y1 = boxes[:,1]
+    x2 = boxes[:,2]
+    y2 = boxes[:,3]
+    s = boxes[:,4]
+    area = (x2-x1+1) * (y2-y1+1)
+    _, width_class = np.unique(np.floor(np.log2(np.maximum(x2-x1+1, 1))), return_inverse=True)
+    nrof_classes = np.max(width_class)+1
+    maxw = np.zeros(nrof_classes)
+    np.maximum.at(maxw, width_class, x2-x1)
+    # the boxes sorted on class and x1, and the range of each class that each box can overlap
+    xmin = np.min(x1)
+    span = np.max(x1)-xmin+1
+    order = np.lexsort((x1, width_class))
+    key = (width_class*span + x1-xmin)[order]
+    class_start = np.arange(nrof_classes)*span
+    lo = np.searchsorted(key, class_start + np.clip(np.expand_dims(x1, 1)-xmin-1-maxw, -0.5, span-0.5), side='left')
+    hi = np.searchsorted(key, class_start + np.clip(np.expand_dims(x2, 1)-xmin+1, -0.5, span-0.5), side='right')
+    lengths = hi-lo
+    alive = np.ones(s.shape[0], dtype=np.bool_)
+    I = np.argsort(s)
+    pick = np.zeros(s.shape[0], dtype=np.intp)
+    counter = 0
+    for i in I[::-1]:
+        if not alive[i]:
+            continue
+        pick[counter] = i
+        counter += 1
+        alive[i] = False
+        ends = np.cumsum(lengths[i])
+        idx = order[np.repeat(hi[i]-ends, lengths[i]) + np.arange(ends[-1])]
+        idx = idx[alive[idx]]
+        xx1 = np.maximum(x1[i], x1[idx])
+        yy1 = np.maximum(y1[i], y1[idx])
+        xx2 = np.minimum(x2[i], x2[idx])
+        yy2 = np.minimum(y2[i], y2[idx])
+        w = np.maximum(0.0, xx2-xx1+1)
+        h = np.maximum(0.0, yy2-yy1+1)
+        inter = w * h
+        if method == 'Min':
+            o = inter / np.minimum(area[i], area[idx])
+        else:
+            o = inter / (area[i] + area[idx] - inter)
+        alive[idx[o>threshold]] = False
+    pick = pick[0:counter]
+    return pick
+
 # function [dy edy dx edx y ey x ex tmpw tmph] = pad(total_boxes,w,h)
 def pad(total_boxes, w, h):
     """Compute the padding coordinates (pad the bounding boxes to square)"""
@@ -0,0 +1,54 @@
+"""Writes the MTCNN networks with their weights to a frozen graph (.pb) that create_mtcnn loads faster."""
+# MIT License
+# 
+# Copyright (c) 2016 David Sandberg
+# 
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+# 
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+# 
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import tensorflow as tf
+import argparse
+import sys
+import align.detect_face
+
+def main(args):
+    with tf.Graph().as_default():
+        with tf.Session() as sess:
+            output_graph_def = align.detect_face.freeze_mtcnn(sess, args.model_dir, row_major=args.row_major)
+
+    with tf.gfile.GFile(args.output_file, 'wb') as f:
+        f.write(output_graph_def.SerializeToString())
+    print("%d ops in the final graph: %s" % (len(output_graph_def.node), args.output_file))
+
+def parse_arguments(argv):
+    parser = argparse.ArgumentParser()
+    
+    parser.add_argument('output_file', type=str, 
+        help='Filename for the exported graphdef protobuf (.pb)')
+    parser.add_argument('--model_dir', type=str,
+        help='Directory containing det1.npy, det2.npy and det3.npy. Defaults to the directory of detect_face.py')
+    parser.add_argument('--row_major', 
+        help='Freeze the networks for images in (height, width) layout, see detect_face.create_mtcnn', action='store_true')
+    return parser.parse_args(argv)
+
+if __name__ == '__main__':
+    main(parse_arguments(sys.argv[1:]))
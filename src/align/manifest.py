@@ -0,0 +1,90 @@
+"""Persistent manifest with the alignment status of the images of a dataset."""
+# MIT License
+# 
+# Copyright (c) 2016 David Sandberg
+# 
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+# 
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+# 
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import sqlite3
+import os
+import numpy as np
+
+# Status of an image in the manifest
+ALIGNED = 1
+NO_FACE = 2
+UNREADABLE = 3
+
+class AlignmentManifest(object):
+    """SQLite file with one row per input image, keyed by the image path, that stores the mtime
+    and size of the image when it was aligned, the status (ALIGNED, NO_FACE or UNREADABLE), and
+    the bounding boxes and landmarks of the aligned faces. This makes it possible to resume an
+    alignment run without checking if every output file exists. The rows are committed in
+    batches of commit_interval rows, so after a crash at most that many images are aligned again.
+    """
+  
+    def __init__(self, filename, commit_interval=100):
+        self.connection = sqlite3.connect(filename)
+        self.connection.execute('CREATE TABLE IF NOT EXISTS images (path TEXT PRIMARY KEY, mtime REAL, size INTEGER, ' +
+                                'status INTEGER, boxes BLOB, landmarks BLOB)')
+        self.commit_interval = commit_interval
+        self.nrof_uncommitted = 0
+  
+    def load(self):
+        """Returns a dict from image path to (mtime, size, status) for all images in the manifest"""
+        return {path: (mtime, size, status) for path, mtime, size, status in
+                self.connection.execute('SELECT path, mtime, size, status FROM images')}
+  
+    def record(self, image_path, status, boxes=None, landmarks=None):
+        """Stores the status of an image. boxes is an array with a row [x1, y1, x2, y2] per aligned
+        face and landmarks an array with the ten landmark coordinates (x1..x5, y1..y5) per face.
+        """
+        try:
+            stat = os.stat(image_path)
+            mtime, size = stat.st_mtime, stat.st_size
+        except OSError:
+            mtime, size = 0.0, 0
+        boxes = None if boxes is None else sqlite3.Binary(np.asarray(boxes, dtype=np.int32).tobytes())
+        landmarks = None if landmarks is None else sqlite3.Binary(np.asarray(landmarks, dtype=np.float32).tobytes())
+        self.connection.execute('INSERT OR REPLACE INTO images VALUES (?, ?, ?, ?, ?, ?)',
+                                (image_path, mtime, size, status, boxes, landmarks))
+        self.nrof_uncommitted += 1
+        if self.nrof_uncommitted >= self.commit_interval:
+            self.commit()
+  
+    def get_faces(self, image_path):
+        """Returns the status, bounding boxes and landmarks stored for an image, or None"""
+        row = self.connection.execute('SELECT status, boxes, landmarks FROM images WHERE path=?', (image_path,)).fetchone()
+        if row is None:
+            return None
+        status, boxes, landmarks = row
+        boxes = np.zeros((0,4), np.int32) if boxes is None else np.frombuffer(boxes, dtype=np.int32).reshape((-1,4))
+        landmarks = np.zeros((0,10), np.float32) if landmarks is None else np.frombuffer(landmarks, dtype=np.float32).reshape((-1,10))
+        return status, boxes, landmarks
+  
+    def commit(self):
+        self.connection.commit()
+        self.nrof_uncommitted = 0
+  
+    def close(self):
+        self.commit()
+        self.connection.close()
@@ -34,6 +34,9 @@ import sys
 import os
 import cv2
 import argparse
+import multiprocessing
+import functools
+import errno
 import facenet
 
 
@@ -47,41 +50,150 @@ import facenet
 
 def main(args):
     output_dir = os.path.expanduser(args.output_dir)
+    if args.output_format=='packed' and not args.size:
+        raise ValueError('--output_format packed needs --size, since all images in a shard must have the same shape')
   
     if not os.path.exists(output_dir):
         os.mkdir(output_dir)
+    shard_dir = os.path.join(output_dir, 'shards')
+    if args.output_format=='packed' and not os.path.exists(shard_dir):
+        os.mkdir(shard_dir)
   
     # Store some git revision info in a text file in the output directory
     src_path,_ = os.path.split(os.path.realpath(__file__))
     facenet.store_revision_info(src_path, output_dir, ' '.join(sys.argv))
     
-    i = 0
-    for f in args.tsv_files:
-        for line in f:
-            fields = line.split('\t')
-            class_dir = fields[0]
-            img_name = fields[1] + '-' + fields[4] + '.' + args.output_format
-            img_string = fields[5]
-            img_dec_string = base64.b64decode(img_string)
-            img_data = np.fromstring(img_dec_string, dtype=np.uint8)
-            img = cv2.imdecode(img_data, cv2.IMREAD_COLOR) #pylint: disable=maybe-no-member
-            if args.size:
-                img = misc.imresize(img, (args.size, args.size), interp='bilinear')
+    byte_ranges = get_byte_ranges(args.tsv_files, args.chunk_size*1024*1024)
+    decode = functools.partial(decode_byte_range, args)
+    if args.nrof_workers>0:
+        pool = multiprocessing.Pool(args.nrof_workers)
+        results = pool.imap_unordered(decode, enumerate(byte_ranges))
+    else:
+        results = map(decode, enumerate(byte_ranges))
+    nrof_images_total = 0
+    nrof_failed_total = 0
+    for i, (chunk_index, nrof_images, nrof_failed) in enumerate(results):
+        filename, start, end = byte_ranges[chunk_index]
+        print('%5d/%d: %d images from %s bytes %d-%d' % (i+1, len(byte_ranges), nrof_images, filename, start, end))
+        nrof_images_total += nrof_images
+        nrof_failed_total += nrof_failed
+    if args.nrof_workers>0:
+        pool.close()
+        pool.join()
+  
+    if args.output_format=='packed':
+        # Merge the indices of the chunks in the order of the TSV files
+        with open(os.path.join(output_dir, facenet.PACKED_INDEX_FILENAME), 'w') as index_file:
+            for chunk_index in range(len(byte_ranges)):
+                with open(get_chunk_index_filename(shard_dir, chunk_index), 'r') as f:
+                    for line in f:
+                        index_file.write(line)
+    print('Number of decoded images: %d' % nrof_images_total)
+    print('Number of images that could not be decoded: %d' % nrof_failed_total)
+
+def get_byte_ranges(filenames, chunk_size):
+    """Splits the TSV files into (filename, start, end) byte ranges of at most chunk_size bytes"""
+    byte_ranges = []
+    for filename in filenames:
+        file_size = os.path.getsize(filename)
+        for start in range(0, file_size, chunk_size):
+            byte_ranges.append((filename, start, min(start+chunk_size, file_size)))
+    return byte_ranges
+
+def get_chunk_index_filename(shard_dir, chunk_index):
+    return os.path.join(shard_dir, 'index_%05d.txt' % chunk_index)
+
+def read_records(filename, start, end):
+    """Yields the lines of a file that start in the byte range [start, end)"""
+    with open(filename, 'rb') as f:
+        if start>0:
+            # Skip the line that started in the previous range
+            f.seek(start-1)
+            f.readline()
+        position = f.tell()
+        while position<end:
+            line = f.readline()
+            if not line:
+                break
+            position += len(line)
+            yield line
+
+def decode_record(line, size):
+    """Returns the class directory, the image name and the decoded (BGR) image of a TSV line,
+    or None as the image if it can not be decoded. For lines with less than six columns all
+    three are None.
+    """
+    fields = line.rstrip(b'\r\n').split(b'\t')
+    if len(fields)<6:
+        return None, None, None
+    class_dir = fields[0].decode('utf-8')
+    img_name = (fields[1] + b'-' + fields[4]).decode('utf-8')
+    try:
+        img_dec_string = base64.b64decode(fields[5])
+    except (TypeError, ValueError):
+        return class_dir, img_name, None
+    img_data = np.frombuffer(img_dec_string, dtype=np.uint8)
+    if img_data.size==0:
+        return class_dir, img_name, None
+    img = cv2.imdecode(img_data, cv2.IMREAD_COLOR) #pylint: disable=maybe-no-member
+    if img is not None and size:
+        img = misc.imresize(img, (size, size), interp='bilinear')
+    return class_dir, img_name, img
+
+def decode_byte_range(args, chunk):
+    """Decodes the records of a byte range of a TSV file into image files, or into the packed
+    shards pack_<chunk>_<shard>.npy with the index shards/index_<chunk>.txt. Returns the chunk
+    index, the number of decoded images and the number of records that could not be decoded.
+    """
+    chunk_index, (filename, start, end) = chunk
+    output_dir = os.path.expanduser(args.output_dir)
+    writer = None
+    if args.output_format=='packed':
+        index_filename = get_chunk_index_filename(os.path.join(output_dir, 'shards'), chunk_index)
+        if os.path.exists(index_filename):
+            os.remove(index_filename)
+        writer = facenet.PackedShardWriter(output_dir, 'pack_%05d' % chunk_index, index_filename,
+            (args.size, args.size, 3), args.pack_size)
+    nrof_images = 0
+    nrof_failed = 0
+    for line in read_records(filename, start, end):
+        class_dir, img_name, img = decode_record(line, args.size)
+        if img is None:
+            nrof_failed += 1
+            continue
+        if writer:
+            # The shards hold RGB images, like the images read by facenet
+            img_rgb = cv2.cvtColor(img, cv2.COLOR_BGR2RGB) #pylint: disable=maybe-no-member
+            writer.add(img_rgb, class_dir, img_name, (0, 0, img.shape[1], img.shape[0]))
+        else:
             full_class_dir = os.path.join(output_dir, class_dir)
-            if not os.path.exists(full_class_dir):
+            try:
                 os.mkdir(full_class_dir)
-            full_path = os.path.join(full_class_dir, img_name.replace('/','_'))
+            except OSError as e:
+                if e.errno!=errno.EEXIST:
+                    raise
+            full_path = os.path.join(full_class_dir, img_name.replace('/','_') + '.' + args.output_format)
             cv2.imwrite(full_path, img) #pylint: disable=maybe-no-member
-            print('%8d: %s' % (i, full_path))
-            i += 1
+        nrof_images += 1
+    if writer:
+        writer.close()
+        if not os.path.exists(index_filename):
+            # Chunks without images still get an (empty) index
+            open(index_filename, 'w').close()
+    return chunk_index, nrof_images, nrof_failed
   
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
 
     parser.add_argument('output_dir', type=str, help='Output base directory for the image dataset')
-    parser.add_argument('tsv_files', type=argparse.FileType('r'), nargs='+', help='Input TSV file name(s)')
+    parser.add_argument('tsv_files', type=str, nargs='+', help='Input TSV file name(s)')
     parser.add_argument('--size', type=int, help='Images are resized to the given size')
-    parser.add_argument('--output_format', type=str, help='Format of the output images', default='png', choices=['png', 'jpg'])
+    parser.add_argument('--output_format', type=str, help='Format of the output images. packed stores them in ' +
+        'memory mappable shards with an index (see facenet.PackedShardWriter) and requires --size', 
+        default='png', choices=['png', 'jpg', 'packed'])
+    parser.add_argument('--nrof_workers', type=int, help='Number of decoding processes. 0 decodes in the main process', default=0)
+    parser.add_argument('--chunk_size', type=int, help='Size in MB of the byte ranges of the TSV files that are ' +
+        'decoded by one worker at a time', default=64)
+    parser.add_argument('--pack_size', type=int, help='Number of images per shard in the packed format', default=1000)
 
     main(parser.parse_args())
-
@@ -28,6 +28,7 @@ from __future__ import division
 from __future__ import print_function
 
 import os
+import multiprocessing.pool
 from subprocess import Popen, PIPE
 import tensorflow as tf
 import numpy as np
@@ -84,6 +85,12 @@ def get_image_paths_and_labels(dataset):
         labels_flat += [i] * len(dataset[i].image_paths)
     return image_paths_flat, labels_flat
 
+def get_image_indices_and_labels(dataset):
+    """get_image_paths_and_labels for the classes of DatasetIndex.get_dataset, as arrays"""
+    image_indices_flat = np.concatenate([cls.image_paths for cls in dataset] + [np.zeros((0,), np.int64)])
+    labels_flat = np.repeat(np.arange(len(dataset), dtype=np.int32), [len(cls) for cls in dataset])
+    return image_indices_flat, labels_flat
+
 def shuffle_examples(image_paths, labels):
     shuffle_list = list(zip(image_paths, labels))
     random.shuffle(shuffle_list)
@@ -93,6 +100,14 @@ def shuffle_examples(image_paths, labels):
 def random_rotate_image(image):
     angle = np.random.uniform(low=-10.0, high=10.0)
     return misc.imrotate(image, angle, 'bicubic')
+
+def random_rotate_image_op(image, max_angle=10.0):
+    """In-graph version of random_rotate_image. The image is rotated by a random angle with a
+    projective transform that runs without the GIL, using bilinear instead of bicubic interpolation."""
+    #pylint: disable=no-member
+    image.set_shape((None, None, 3))
+    angle = tf.random_uniform([], -max_angle, max_angle) * math.pi / 180.0
+    return tf.contrib.image.rotate(image, angle, interpolation='BILINEAR')
   
 # 1: Random rotate 2: Random crop  4: Random flip  8:  Fixed image standardization  16: Flip
 RANDOM_ROTATE = 1
@@ -100,32 +115,65 @@ RANDOM_CROP = 2
 RANDOM_FLIP = 4
 FIXED_STANDARDIZATION = 8
 FLIP = 16
-def create_input_pipeline(input_queue, image_size, nrof_preprocess_threads, batch_size_placeholder):
+def decode_image_op(filename, packed=False, image_cache=None):
+    if image_cache is not None:
+        return read_cached_image_op(image_cache, filename)
+    if packed:
+        return read_packed_image_op(filename)
+    file_contents = tf.read_file(filename)
+    return tf.image.decode_image(file_contents, 3)
+
+def get_static_control_flags(control_values):
+    """Returns the flags set in all and in any of the control values a pipeline is fed"""
+    if not control_values:
+        return 0, ~0
+    always_set, ever_set = ~0, 0
+    for control_value in control_values:
+        always_set &= control_value
+        ever_set |= control_value
+    return always_set, ever_set
+
+def preprocess_image(image, control, image_size, control_values=None):
+    """Applies the preprocessing selected by the control flags. If control_values lists
+    all control values the pipeline will be fed, the flags that are set in all or in none
+    of them are applied when the graph is built and only the remaining flags are tested
+    per image. Without control_values every flag is tested per image.
+    """
+    always_set, ever_set = get_static_control_flags(control_values)
+    def apply_flag(image, field, set_fn, unset_fn):
+        if always_set & field:
+            return set_fn(image)
+        if not ever_set & field:
+            return unset_fn(image)
+        return tf.cond(get_control_flag(control, field), lambda:set_fn(image), lambda:unset_fn(image))
+    image = apply_flag(image, RANDOM_ROTATE,
+                       lambda image:random_rotate_image_op(image),
+                       lambda image:image)
+    image = apply_flag(image, RANDOM_CROP,
+                       lambda image:tf.random_crop(image, image_size + (3,)),
+                       lambda image:tf.image.resize_image_with_crop_or_pad(image, image_size[0], image_size[1]))
+    image = apply_flag(image, RANDOM_FLIP,
+                       lambda image:tf.image.random_flip_left_right(image),
+                       lambda image:image)
+    image = apply_flag(image, FIXED_STANDARDIZATION,
+                       lambda image:(tf.cast(image, tf.float32) - 127.5)/128.0,
+                       lambda image:tf.image.per_image_standardization(image))
+    image = apply_flag(image, FLIP,
+                       lambda image:tf.image.flip_left_right(image),
+                       lambda image:image)
+    #pylint: disable=no-member
+    image.set_shape(image_size + (3,))
+    return image
+
+def create_input_pipeline(input_queue, image_size, nrof_preprocess_threads, batch_size_placeholder, packed=False, control_values=None,
+        image_cache=None):
     images_and_labels_list = []
     for _ in range(nrof_preprocess_threads):
         filenames, label, control = input_queue.dequeue()
         images = []
         for filename in tf.unstack(filenames):
-            file_contents = tf.read_file(filename)
-            image = tf.image.decode_image(file_contents, 3)
-            image = tf.cond(get_control_flag(control[0], RANDOM_ROTATE),
-                            lambda:tf.py_func(random_rotate_image, [image], tf.uint8), 
-                            lambda:tf.identity(image))
-            image = tf.cond(get_control_flag(control[0], RANDOM_CROP), 
-                            lambda:tf.random_crop(image, image_size + (3,)), 
-                            lambda:tf.image.resize_image_with_crop_or_pad(image, image_size[0], image_size[1]))
-            image = tf.cond(get_control_flag(control[0], RANDOM_FLIP),
-                            lambda:tf.image.random_flip_left_right(image),
-                            lambda:tf.identity(image))
-            image = tf.cond(get_control_flag(control[0], FIXED_STANDARDIZATION),
-                            lambda:(tf.cast(image, tf.float32) - 127.5)/128.0,
-                            lambda:tf.image.per_image_standardization(image))
-            image = tf.cond(get_control_flag(control[0], FLIP),
-                            lambda:tf.image.flip_left_right(image),
-                            lambda:tf.identity(image))
-            #pylint: disable=no-member
-            image.set_shape(image_size + (3,))
-            images.append(image)
+            image = decode_image_op(filename, packed, image_cache)
+            images.append(preprocess_image(image, control[0], image_size, control_values))
         images_and_labels_list.append([images, label])
 
     image_batch, label_batch = tf.train.batch_join(
@@ -136,6 +184,49 @@ def create_input_pipeline(input_queue, image_size, nrof_preprocess_threads, batc
     
     return image_batch, label_batch
 
+def get_dataset_parallelism(nrof_threads):
+    """Returns nrof_threads, or tf.data's AUTOTUNE when nrof_threads is 0 and the installed
+    TensorFlow has it (older versions fall back to one call per CPU)"""
+    if nrof_threads>0:
+        return nrof_threads
+    for module in (getattr(tf.data, 'experimental', None), tf.contrib.data):
+        if hasattr(module, 'AUTOTUNE'):
+            return module.AUTOTUNE
+    return multiprocessing.cpu_count()
+
+def create_dataset_pipeline(image_paths_placeholder, labels_placeholder, control_placeholder, image_size,
+        nrof_preprocess_threads, batch_size_placeholder, packed=False, nrof_read_threads=0, control_values=None,
+        image_cache=None):
+    """tf.data version of create_input_pipeline. Instead of running an enqueue op, the returned
+    initializer is run once per epoch with the image paths, labels, control flags and batch size
+    fed. The examples come out in the order they were fed, with a smaller final batch.
+    The placeholders can have any shape with the same number of elements; they are flattened.
+    nrof_preprocess_threads=0 autotunes the parallelism of the decoding and preprocessing.
+    nrof_read_threads>0 reads the image files in an interleaved stage of its own before decoding.
+    control_values specializes the preprocessing as in preprocess_image.
+    With an ImageCache the images are read from the cache instead of being decoded.
+    """
+    filenames = tf.reshape(image_paths_placeholder, [-1])
+    labels = tf.reshape(labels_placeholder, [-1])
+    controls = tf.reshape(control_placeholder, [-1])
+    dataset = tf.data.Dataset.from_tensor_slices((filenames, labels, controls))
+    parallelism = get_dataset_parallelism(nrof_preprocess_threads)
+    if nrof_read_threads>0 and not packed and image_cache is None:
+        # One single element dataset per file, interleaved in the original order
+        dataset = dataset.apply(tf.contrib.data.parallel_interleave(
+            lambda filename, label, control: tf.data.Dataset.from_tensors((tf.read_file(filename), label, control)),
+            cycle_length=nrof_read_threads, sloppy=False))
+        decode = lambda file_contents: tf.image.decode_image(file_contents, 3)
+    else:
+        decode = lambda filename: decode_image_op(filename, packed, image_cache)
+    dataset = dataset.map(lambda data, label, control: (preprocess_image(decode(data), control, image_size, control_values), label),
+        num_parallel_calls=parallelism)
+    dataset = dataset.batch(tf.cast(batch_size_placeholder, tf.int64))
+    dataset = dataset.prefetch(2)
+    iterator = dataset.make_initializable_iterator()
+    image_batch, label_batch = iterator.get_next()
+    return image_batch, label_batch, iterator.initializer
+
 def get_control_flag(control, field):
     return tf.equal(tf.mod(tf.floor_div(control, field), 2), 1)
   
@@ -217,6 +308,37 @@ def prewhiten(x):
     y = np.multiply(np.subtract(x, mean), 1/std_adj)
     return y  
 
+def prewhiten_batch(images, out=None):
+    """prewhiten for a batch of images, with the statistics of each image computed by
+    reductions over the whole batch. The result is written into out, a C contiguous float32
+    array that may be images itself, or into a new float32 array.
+    """
+    images = np.asarray(images)
+    if out is None:
+        out = np.empty(images.shape, np.float32)
+    elif out.dtype != np.float32 or out.shape != images.shape or not out.flags.c_contiguous:
+        # reshape would silently return a copy of a non contiguous array and out would not be written
+        raise ValueError('out must be a C contiguous float32 array of shape %s, got a %s%s array of shape %s' %
+                         (images.shape, '' if out.flags.c_contiguous else 'non contiguous ', out.dtype, out.shape))
+    if out is not images:
+        np.copyto(out, images)
+    flat = out.reshape((out.shape[0], -1))
+    size = flat.shape[1]
+    mean = np.mean(flat, axis=1, dtype=np.float64)
+    variance = np.maximum(np.einsum('ij,ij->i', flat, flat, dtype=np.float64) / size - mean**2, 0.0)
+    std_adj = np.maximum(np.sqrt(variance), 1.0/np.sqrt(size))
+    flat -= mean.astype(np.float32)[:,None]
+    flat *= (1/std_adj).astype(np.float32)[:,None]
+    return out
+
+def prewhiten_op(images):
+    """prewhiten_batch in the graph, for a batch of images of any type"""
+    images = tf.cast(images, tf.float32)
+    mean, variance = tf.nn.moments(images, axes=[1,2,3], keep_dims=True)
+    size = tf.cast(tf.reduce_prod(tf.shape(images)[1:]), tf.float32)
+    std_adj = tf.maximum(tf.sqrt(variance), tf.rsqrt(size))
+    return (images - mean) / std_adj
+
 def crop(image, random_crop, image_size):
     if image.shape[1]>image_size:
         sz1 = int(image.shape[1]//2)
@@ -244,7 +366,7 @@ def load_data(image_paths, do_random_crop, do_random_flip, image_size, do_prewhi
     nrof_samples = len(image_paths)
     images = np.zeros((nrof_samples, image_size, image_size, 3))
     for i in range(nrof_samples):
-        img = misc.imread(image_paths[i])
+        img = read_image(image_paths[i])
         if img.ndim == 2:
             img = to_rgb(img)
         if do_prewhiten:
@@ -254,6 +376,47 @@ def load_data(image_paths, do_random_crop, do_random_flip, image_size, do_prewhi
         images[i,:,:,:] = img
     return images
 
+class ImageLoader():
+    """Faster load_data for batches of images. The images are decoded on a thread pool and written
+    into a buffer that is reused by the next call, so the returned batch is only valid until then.
+    Images are cropped (and flipped) before they are prewhitened, so the mean and standard deviation
+    are those of the crop; for images that already have image_size the result is the same as load_data.
+    With dtype=np.uint8 the raw pixels are returned and the normalization is left to the graph.
+    """
+    def __init__(self, image_size, nrof_threads=8, do_random_crop=False, do_random_flip=False, do_prewhiten=True, dtype=np.float32):
+        if dtype==np.uint8 and do_prewhiten:
+            raise ValueError('uint8 images cannot be prewhitened')
+        self.image_size = image_size
+        self.do_random_crop = do_random_crop
+        self.do_random_flip = do_random_flip
+        self.do_prewhiten = do_prewhiten
+        self.buffer = np.zeros((0, image_size, image_size, 3), dtype)
+        self.pool = multiprocessing.pool.ThreadPool(nrof_threads)
+  
+    def load_image(self, index, path):
+        img = read_image(path)
+        if img.ndim == 2:
+            img = to_rgb(img)
+        img = crop(img, self.do_random_crop, self.image_size)
+        img = flip(img, self.do_random_flip)
+        image = self.buffer[index]
+        image[:] = img
+        if self.do_prewhiten:
+            mean = np.mean(image)
+            std_adj = np.maximum(np.std(image), 1.0/np.sqrt(image.size))
+            image -= mean
+            image *= 1/std_adj
+  
+    def load(self, image_paths):
+        nrof_samples = len(image_paths)
+        if nrof_samples>self.buffer.shape[0]:
+            self.buffer = np.zeros((nrof_samples,) + self.buffer.shape[1:], self.buffer.dtype)
+        self.pool.map(lambda i: self.load_image(i, image_paths[i]), range(nrof_samples))
+        return self.buffer[0:nrof_samples]
+  
+    def close(self):
+        self.pool.close()
+
 def get_label_batch(label_data, batch_size, batch_index):
     nrof_examples = np.size(label_data, 0)
     j = batch_index*batch_size % nrof_examples
@@ -317,6 +480,8 @@ class ImageClass():
 def get_dataset(path, has_class_directories=True):
     dataset = []
     path_exp = os.path.expanduser(path)
+    if is_packed_dataset(path_exp):
+        return get_packed_dataset(path_exp)
     classes = [path for path in os.listdir(path_exp) \
                     if os.path.isdir(os.path.join(path_exp, path))]
     classes.sort()
@@ -335,7 +500,314 @@ def get_image_paths(facedir):
         images = os.listdir(facedir)
         image_paths = [os.path.join(facedir,img) for img in images]
     return image_paths
+
+class DatasetIndex():
+    """Index of a dataset with class directories, stored in an .npz file so that the dataset
+    does not have to be listed again. It holds the sorted class names, the label of each image
+    and a packed table with the image paths relative to the dataset directory, in the order of
+    get_dataset. Images are identified by their integer index into the table and the paths are
+    only created by get_paths. The mtimes of the dataset directory and the class directories
+    are stored with the index and is_valid compares them with the current ones.
+    """
+    def __init__(self, path, class_names, labels, path_data, path_offsets, class_mtimes, mtime):
+        self.path = path
+        self.class_names = class_names
+        self.labels = labels
+        self.path_data = path_data
+        self.path_offsets = path_offsets
+        self.class_mtimes = class_mtimes
+        self.mtime = mtime
+  
+    def __len__(self):
+        return len(self.labels)
+  
+    def get_path(self, index):
+        start, end = self.path_offsets[index], self.path_offsets[index+1]
+        return os.path.join(self.path, self.path_data[start:end].tobytes().decode('utf-8'))
+  
+    def get_paths(self, indices):
+        return [self.get_path(index) for index in indices]
   
+    def get_dataset(self):
+        """Returns the classes with arrays of image indices instead of lists of image paths"""
+        class_offsets = np.concatenate([[0], np.cumsum(np.bincount(self.labels, minlength=len(self.class_names)))])
+        return [ImageClass(class_name, np.arange(class_offsets[i], class_offsets[i+1])) 
+            for i, class_name in enumerate(self.class_names)]
+  
+    def is_valid(self, nrof_threads=16):
+        class_dirs = [os.path.join(self.path, class_name) for class_name in self.class_names]
+        pool = multiprocessing.pool.ThreadPool(nrof_threads)
+        try:
+            class_mtimes = pool.map(get_mtime, class_dirs)
+        finally:
+            pool.close()
+        return get_mtime(self.path)==self.mtime and np.array_equal(np.array(class_mtimes, np.float64), self.class_mtimes)
+  
+    def save(self, filename):
+        with open(filename, 'wb') as f:
+            np.savez(f, class_names=np.array(self.class_names), labels=self.labels, path_data=self.path_data,
+                path_offsets=self.path_offsets, class_mtimes=self.class_mtimes, mtime=np.float64(self.mtime))
+
+def get_mtime(path):
+    try:
+        return os.stat(path).st_mtime
+    except OSError:
+        return -1.0
+
+def list_directory(path, directories_only=False):
+    """Returns the names of the entries of a directory, or only of its subdirectories. os.scandir
+    is only available in Python 3.5 and later, and os.listdir is used instead before that.
+    """
+    if hasattr(os, 'scandir'):
+        return [entry.name for entry in os.scandir(path) if not directories_only or entry.is_dir()]
+    names = os.listdir(path)
+    if directories_only:
+        names = [name for name in names if os.path.isdir(os.path.join(path, name))]
+    return names
+
+def list_class_directory(facedir):
+    """Returns the mtime of a class directory and the names of its entries"""
+    mtime = get_mtime(facedir)
+    return mtime, list_directory(facedir)
+
+def build_dataset_index(path, nrof_threads=16):
+    """Lists the class directories of a dataset in parallel and returns its DatasetIndex"""
+    path_exp = os.path.expanduser(path)
+    mtime = get_mtime(path_exp)
+    class_names = sorted(list_directory(path_exp, directories_only=True))
+    pool = multiprocessing.pool.ThreadPool(nrof_threads)
+    try:
+        listings = pool.map(list_class_directory, [os.path.join(path_exp, class_name) for class_name in class_names])
+    finally:
+        pool.close()
+    relative_paths = [os.path.join(class_name, name).encode('utf-8')
+        for class_name, (_, names) in zip(class_names, listings) for name in names]
+    path_lengths = np.array([len(relative_path) for relative_path in relative_paths], np.int64)
+    path_offsets = np.concatenate([[0], np.cumsum(path_lengths)]).astype(np.int64)
+    path_data = np.frombuffer(b''.join(relative_paths), np.uint8)
+    labels = np.repeat(np.arange(len(class_names), dtype=np.int32), [len(names) for _, names in listings])
+    class_mtimes = np.array([class_mtime for class_mtime, _ in listings], np.float64)
+    return DatasetIndex(path_exp, class_names, labels, path_data, path_offsets, class_mtimes, mtime)
+
+def load_dataset_index(path, index_filename, nrof_threads=16):
+    """Returns the DatasetIndex of a dataset from index_filename. The index is built, and
+    index_filename written, if the file does not exist or if the dataset has changed.
+    """
+    path_exp = os.path.expanduser(path)
+    index_filename = os.path.expanduser(index_filename)
+    if os.path.isfile(index_filename):
+        with np.load(index_filename) as data:
+            dataset_index = DatasetIndex(path_exp, list(data['class_names']), data['labels'], data['path_data'],
+                data['path_offsets'], data['class_mtimes'], float(data['mtime']))
+        if dataset_index.is_valid(nrof_threads):
+            return dataset_index
+    print('Building the dataset index %s' % index_filename)
+    dataset_index = build_dataset_index(path_exp, nrof_threads)
+    dataset_index.save(index_filename)
+    return dataset_index
+  
+# Name of the index file of a dataset stored in packed shards by PackedShardWriter
+PACKED_INDEX_FILENAME = 'index.txt'
+
+class PackedShardWriter():
+    """Writes images with the same shape into .npy files (shards) of shard_size images each, named
+    prefix_00000.npy, prefix_00001.npy and so on, that can be memory mapped when they are read.
+    For each image a line 'shard.npy#row<TAB>class name<TAB>source path<TAB>x1 y1 x2 y2' is
+    appended to the index file when its shard is written. The paths 'shard.npy#row' can be used
+    as image paths for load_data and create_input_pipeline(..., packed=True).
+    With temp_suffix the shards are written to 'shard.npy.<temp_suffix>' and only get their
+    final names by rename_shards, e.g. once the writer knows that its output should be kept.
+    """
+    def __init__(self, output_dir, prefix, index_filename, image_shape, shard_size=1000, temp_suffix=None):
+        self.output_dir = output_dir
+        self.prefix = prefix
+        self.index_filename = index_filename
+        self.images = np.zeros((shard_size,) + tuple(image_shape), dtype=np.uint8)
+        self.index_lines = []
+        self.nrof_shards = 0
+        self.temp_suffix = temp_suffix
+        self.temp_filenames = []
+        self.flush_callbacks = []
+  
+    def add(self, image, class_name, source_path, bounding_box):
+        """Adds an image to the current shard and returns its path"""
+        row = len(self.index_lines)
+        self.images[row,:] = image
+        packed_path = '%s_%05d.npy#%d' % (self.prefix, self.nrof_shards, row)
+        self.index_lines.append('%s\t%s\t%s\t%d %d %d %d\n' % ((packed_path, class_name, source_path) + tuple(bounding_box)))
+        if len(self.index_lines)==self.images.shape[0]:
+            self.flush()
+        return os.path.join(self.output_dir, packed_path)
+  
+    def reserve(self, nrof_images):
+        """Writes the current shard if it has no room for nrof_images more images, so that images
+        added together end up in the same shard (unless there are more than shard_size of them)
+        """
+        if len(self.index_lines)+nrof_images>self.images.shape[0]:
+            self.flush()
+  
+    def flush(self):
+        """Writes the current shard, if it has any images, and its lines in the index"""
+        if self.index_lines:
+            shard_filename = os.path.join(self.output_dir, '%s_%05d.npy' % (self.prefix, self.nrof_shards))
+            if self.temp_suffix:
+                self.temp_filenames.append(shard_filename)
+                shard_filename += '.' + self.temp_suffix
+            # Save through a file object since np.save would append .npy to a temporary filename
+            with open(shard_filename, 'wb') as f:
+                np.save(f, self.images[0:len(self.index_lines)])
+            with open(self.index_filename, 'a') as f:
+                f.writelines(self.index_lines)
+            self.index_lines = []
+            self.nrof_shards += 1
+        flush_callbacks, self.flush_callbacks = self.flush_callbacks, []
+        for fun in flush_callbacks:
+            fun()
+  
+    def close(self):
+        self.flush()
+  
+    def call_after_flush(self, fun):
+        """Calls fun (without arguments) once the images added so far are written to their shard
+        and the index, or right away if they already are
+        """
+        if self.index_lines:
+            self.flush_callbacks.append(fun)
+        else:
+            fun()
+  
+    def rename_shards(self):
+        """Gives the shards written with temp_suffix their final names"""
+        for shard_filename in self.temp_filenames:
+            os.rename(shard_filename + '.' + self.temp_suffix, shard_filename)
+        self.temp_filenames = []
+  
+    def remove_shards(self):
+        """Removes the shards written with temp_suffix that have not been renamed"""
+        for shard_filename in self.temp_filenames:
+            try:
+                os.remove(shard_filename + '.' + self.temp_suffix)
+            except OSError:
+                pass
+        self.temp_filenames = []
+
+def is_packed_dataset(path):
+    return os.path.isfile(os.path.join(os.path.expanduser(path), PACKED_INDEX_FILENAME))
+
+def get_packed_dataset(path):
+    """Returns the classes of a dataset stored by PackedShardWriter, with image paths of the
+    form 'shard.npy#row'
+    """
+    path_exp = os.path.expanduser(path)
+    image_paths = {}
+    with open(os.path.join(path_exp, PACKED_INDEX_FILENAME), 'r') as f:
+        for line in f:
+            packed_path, class_name = line.split('\t')[0:2]
+            image_paths.setdefault(class_name, []).append(os.path.join(path_exp, packed_path))
+    return [ImageClass(class_name, image_paths[class_name]) for class_name in sorted(image_paths)]
+
+# Memory mapped shards by filename
+packed_shards = {}
+
+def read_packed_image(packed_path):
+    """Reads the image at a path 'shard.npy#row' from the memory mapped shard"""
+    if isinstance(packed_path, bytes):
+        packed_path = packed_path.decode('utf-8')
+    shard_filename, row = packed_path.rsplit('#', 1)
+    if shard_filename not in packed_shards:
+        packed_shards[shard_filename] = np.load(shard_filename, mmap_mode='r')
+    return np.array(packed_shards[shard_filename][int(row)])
+
+def read_packed_image_op(packed_path):
+    """Reads the image at a path 'shard.npy#row' in the graph"""
+    image = tf.py_func(read_packed_image, [packed_path], tf.uint8, stateful=False)
+    image.set_shape((None, None, 3))
+    return image
+
+def read_image(path):
+    """Reads an image file, or a packed image if the path has the form 'shard.npy#row'"""
+    if '.npy#' in path:
+        return read_packed_image(path)
+    return misc.imread(path)
+
+# Names of the files of an ImageCache in its directory
+CACHE_IMAGES_FILENAME = 'images.npy'
+CACHE_INDEX_FILENAME = 'image_cache_index.txt'
+
+def get_image_mtime(path):
+    """Returns the modification time of an image file, or of the shard of a packed image"""
+    if '.npy#' in path:
+        path = path.rsplit('#', 1)[0]
+    return os.path.getmtime(path)
+
+def read_rgb_image(path):
+    img = read_image(path)
+    if img.ndim == 2:
+        img = to_rgb(img)
+    return img
+
+class ImageCache():
+    """Decoded images of a dataset in a memory mapped uint8 array with one row per image path,
+    in the order of the paths it is opened with (the order of get_image_paths_and_labels).
+    The index file of the cache has a line 'mtime<TAB>path' per row. When the cache is opened
+    the rows whose path or mtime differ from the index are decoded again, and if the number of
+    images has changed the cache is rebuilt. All images in the cache must have the same shape.
+    """
+    def __init__(self, cache_dir, image_paths, nrof_threads=8):
+        self.cache_dir = os.path.expanduser(cache_dir)
+        if not os.path.isdir(self.cache_dir):
+            os.makedirs(self.cache_dir)
+        self.rows = dict((path, row) for row, path in enumerate(image_paths))
+        pool = multiprocessing.pool.ThreadPool(nrof_threads)
+        try:
+            index = ['%r\t%s\n' % (mtime, path) for mtime, path in zip(pool.map(get_image_mtime, image_paths), image_paths)]
+            images_filename = os.path.join(self.cache_dir, CACHE_IMAGES_FILENAME)
+            index_filename = os.path.join(self.cache_dir, CACHE_INDEX_FILENAME)
+            cached_index = []
+            if os.path.isfile(index_filename) and os.path.isfile(images_filename):
+                with open(index_filename, 'r') as f:
+                    cached_index = f.readlines()
+            if len(cached_index)==len(index):
+                self.images = np.load(images_filename, mmap_mode='r+')
+                stale_rows = [row for row in range(len(index)) if index[row]!=cached_index[row]]
+            else:
+                if os.path.isfile(index_filename):
+                    os.remove(index_filename)
+                image_shape = read_rgb_image(image_paths[0]).shape
+                self.images = np.lib.format.open_memmap(images_filename, mode='w+', dtype=np.uint8,
+                    shape=(len(image_paths),)+image_shape)
+                stale_rows = list(range(len(index)))
+            if stale_rows:
+                print('Decoding %d images into the image cache %s' % (len(stale_rows), self.cache_dir))
+                stale_paths = [image_paths[row] for row in stale_rows]
+                for row, img in zip(stale_rows, pool.imap(read_rgb_image, stale_paths, chunksize=64)):
+                    if img.shape!=self.images.shape[1:]:
+                        raise ValueError('Image %s has shape %s but the image cache holds images of shape %s' %
+                            (image_paths[row], img.shape, self.images.shape[1:]))
+                    self.images[row] = img
+                self.images.flush()
+                # The index is written last, so an interrupted update is redone on the next run
+                with open(index_filename, 'w') as f:
+                    f.writelines(index)
+        finally:
+            pool.close()
+        self.images = np.load(images_filename, mmap_mode='r')
+  
+    def read(self, path):
+        """Returns the cached image for a path, or decodes images that are not in the cache"""
+        if isinstance(path, bytes):
+            path = path.decode('utf-8')
+        row = self.rows.get(path)
+        if row is None:
+            return read_rgb_image(path)
+        return np.array(self.images[row])
+
+def read_cached_image_op(image_cache, path):
+    """Reads an image through an ImageCache in the graph"""
+    image = tf.py_func(image_cache.read, [path], tf.uint8, stateful=False)
+    image.set_shape((None, None, 3))
+    return image
+
 def split_dataset(dataset, split_ratio, min_nrof_images_per_class, mode):
     if mode=='SPLIT_CLASSES':
         nrof_classes = len(dataset)
@@ -56,6 +56,8 @@ def main(args):
             
             # Freeze the graph def
             output_graph_def = freeze_graph_def(sess, input_graph_def, 'embeddings,label_batch')
+            if args.prewhiten_input:
+                output_graph_def = add_prewhiten_input(output_graph_def)
 
         # Serialize and dump the output graph to the filesystem
         with tf.gfile.GFile(args.output_file, 'wb') as f:
@@ -90,6 +92,15 @@ def freeze_graph_def(sess, input_graph_def, output_node_names):
         variable_names_whitelist=whitelist_names)
     return output_graph_def
   
+def add_prewhiten_input(graph_def):
+    """Returns graph_def with a uint8 placeholder 'raw_input' for batches of unnormalized images,
+    which are prewhitened in the graph and fed to the 'input' tensor
+    """
+    with tf.Graph().as_default() as graph:
+        images = tf.placeholder(tf.uint8, shape=(None, None, None, 3), name='raw_input')
+        tf.import_graph_def(graph_def, input_map={'input:0': facenet.prewhiten_op(images)}, name='')
+        return graph.as_graph_def()
+  
 def parse_arguments(argv):
     parser = argparse.ArgumentParser()
     
@@ -97,6 +108,8 @@ def parse_arguments(argv):
         help='Directory containing the metagraph (.meta) file and the checkpoint (ckpt) file containing model parameters')
     parser.add_argument('output_file', type=str, 
         help='Filename for the exported graphdef protobuf (.pb)')
+    parser.add_argument('--prewhiten_input', 
+        help='Add a uint8 input tensor raw_input:0 for images that are prewhitened in the exported graph.', action='store_true')
     return parser.parse_args(argv)
 
 if __name__ == '__main__':
@@ -68,7 +68,15 @@ def main(args):
 
     np.random.seed(seed=args.seed)
     random.seed(args.seed)
-    dataset = facenet.get_dataset(args.data_dir)
+    if args.dataset_index:
+        if args.filter_filename:
+            raise ValueError('--filter_filename works on image paths and cannot be used with --dataset_index')
+        # The image lists hold indices into the dataset index instead of paths
+        dataset_index = facenet.load_dataset_index(args.data_dir, args.dataset_index)
+        dataset = dataset_index.get_dataset()
+    else:
+        dataset_index = None
+        dataset = facenet.get_dataset(args.data_dir)
     if args.filter_filename:
         dataset = filter_dataset(dataset, os.path.expanduser(args.filter_filename), 
             args.filter_percentile, args.filter_min_nrof_images_per_class)
@@ -99,10 +107,13 @@ def main(args):
         global_step = tf.Variable(0, trainable=False)
         
         # Get a list of image paths and their labels
-        image_list, label_list = facenet.get_image_paths_and_labels(train_set)
+        if dataset_index is not None:
+            image_list, label_list = facenet.get_image_indices_and_labels(train_set)
+            val_image_list, val_label_list = facenet.get_image_indices_and_labels(val_set)
+        else:
+            image_list, label_list = facenet.get_image_paths_and_labels(train_set)
+            val_image_list, val_label_list = facenet.get_image_paths_and_labels(val_set)
         assert len(image_list)>0, 'The training set should not be empty'
-        
-        val_image_list, val_label_list = facenet.get_image_paths_and_labels(val_set)
 
         # Create a queue that produces indices into the image_list and label_list 
         labels = ops.convert_to_tensor(label_list, dtype=tf.int32)
@@ -119,13 +130,39 @@ def main(args):
         labels_placeholder = tf.placeholder(tf.int32, shape=(None,1), name='labels')
         control_placeholder = tf.placeholder(tf.int32, shape=(None,1), name='control')
         
+        # The control values fed by train, validate and evaluate. The preprocessing is specialized
+        # to them so that only the flags that differ between them are tested per image.
+        control_values = [facenet.RANDOM_ROTATE * args.random_rotate + facenet.RANDOM_CROP * args.random_crop +
+            facenet.RANDOM_FLIP * args.random_flip + facenet.FIXED_STANDARDIZATION * args.use_fixed_image_standardization]
+        eval_control_value = facenet.FIXED_STANDARDIZATION * args.use_fixed_image_standardization
+        if len(val_image_list)>0 or args.lfw_dir:
+            control_values.append(eval_control_value)
+        if args.lfw_dir and args.lfw_use_flipped_images:
+            control_values.append(eval_control_value + facenet.FLIP)
+        if args.dynamic_preprocessing:
+            control_values = None
+
+        # Decoded training images, read from a memory mapped cache instead of the image files
+        image_cache = None
+        if args.image_cache_dir:
+            image_cache = facenet.ImageCache(args.image_cache_dir, 
+                dataset_index.get_paths(image_list) if dataset_index is not None else image_list)
+
         nrof_preprocess_threads = 4
-        input_queue = data_flow_ops.FIFOQueue(capacity=2000000,
-                                    dtypes=[tf.string, tf.int32, tf.int32],
-                                    shapes=[(1,), (1,), (1,)],
-                                    shared_name=None, name=None)
-        enqueue_op = input_queue.enqueue_many([image_paths_placeholder, labels_placeholder, control_placeholder], name='enqueue_op')
-        image_batch, label_batch = facenet.create_input_pipeline(input_queue, image_size, nrof_preprocess_threads, batch_size_placeholder)
+        if args.use_tf_data:
+            # The iterator initializer takes the place of the enqueue op
+            image_batch, label_batch, enqueue_op = facenet.create_dataset_pipeline(image_paths_placeholder, labels_placeholder,
+                control_placeholder, image_size, args.nrof_preprocess_threads, batch_size_placeholder,
+                packed=facenet.is_packed_dataset(args.data_dir), nrof_read_threads=args.nrof_read_threads,
+                control_values=control_values, image_cache=image_cache)
+        else:
+            input_queue = data_flow_ops.FIFOQueue(capacity=2000000,
+                                        dtypes=[tf.string, tf.int32, tf.int32],
+                                        shapes=[(1,), (1,), (1,)],
+                                        shared_name=None, name=None)
+            enqueue_op = input_queue.enqueue_many([image_paths_placeholder, labels_placeholder, control_placeholder], name='enqueue_op')
+            image_batch, label_batch = facenet.create_input_pipeline(input_queue, image_size, nrof_preprocess_threads, batch_size_placeholder,
+                packed=facenet.is_packed_dataset(args.data_dir), control_values=control_values, image_cache=image_cache)
 
         image_batch = tf.identity(image_batch, 'image_batch')
         image_batch = tf.identity(image_batch, 'input')
@@ -231,7 +268,8 @@ def main(args):
                     learning_rate_placeholder, phase_train_placeholder, batch_size_placeholder, control_placeholder, global_step, 
                     total_loss, train_op, summary_op, summary_writer, regularization_losses, args.learning_rate_schedule_file,
                     stat, cross_entropy_mean, accuracy, learning_rate,
-                    prelogits, prelogits_center_loss, args.random_rotate, args.random_crop, args.random_flip, prelogits_norm, args.prelogits_hist_max, args.use_fixed_image_standardization)
+                    prelogits, prelogits_center_loss, args.random_rotate, args.random_crop, args.random_flip, prelogits_norm, args.prelogits_hist_max, args.use_fixed_image_standardization,
+                    dataset_index)
                 stat['time_train'][epoch-1] = time.time() - t
                 
                 if not cont:
@@ -241,7 +279,8 @@ def main(args):
                 if len(val_image_list)>0 and ((epoch-1) % args.validate_every_n_epochs == args.validate_every_n_epochs-1 or epoch==args.max_nrof_epochs):
                     validate(args, sess, epoch, val_image_list, val_label_list, enqueue_op, image_paths_placeholder, labels_placeholder, control_placeholder,
                         phase_train_placeholder, batch_size_placeholder, 
-                        stat, total_loss, regularization_losses, cross_entropy_mean, accuracy, args.validate_every_n_epochs, args.use_fixed_image_standardization)
+                        stat, total_loss, regularization_losses, cross_entropy_mean, accuracy, args.validate_every_n_epochs, args.use_fixed_image_standardization,
+                        dataset_index)
                 stat['time_validate'][epoch-1] = time.time() - t
 
                 # Save variables and the metagraph if it doesn't exist already
@@ -297,7 +336,8 @@ def train(args, sess, epoch, image_list, label_list, index_dequeue_op, enqueue_o
       learning_rate_placeholder, phase_train_placeholder, batch_size_placeholder, control_placeholder, step, 
       loss, train_op, summary_op, summary_writer, reg_losses, learning_rate_schedule_file, 
       stat, cross_entropy_mean, accuracy, 
-      learning_rate, prelogits, prelogits_center_loss, random_rotate, random_crop, random_flip, prelogits_norm, prelogits_hist_max, use_fixed_image_standardization):
+      learning_rate, prelogits, prelogits_center_loss, random_rotate, random_crop, random_flip, prelogits_norm, prelogits_hist_max, use_fixed_image_standardization,
+      dataset_index=None):
     batch_number = 0
     
     if args.learning_rate>0.0:
@@ -311,13 +351,16 @@ def train(args, sess, epoch, image_list, label_list, index_dequeue_op, enqueue_o
     index_epoch = sess.run(index_dequeue_op)
     label_epoch = np.array(label_list)[index_epoch]
     image_epoch = np.array(image_list)[index_epoch]
+    if dataset_index is not None:
+        image_epoch = dataset_index.get_paths(image_epoch)
     
     # Enqueue one epoch of image paths and labels
     labels_array = np.expand_dims(np.array(label_epoch),1)
     image_paths_array = np.expand_dims(np.array(image_epoch),1)
     control_value = facenet.RANDOM_ROTATE * random_rotate + facenet.RANDOM_CROP * random_crop + facenet.RANDOM_FLIP * random_flip + facenet.FIXED_STANDARDIZATION * use_fixed_image_standardization
     control_array = np.ones_like(labels_array) * control_value
-    sess.run(enqueue_op, {image_paths_placeholder: image_paths_array, labels_placeholder: labels_array, control_placeholder: control_array})
+    sess.run(enqueue_op, {image_paths_placeholder: image_paths_array, labels_placeholder: labels_array, control_placeholder: control_array,
+        batch_size_placeholder: args.batch_size})
 
     # Training loop
     train_time = 0
@@ -355,7 +398,8 @@ def train(args, sess, epoch, image_list, label_list, index_dequeue_op, enqueue_o
 
 def validate(args, sess, epoch, image_list, label_list, enqueue_op, image_paths_placeholder, labels_placeholder, control_placeholder,
              phase_train_placeholder, batch_size_placeholder, 
-             stat, loss, regularization_losses, cross_entropy_mean, accuracy, validate_every_n_epochs, use_fixed_image_standardization):
+             stat, loss, regularization_losses, cross_entropy_mean, accuracy, validate_every_n_epochs, use_fixed_image_standardization,
+             dataset_index=None):
   
     print('Running forward pass on validation set')
 
@@ -364,9 +408,13 @@ def validate(args, sess, epoch, image_list, label_list, enqueue_op, image_paths_
     
     # Enqueue one epoch of image paths and labels
     labels_array = np.expand_dims(np.array(label_list[:nrof_images]),1)
-    image_paths_array = np.expand_dims(np.array(image_list[:nrof_images]),1)
+    image_paths = image_list[:nrof_images]
+    if dataset_index is not None:
+        image_paths = dataset_index.get_paths(image_paths)
+    image_paths_array = np.expand_dims(np.array(image_paths),1)
     control_array = np.ones_like(labels_array, np.int32)*facenet.FIXED_STANDARDIZATION * use_fixed_image_standardization
-    sess.run(enqueue_op, {image_paths_placeholder: image_paths_array, labels_placeholder: labels_array, control_placeholder: control_array})
+    sess.run(enqueue_op, {image_paths_placeholder: image_paths_array, labels_placeholder: labels_array, control_placeholder: control_array,
+        batch_size_placeholder: args.lfw_batch_size})
 
     loss_array = np.zeros((nrof_batches,), np.float32)
     xent_array = np.zeros((nrof_batches,), np.float32)
@@ -412,7 +460,8 @@ def evaluate(sess, enqueue_op, image_paths_placeholder, labels_placeholder, phas
     if use_flipped_images:
         # Flip every second image
         control_array += (labels_array % 2)*facenet.FLIP
-    sess.run(enqueue_op, {image_paths_placeholder: image_paths_array, labels_placeholder: labels_array, control_placeholder: control_array})
+    sess.run(enqueue_op, {image_paths_placeholder: image_paths_array, labels_placeholder: labels_array, control_placeholder: control_array,
+        batch_size_placeholder: batch_size})
     
     embedding_size = int(embeddings.get_shape()[1])
     assert nrof_images % batch_size == 0, 'The number of LFW images must be an integer multiple of the LFW batch size'
@@ -541,6 +590,19 @@ def parse_arguments(argv):
         help='Random seed.', default=666)
     parser.add_argument('--nrof_preprocess_threads', type=int,
         help='Number of preprocessing (data loading and augmentation) threads.', default=4)
+    parser.add_argument('--use_tf_data', 
+        help='Feed the network from a tf.data pipeline instead of input queues. It uses nrof_preprocess_threads parallel calls, ' +
+        'or autotunes them if it is 0.', action='store_true')
+    parser.add_argument('--nrof_read_threads', type=int,
+        help='Number of interleaved file reads in the tf.data pipeline. 0 reads the files in the preprocessing calls.', default=0)
+    parser.add_argument('--dataset_index', type=str,
+        help='Index file of the training set. It is built on the first run and when class directories change, ' +
+        'and replaces listing the dataset directory.', default='')
+    parser.add_argument('--image_cache_dir', type=str,
+        help='Directory of a memory mapped cache of the decoded training images. It is built on the first run and ' +
+        'images whose file modification time changed are decoded again.', default='')
+    parser.add_argument('--dynamic_preprocessing', 
+        help='Test every preprocessing control flag per image instead of specializing the graph to the flags in use.', action='store_true')
     parser.add_argument('--log_histograms', 
         help='Enables logging of weight/bias histograms in tensorboard.', action='store_true')
     parser.add_argument('--learning_rate_schedule_file', type=str,
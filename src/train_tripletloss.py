@@ -38,6 +38,7 @@ import itertools
 import argparse
 import facenet
 import lfw
+import triplet_mining
 
 from tensorflow.python.ops import data_flow_ops
 
@@ -63,7 +64,13 @@ def main(args):
     facenet.store_revision_info(src_path, log_dir, ' '.join(sys.argv))
 
     np.random.seed(seed=args.seed)
-    train_set = facenet.get_dataset(args.data_dir)
+    if args.dataset_index:
+        # The classes hold indices into the dataset index instead of paths
+        dataset_index = facenet.load_dataset_index(args.data_dir, args.dataset_index)
+        train_set = dataset_index.get_dataset()
+    else:
+        dataset_index = None
+        train_set = facenet.get_dataset(args.data_dir)
     
     print('Model directory: %s' % model_dir)
     print('Log directory: %s' % log_dir)
@@ -92,38 +99,51 @@ def main(args):
         image_paths_placeholder = tf.placeholder(tf.string, shape=(None,3), name='image_paths')
         labels_placeholder = tf.placeholder(tf.int64, shape=(None,3), name='labels')
         
-        input_queue = data_flow_ops.FIFOQueue(capacity=100000,
-                                    dtypes=[tf.string, tf.int64],
-                                    shapes=[(3,), (3,)],
-                                    shared_name=None, name=None)
-        enqueue_op = input_queue.enqueue_many([image_paths_placeholder, labels_placeholder])
+        if args.use_tf_data:
+            # Same preprocessing as below, selected by the control flags of facenet.preprocess_image
+            control_value = facenet.RANDOM_CROP * args.random_crop + facenet.RANDOM_FLIP * args.random_flip
+            control = tf.fill(tf.shape(labels_placeholder), control_value)
+            image_batch, labels_batch, enqueue_op = facenet.create_dataset_pipeline(image_paths_placeholder, labels_placeholder,
+                control, (args.image_size, args.image_size), 4, batch_size_placeholder, packed=facenet.is_packed_dataset(args.data_dir),
+                control_values=[control_value])
+            input_queue = None
+        else:
+            input_queue = data_flow_ops.FIFOQueue(capacity=100000,
+                                        dtypes=[tf.string, tf.int64],
+                                        shapes=[(3,), (3,)],
+                                        shared_name=None, name=None)
+            enqueue_op = input_queue.enqueue_many([image_paths_placeholder, labels_placeholder])
         
-        nrof_preprocess_threads = 4
-        images_and_labels = []
-        for _ in range(nrof_preprocess_threads):
-            filenames, label = input_queue.dequeue()
-            images = []
-            for filename in tf.unstack(filenames):
-                file_contents = tf.read_file(filename)
-                image = tf.image.decode_image(file_contents, channels=3)
+            nrof_preprocess_threads = 4
+            images_and_labels = []
+            for _ in range(nrof_preprocess_threads):
+                filenames, label = input_queue.dequeue()
+                images = []
+                for filename in tf.unstack(filenames):
+                    if facenet.is_packed_dataset(args.data_dir):
+                        image = facenet.read_packed_image_op(filename)
+                    else:
+                        file_contents = tf.read_file(filename)
+                        image = tf.image.decode_image(file_contents, channels=3)
                 
-                if args.random_crop:
-                    image = tf.random_crop(image, [args.image_size, args.image_size, 3])
-                else:
-                    image = tf.image.resize_image_with_crop_or_pad(image, args.image_size, args.image_size)
-                if args.random_flip:
-                    image = tf.image.random_flip_left_right(image)
+                    if args.random_crop:
+                        image = tf.random_crop(image, [args.image_size, args.image_size, 3])
+                    else:
+                        image = tf.image.resize_image_with_crop_or_pad(image, args.image_size, args.image_size)
+                    if args.random_flip:
+                        image = tf.image.random_flip_left_right(image)
     
-                #pylint: disable=no-member
-                image.set_shape((args.image_size, args.image_size, 3))
-                images.append(tf.image.per_image_standardization(image))
-            images_and_labels.append([images, label])
+                    #pylint: disable=no-member
+                    image.set_shape((args.image_size, args.image_size, 3))
+                    images.append(tf.image.per_image_standardization(image))
+                images_and_labels.append([images, label])
     
-        image_batch, labels_batch = tf.train.batch_join(
-            images_and_labels, batch_size=batch_size_placeholder, 
-            shapes=[(args.image_size, args.image_size, 3), ()], enqueue_many=True,
-            capacity=4 * nrof_preprocess_threads * args.batch_size,
-            allow_smaller_final_batch=True)
+            image_batch, labels_batch = tf.train.batch_join(
+                images_and_labels, batch_size=batch_size_placeholder, 
+                shapes=[(args.image_size, args.image_size, 3), ()], enqueue_many=True,
+                capacity=4 * nrof_preprocess_threads * args.batch_size,
+                allow_smaller_final_batch=True)
+
         image_batch = tf.identity(image_batch, 'image_batch')
         image_batch = tf.identity(image_batch, 'input')
         labels_batch = tf.identity(labels_batch, 'label_batch')
@@ -183,7 +203,7 @@ def main(args):
                 train(args, sess, train_set, epoch, image_paths_placeholder, labels_placeholder, labels_batch,
                     batch_size_placeholder, learning_rate_placeholder, phase_train_placeholder, enqueue_op, input_queue, global_step, 
                     embeddings, total_loss, train_op, summary_op, summary_writer, args.learning_rate_schedule_file,
-                    args.embedding_size, anchor, positive, negative, triplet_loss)
+                    args.embedding_size, anchor, positive, negative, triplet_loss, dataset_index)
 
                 # Save variables and the metagraph if it doesn't exist already
                 save_variables_and_metagraph(sess, saver, summary_writer, model_dir, subdir, step)
@@ -200,7 +220,7 @@ def main(args):
 def train(args, sess, dataset, epoch, image_paths_placeholder, labels_placeholder, labels_batch,
           batch_size_placeholder, learning_rate_placeholder, phase_train_placeholder, enqueue_op, input_queue, global_step, 
           embeddings, loss, train_op, summary_op, summary_writer, learning_rate_schedule_file,
-          embedding_size, anchor, positive, negative, triplet_loss):
+          embedding_size, anchor, positive, negative, triplet_loss, dataset_index=None):
     batch_number = 0
     
     if args.learning_rate>0.0:
@@ -210,13 +230,16 @@ def train(args, sess, dataset, epoch, image_paths_placeholder, labels_placeholde
     while batch_number < args.epoch_size:
         # Sample people randomly from the dataset
         image_paths, num_per_class = sample_people(dataset, args.people_per_batch, args.images_per_person)
+        if dataset_index is not None:
+            image_paths = dataset_index.get_paths(image_paths)
         
         print('Running forward pass on sampled images: ', end='')
         start_time = time.time()
         nrof_examples = args.people_per_batch * args.images_per_person
         labels_array = np.reshape(np.arange(nrof_examples),(-1,3))
         image_paths_array = np.reshape(np.expand_dims(np.array(image_paths),1), (-1,3))
-        sess.run(enqueue_op, {image_paths_placeholder: image_paths_array, labels_placeholder: labels_array})
+        sess.run(enqueue_op, {image_paths_placeholder: image_paths_array, labels_placeholder: labels_array,
+            batch_size_placeholder: args.batch_size})
         emb_array = np.zeros((nrof_examples, embedding_size))
         nrof_batches = int(np.ceil(nrof_examples / args.batch_size))
         for i in range(nrof_batches):
@@ -228,18 +251,24 @@ def train(args, sess, dataset, epoch, image_paths_placeholder, labels_placeholde
 
         # Select triplets based on the embeddings
         print('Selecting suitable triplets for training')
-        triplets, nrof_random_negs, nrof_triplets = select_triplets(emb_array, num_per_class, 
-            image_paths, args.people_per_batch, args.alpha)
+        # Without --max_nrof_triplets there are at most as many triplets as anchor-positive pairs, which
+        # is what RANDOM_VIOLATING and SEMI_HARD select and what BATCH_ALL is sampled down to
+        max_nrof_triplets = args.max_nrof_triplets or sum(n*(n-1)//2 for n in num_per_class)
+        triplet_indices, nrof_pairs = triplet_mining.select_triplets(emb_array, num_per_class, args.alpha,
+            args.triplet_strategy, max_nrof_triplets)
+        triplets = [(image_paths[a], image_paths[p], image_paths[n]) for a, p, n in triplet_indices]
+        nrof_triplets = len(triplets)
         selection_time = time.time() - start_time
-        print('(nrof_random_negs, nrof_triplets) = (%d, %d): time=%.3f seconds' % 
-            (nrof_random_negs, nrof_triplets, selection_time))
+        print('(nrof_pairs, nrof_triplets, max_nrof_triplets) = (%d, %d, %d): time=%.3f seconds' % 
+            (nrof_pairs, nrof_triplets, max_nrof_triplets, selection_time))
 
         # Perform training on the selected triplets
         nrof_batches = int(np.ceil(nrof_triplets*3/args.batch_size))
         triplet_paths = list(itertools.chain(*triplets))
         labels_array = np.reshape(np.arange(len(triplet_paths)),(-1,3))
         triplet_paths_array = np.reshape(np.expand_dims(np.array(triplet_paths),1), (-1,3))
-        sess.run(enqueue_op, {image_paths_placeholder: triplet_paths_array, labels_placeholder: labels_array})
+        sess.run(enqueue_op, {image_paths_placeholder: triplet_paths_array, labels_placeholder: labels_array,
+            batch_size_placeholder: args.batch_size})
         nrof_examples = len(triplet_paths)
         train_time = 0
         i = 0
@@ -270,6 +299,7 @@ def train(args, sess, dataset, epoch, image_paths_placeholder, labels_placeholde
   
 def select_triplets(embeddings, nrof_images_per_class, image_paths, people_per_batch, alpha):
     """ Select the triplets for training
+    Reference implementation of triplet_mining.select_triplets with the RANDOM_VIOLATING strategy
     """
     trip_idx = 0
     emb_start_idx = 0
@@ -291,7 +321,7 @@ def select_triplets(embeddings, nrof_images_per_class, image_paths, people_per_b
             for pair in xrange(j, nrof_images): # For every possible positive pair.
                 p_idx = emb_start_idx + pair
                 pos_dist_sqr = np.sum(np.square(embeddings[a_idx]-embeddings[p_idx]))
-                neg_dists_sqr[emb_start_idx:emb_start_idx+nrof_images] = np.NaN
+                neg_dists_sqr[emb_start_idx:emb_start_idx+nrof_images] = np.nan
                 #all_neg = np.where(np.logical_and(neg_dists_sqr-pos_dist_sqr<alpha, pos_dist_sqr<neg_dists_sqr))[0]  # FaceNet selection
                 all_neg = np.where(neg_dists_sqr-pos_dist_sqr<alpha)[0] # VGG Face selecction
                 nrof_random_negs = all_neg.shape[0]
@@ -349,7 +379,8 @@ def evaluate(sess, image_paths, embeddings, labels_batch, image_paths_placeholde
     assert(len(image_paths)==nrof_images)
     labels_array = np.reshape(np.arange(nrof_images),(-1,3))
     image_paths_array = np.reshape(np.expand_dims(np.array(image_paths),1), (-1,3))
-    sess.run(enqueue_op, {image_paths_placeholder: image_paths_array, labels_placeholder: labels_array})
+    sess.run(enqueue_op, {image_paths_placeholder: image_paths_array, labels_placeholder: labels_array,
+        batch_size_placeholder: batch_size})
     emb_array = np.zeros((nrof_images, embedding_size))
     nrof_batches = int(np.ceil(nrof_images / batch_size))
     label_check_array = np.zeros((nrof_images,))
@@ -443,6 +474,11 @@ def parse_arguments(argv):
         help='Number of images per person.', default=40)
     parser.add_argument('--epoch_size', type=int,
         help='Number of batches per epoch.', default=1000)
+    parser.add_argument('--triplet_strategy', type=str, choices=triplet_mining.STRATEGIES,
+        help='The triplet selection strategy to use (see triplet_mining.py)', default=triplet_mining.RANDOM_VIOLATING)
+    parser.add_argument('--max_nrof_triplets', type=int,
+        help='Maximum number of triplets selected from a batch, sampled uniformly if more are found. ' +
+        'The default (0) is the number of anchor-positive pairs in the batch.', default=0)
     parser.add_argument('--alpha', type=float,
         help='Positive to negative triplet distance margin.', default=0.2)
     parser.add_argument('--embedding_size', type=int,
@@ -479,6 +515,11 @@ def parse_arguments(argv):
         help='Path to the data directory containing aligned face patches.', default='')
     parser.add_argument('--lfw_nrof_folds', type=int,
         help='Number of folds to use for cross validation. Mainly used for testing.', default=10)
+    parser.add_argument('--dataset_index', type=str,
+        help='Index file of the training set. It is built on the first run and when class directories change, ' +
+        'and replaces listing the dataset directory.', default='')
+    parser.add_argument('--use_tf_data', 
+        help='Feed the network from a tf.data pipeline instead of input queues.', action='store_true')
     return parser.parse_args(argv)
   
 
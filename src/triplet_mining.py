@@ -0,0 +1,133 @@
+"""Vectorized selection of triplets for training with the triplet loss
+"""
+# MIT License
+# 
+# Copyright (c) 2016 David Sandberg
+# 
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+# 
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+# 
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import numpy as np
+
+# VGG Face: a random negative among the ones that violate the margin (train_tripletloss.select_triplets)
+RANDOM_VIOLATING = 'RANDOM_VIOLATING'
+# FaceNet: a random negative that is further away than the positive but within the margin
+SEMI_HARD = 'SEMI_HARD'
+# In Defense of the Triplet Loss: the hardest positive and the hardest negative for each anchor
+BATCH_HARD = 'BATCH_HARD'
+# All triplets that violate the margin
+BATCH_ALL = 'BATCH_ALL'
+STRATEGIES = (RANDOM_VIOLATING, SEMI_HARD, BATCH_HARD, BATCH_ALL)
+
+def select_triplets(embeddings, nrof_images_per_class, alpha, strategy=RANDOM_VIOLATING, max_nrof_triplets=None):
+    """Selects triplets from a batch of embeddings sampled by class, like train_tripletloss.select_triplets.
+    The distances between all embeddings are computed once and the negatives of each anchor are sorted
+    by distance, so that the negatives that violate the margin for an anchor-positive pair (a, p), a<p,
+    are a prefix of that order and the semi-hard ones a range in it. With every strategy, max_nrof_triplets
+    limits the number of triplets to a uniformly sampled subset.
+    Returns the shuffled triplets as an array of (anchor, positive, negative) indices into the embeddings
+    and the number of anchor-positive pairs.
+    """
+    if strategy not in STRATEGIES:
+        raise ValueError('Invalid triplet selection strategy %s' % strategy)
+    dists = pairwise_squared_distances(embeddings)
+    labels = np.repeat(np.arange(len(nrof_images_per_class)), np.asarray(nrof_images_per_class, np.int64))
+    anchors, positives = np.nonzero(np.triu(labels[:,None]==labels[None,:], 1))
+    if strategy==BATCH_HARD:
+        triplets = select_batch_hard(dists, labels)
+    else:
+        negatives, neg_dists = sort_negatives(dists, labels)
+        pos_dists = dists[anchors, positives]
+        # Negatives n with d(a,n)-d(a,p)<alpha, and d(a,n)>d(a,p) for SEMI_HARD
+        end = search_rows(neg_dists, anchors, pos_dists + alpha, 'left')
+        start = search_rows(neg_dists, anchors, pos_dists, 'right') if strategy==SEMI_HARD else np.zeros_like(end)
+        if strategy==BATCH_ALL:
+            triplets = select_all_negatives(negatives, anchors, positives, end, max_nrof_triplets)
+        else:
+            triplets = select_random_negatives(negatives, anchors, positives, start, end)
+    if max_nrof_triplets is not None and len(triplets)>max_nrof_triplets:
+        triplets = triplets[sample_without_replacement(len(triplets), max_nrof_triplets)]
+    np.random.shuffle(triplets)
+    return triplets, len(anchors)
+
+def pairwise_squared_distances(embeddings):
+    """Returns the squared euclidean distances between all embeddings, computed with one matrix product"""
+    embeddings = np.asarray(embeddings, np.float64)
+    square_norms = np.sum(np.square(embeddings), 1)
+    dists = square_norms[:,None] - 2*np.dot(embeddings, embeddings.T) + square_norms[None,:]
+    np.maximum(dists, 0.0, out=dists)
+    np.fill_diagonal(dists, 0.0)
+    return dists
+
+def sort_negatives(dists, labels):
+    """Returns, for each image, the images sorted by distance and the sorted distances, with the
+    images of the same class last at an infinite distance
+    """
+    neg_dists = np.where(labels[:,None]==labels[None,:], np.inf, dists)
+    negatives = np.argsort(neg_dists, 1)
+    return negatives, neg_dists[np.arange(len(labels))[:,None], negatives]
+
+def search_rows(sorted_rows, rows, values, side):
+    """np.searchsorted of each value in its row of sorted_rows, where equal rows are adjacent"""
+    indices = np.zeros(len(rows), np.int64)
+    starts = np.concatenate([[0], np.nonzero(np.diff(rows))[0] + 1, [len(rows)]])
+    for start, end in zip(starts[:-1], starts[1:]):
+        indices[start:end] = np.searchsorted(sorted_rows[rows[start]], values[start:end], side)
+    return indices
+
+def select_random_negatives(negatives, anchors, positives, start, end):
+    """Picks a uniformly sampled negative in the range [start, end) of the sorted negatives of each pair"""
+    has_negative = end>start
+    anchors, positives, start, end = anchors[has_negative], positives[has_negative], start[has_negative], end[has_negative]
+    ranks = start + (np.random.random_sample(len(anchors))*(end-start)).astype(np.int64)
+    return np.stack([anchors, positives, negatives[anchors, np.minimum(ranks, end-1)]], 1)
+
+def select_batch_hard(dists, labels):
+    same_class = labels[:,None]==labels[None,:]
+    pos_dists = np.where(same_class, dists, -np.inf)
+    np.fill_diagonal(pos_dists, -np.inf)
+    neg_dists = np.where(same_class, np.inf, dists)
+    anchors = np.nonzero(np.logical_and(np.any(np.isfinite(pos_dists), 1), np.any(np.isfinite(neg_dists), 1)))[0]
+    return np.stack([anchors, np.argmax(pos_dists[anchors], 1), np.argmin(neg_dists[anchors], 1)], 1)
+
+def select_all_negatives(negatives, anchors, positives, end, max_nrof_triplets):
+    """Returns the triplets with the first end negatives of each pair, or a uniform sample of
+    max_nrof_triplets of them
+    """
+    pair_ends = np.cumsum(end)
+    nrof_triplets = int(pair_ends[-1]) if len(pair_ends)>0 else 0
+    if max_nrof_triplets is not None and nrof_triplets>max_nrof_triplets:
+        positions = sample_without_replacement(nrof_triplets, max_nrof_triplets)
+    else:
+        positions = np.arange(nrof_triplets)
+    pairs = np.searchsorted(pair_ends, positions, 'right')
+    ranks = positions - (pair_ends - end)[pairs]
+    return np.stack([anchors[pairs], positives[pairs], negatives[anchors[pairs], ranks]], 1)
+
+def sample_without_replacement(n, k):
+    """Returns k distinct integers sampled uniformly from range(n), without a permutation of range(n) if k is small"""
+    if 2*k>=n:
+        return np.random.permutation(n)[:k]
+    samples = np.unique(np.random.randint(n, size=k))
+    while len(samples)<k:
+        samples = np.unique(np.concatenate([samples, np.random.randint(n, size=k-len(samples))]))
+    return samples
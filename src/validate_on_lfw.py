@@ -61,12 +61,20 @@ def main(args):
  
             nrof_preprocess_threads = 4
             image_size = (args.image_size, args.image_size)
-            eval_input_queue = data_flow_ops.FIFOQueue(capacity=2000000,
-                                        dtypes=[tf.string, tf.int32, tf.int32],
-                                        shapes=[(1,), (1,), (1,)],
-                                        shared_name=None, name=None)
-            eval_enqueue_op = eval_input_queue.enqueue_many([image_paths_placeholder, labels_placeholder, control_placeholder], name='eval_enqueue_op')
-            image_batch, label_batch = facenet.create_input_pipeline(eval_input_queue, image_size, nrof_preprocess_threads, batch_size_placeholder)
+            # Only the flip of every second image is decided per image
+            control_value = facenet.FIXED_STANDARDIZATION * args.use_fixed_image_standardization
+            control_values = [control_value, control_value + facenet.FLIP] if args.use_flipped_images else [control_value]
+            if args.use_tf_data:
+                image_batch, label_batch, eval_enqueue_op = facenet.create_dataset_pipeline(image_paths_placeholder, labels_placeholder,
+                    control_placeholder, image_size, nrof_preprocess_threads, batch_size_placeholder, control_values=control_values)
+            else:
+                eval_input_queue = data_flow_ops.FIFOQueue(capacity=2000000,
+                                            dtypes=[tf.string, tf.int32, tf.int32],
+                                            shapes=[(1,), (1,), (1,)],
+                                            shared_name=None, name=None)
+                eval_enqueue_op = eval_input_queue.enqueue_many([image_paths_placeholder, labels_placeholder, control_placeholder], name='eval_enqueue_op')
+                image_batch, label_batch = facenet.create_input_pipeline(eval_input_queue, image_size, nrof_preprocess_threads, batch_size_placeholder,
+                    control_values=control_values)
      
             # Load the model
             input_map = {'image_batch': image_batch, 'label_batch': label_batch, 'phase_train': phase_train_placeholder}
@@ -100,7 +108,8 @@ def evaluate(sess, enqueue_op, image_paths_placeholder, labels_placeholder, phas
     if use_flipped_images:
         # Flip every second image
         control_array += (labels_array % 2)*facenet.FLIP
-    sess.run(enqueue_op, {image_paths_placeholder: image_paths_array, labels_placeholder: labels_array, control_placeholder: control_array})
+    sess.run(enqueue_op, {image_paths_placeholder: image_paths_array, labels_placeholder: labels_array, control_placeholder: control_array,
+        batch_size_placeholder: batch_size})
     
     embedding_size = int(embeddings.get_shape()[1])
     assert nrof_images % batch_size == 0, 'The number of LFW images must be an integer multiple of the LFW batch size'
@@ -158,6 +167,8 @@ def parse_arguments(argv):
         help='Subtract feature mean before calculating distance.', action='store_true')
     parser.add_argument('--use_fixed_image_standardization', 
         help='Performs fixed standardization of images.', action='store_true')
+    parser.add_argument('--use_tf_data', 
+        help='Feed the network from a tf.data pipeline instead of input queues.', action='store_true')
     return parser.parse_args(argv)
 
 if __name__ == '__main__':
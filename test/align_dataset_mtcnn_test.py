@@ -0,0 +1,171 @@
+# MIT License
+# 
+# Copyright (c) 2016 David Sandberg
+# 
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+# 
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+# 
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+import unittest
+import tempfile
+import os
+import shutil
+import time
+import numpy as np
+import facenet
+import align.align_dataset_mtcnn as align_dataset_mtcnn
+
+class AlignDatasetMtcnnTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        # Recursively remove the temporary directory
+        shutil.rmtree(self.tmp_dir)
+
+    def testGetShards(self):
+        dataset = [facenet.ImageClass('a', ['a/%d.png' % i for i in (3, 1, 2)]),
+                   facenet.ImageClass('b', ['b/%d.png' % i for i in range(7)]),
+                   facenet.ImageClass('c', [])]
+        expected = [(cls.name, image_path) for cls in dataset for image_path in sorted(cls.image_paths)]
+        for nrof_shards in (1, 3, 4, 10, 12):
+            shards = align_dataset_mtcnn.get_shards(dataset, nrof_shards)
+            self.assertEqual(len(shards), nrof_shards)
+            self.assertEqual([image for shard in shards for image in shard], expected)
+            shard_sizes = [len(shard) for shard in shards]
+            self.assertLessEqual(max(shard_sizes)-min(shard_sizes), 1)
+        # The shards do not depend on the order of the image paths
+        reversed_dataset = [facenet.ImageClass(cls.name, cls.image_paths[::-1]) for cls in dataset]
+        self.assertEqual(align_dataset_mtcnn.get_shards(reversed_dataset, 4), align_dataset_mtcnn.get_shards(dataset, 4))
+
+    def testLeaseShard(self):
+        lease_filename = os.path.join(self.tmp_dir, 'bounding_boxes_00000.txt.lease')
+        self.assertTrue(align_dataset_mtcnn.lease_shard(lease_filename, 'host.1', 60.0))
+        self.assertFalse(align_dataset_mtcnn.lease_shard(lease_filename, 'host.2', 60.0))
+        lease = align_dataset_mtcnn.ShardLease(lease_filename, 'host.1', 60.0)
+        other_lease = align_dataset_mtcnn.ShardLease(lease_filename, 'host.2', 60.0)
+        self.assertTrue(lease.is_held())
+        self.assertFalse(other_lease.is_held())
+        lease.renew(force=True)
+        with self.assertRaises(align_dataset_mtcnn.LeaseLostError):
+            other_lease.renew(force=True)
+        # Only the worker that holds the lease can release it
+        other_lease.release()
+        self.assertTrue(os.path.exists(lease_filename))
+        lease.release()
+        self.assertFalse(os.path.exists(lease_filename))
+        with self.assertRaises(align_dataset_mtcnn.LeaseLostError):
+            lease.renew(force=True)
+        self.assertTrue(align_dataset_mtcnn.lease_shard(lease_filename, 'host.2', 60.0))
+
+    def testStaleLeaseTakeover(self):
+        lease_filename = os.path.join(self.tmp_dir, 'bounding_boxes_00000.txt.lease')
+        self.assertTrue(align_dataset_mtcnn.lease_shard(lease_filename, 'host.1', 60.0))
+        lease = align_dataset_mtcnn.ShardLease(lease_filename, 'host.1', 60.0)
+        # A lease that has not been renewed for the timeout is taken over
+        stale_time = time.time()-120.0
+        os.utime(lease_filename, (stale_time, stale_time))
+        self.assertTrue(align_dataset_mtcnn.lease_shard(lease_filename, 'host.2', 60.0))
+        self.assertEqual(os.listdir(self.tmp_dir), [os.path.basename(lease_filename)])
+        self.assertFalse(align_dataset_mtcnn.lease_shard(lease_filename, 'host.3', 60.0))
+        # The worker that lost the lease notices it when it renews and does not remove the new lease
+        self.assertFalse(lease.is_held())
+        with self.assertRaises(align_dataset_mtcnn.LeaseLostError):
+            lease.renew(force=True)
+        lease.release()
+        self.assertTrue(align_dataset_mtcnn.ShardLease(lease_filename, 'host.2', 60.0).is_held())
+
+    def testStaleLeaseRace(self):
+        lease_filename = os.path.join(self.tmp_dir, 'bounding_boxes_00000.txt.lease')
+        self.assertTrue(align_dataset_mtcnn.lease_shard(lease_filename, 'host.1', 60.0))
+        stale_time = time.time()-120.0
+        os.utime(lease_filename, (stale_time, stale_time))
+        getmtime = os.path.getmtime
+        def break_lease_after_getmtime(filename):
+            # Another worker breaks the stale lease and leases the shard again right after the check
+            os.path.getmtime = getmtime
+            mtime = getmtime(filename)
+            os.remove(lease_filename)
+            self.assertTrue(align_dataset_mtcnn.lease_shard(lease_filename, 'host.3', 60.0))
+            return mtime
+        os.path.getmtime = break_lease_after_getmtime
+        try:
+            self.assertFalse(align_dataset_mtcnn.lease_shard(lease_filename, 'host.2', 60.0))
+        finally:
+            os.path.getmtime = getmtime
+        # The new lease that was renamed by mistake is put back
+        self.assertEqual(os.listdir(self.tmp_dir), [os.path.basename(lease_filename)])
+        self.assertTrue(align_dataset_mtcnn.ShardLease(lease_filename, 'host.3', 60.0).is_held())
+
+    def testMoveFaces(self):
+        face_dir = os.path.join(self.tmp_dir, 'shards', 'faces_00000.host.1')
+        for class_name in ('a', 'b'):
+            os.makedirs(os.path.join(face_dir, class_name))
+        os.makedirs(os.path.join(self.tmp_dir, 'a'))
+        for path in ('a/1.png', 'b/1_0.png', 'b/1_1.png'):
+            open(os.path.join(face_dir, path), 'w').close()
+        text_filename = os.path.join(self.tmp_dir, 'shards', 'bounding_boxes_00000.txt.host.1')
+        with open(text_filename, 'w') as f:
+            f.write(''.join('%s 1 2 3 4\n' % os.path.join(face_dir, path) for path in ('a/1.png', 'b/1_0.png', 'b/1_1.png')))
+            f.write('%s\n' % os.path.join(face_dir, 'b', '2.png'))
+        align_dataset_mtcnn.move_faces(face_dir, self.tmp_dir, text_filename)
+        self.assertFalse(os.path.exists(face_dir))
+        self.assertEqual(sorted(os.listdir(os.path.join(self.tmp_dir, 'a'))), ['1.png'])
+        self.assertEqual(sorted(os.listdir(os.path.join(self.tmp_dir, 'b'))), ['1_0.png', '1_1.png'])
+        with open(text_filename, 'r') as f:
+            self.assertEqual(f.read(), ''.join('%s 1 2 3 4\n' % os.path.join(self.tmp_dir, path) 
+                for path in ('a/1.png', 'b/1_0.png', 'b/1_1.png')) + '%s\n' % os.path.join(self.tmp_dir, 'b', '2.png'))
+
+    def testPackedShardsRenamedUnderLease(self):
+        index_filename = os.path.join(self.tmp_dir, 'index.txt.host.1')
+        writer = facenet.PackedShardWriter(self.tmp_dir, 'pack_00003', index_filename, (4, 4, 3), shard_size=2,
+            temp_suffix='host.1')
+        images = np.random.randint(0, 256, size=(3, 4, 4, 3)).astype(np.uint8)
+        packed_paths = [writer.add(image, 'a', 'a/%d.png' % i, (0, 0, 4, 4)) for i, image in enumerate(images)]
+        writer.close()
+        self.assertEqual(sorted(os.listdir(self.tmp_dir)),
+            ['index.txt.host.1', 'pack_00003_00000.npy.host.1', 'pack_00003_00001.npy.host.1'])
+        writer.rename_shards()
+        for packed_path, image in zip(packed_paths, images):
+            np.testing.assert_array_equal(facenet.read_packed_image(packed_path), image)
+        writer = facenet.PackedShardWriter(self.tmp_dir, 'pack_00004', index_filename, (4, 4, 3), shard_size=2,
+            temp_suffix='host.1')
+        writer.add(images[0], 'a', 'a/0.png', (0, 0, 4, 4))
+        writer.close()
+        writer.remove_shards()
+        self.assertFalse([filename for filename in os.listdir(self.tmp_dir) if filename.startswith('pack_00004')])
+
+    def testMergeFiles(self):
+        filenames = [os.path.join(self.tmp_dir, 'bounding_boxes_%05d.txt' % i) for i in range(3)]
+        contents = ['a/1.png 1 2 3 4\na/2.png\n', '', 'b/1.png 5 6 7 8\nb/1_1.png 9 10 11 12\n']
+        for filename, content in zip(filenames, contents):
+            with open(filename, 'w') as f:
+                f.write(content)
+        output_filename = os.path.join(self.tmp_dir, 'bounding_boxes.txt')
+        self.assertEqual(align_dataset_mtcnn.merge_files(filenames, output_filename), 3)
+        with open(output_filename, 'r') as f:
+            self.assertEqual(f.read(), ''.join(contents))
+        # The merged file replaces an existing one and no temporary file is left behind
+        self.assertEqual(align_dataset_mtcnn.merge_files(filenames[0:1], output_filename), 1)
+        with open(output_filename, 'r') as f:
+            self.assertEqual(f.read(), contents[0])
+        self.assertEqual(sorted(os.listdir(self.tmp_dir)), sorted([os.path.basename(filename) 
+            for filename in filenames + [output_filename]]))
+
+if __name__ == "__main__":
+    unittest.main()
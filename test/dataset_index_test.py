@@ -0,0 +1,131 @@
+# MIT License
+# 
+# Copyright (c) 2016 David Sandberg
+# 
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+# 
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+# 
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+import unittest
+import tempfile
+import os
+import shutil
+import numpy as np
+import facenet
+
+class DatasetIndexTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.dataset_dir = os.path.join(self.tmp_dir, 'dataset')
+        self.index_filename = os.path.join(self.tmp_dir, 'dataset_index.npz')
+        for class_name, nrof_images in (('b', 3), ('a', 4), (u'cé', 2), ('empty', 0)):
+            os.makedirs(os.path.join(self.dataset_dir, class_name))
+            for i in range(nrof_images):
+                self.touch(os.path.join(self.dataset_dir, class_name, u'%s_%04d.png' % (class_name, i)))
+        # Files next to the class directories are not classes
+        self.touch(os.path.join(self.dataset_dir, 'readme.txt'))
+        # Count the times the index is built
+        self.nrof_builds = 0
+        self.build_dataset_index = facenet.build_dataset_index
+        def build_dataset_index(path, nrof_threads=16):
+            self.nrof_builds += 1
+            return self.build_dataset_index(path, nrof_threads)
+        facenet.build_dataset_index = build_dataset_index
+
+    def tearDown(self):
+        facenet.build_dataset_index = self.build_dataset_index
+        shutil.rmtree(self.tmp_dir)
+
+    def touch(self, filename):
+        open(filename, 'w').close()
+
+    def assertSameDataset(self, dataset_index):
+        dataset = facenet.get_dataset(self.dataset_dir)
+        index_dataset = dataset_index.get_dataset()
+        self.assertEqual([cls.name for cls in index_dataset], [cls.name for cls in dataset])
+        for index_cls, cls in zip(index_dataset, dataset):
+            self.assertEqual(sorted(dataset_index.get_paths(index_cls.image_paths)), sorted(cls.image_paths))
+
+    def testRoundTrip(self):
+        dataset_index = facenet.load_dataset_index(self.dataset_dir, self.index_filename)
+        self.assertEqual(self.nrof_builds, 1)
+        self.assertTrue(os.path.isfile(self.index_filename))
+        self.assertSameDataset(dataset_index)
+        loaded_index = facenet.load_dataset_index(self.dataset_dir, self.index_filename)
+        self.assertEqual(self.nrof_builds, 1)
+        self.assertEqual(len(loaded_index), 9)
+        self.assertEqual(loaded_index.class_names, dataset_index.class_names)
+        np.testing.assert_array_equal(loaded_index.labels, dataset_index.labels)
+        self.assertEqual(loaded_index.get_paths(range(len(loaded_index))), dataset_index.get_paths(range(len(dataset_index))))
+        self.assertSameDataset(loaded_index)
+
+    def testImageIndicesAndLabels(self):
+        dataset_index = facenet.load_dataset_index(self.dataset_dir, self.index_filename)
+        image_indices, labels = facenet.get_image_indices_and_labels(dataset_index.get_dataset())
+        self.assertEqual(image_indices.dtype, np.int64)
+        self.assertEqual(labels.dtype, np.int32)
+        np.testing.assert_array_equal(labels, dataset_index.labels)
+        image_paths, expected_labels = facenet.get_image_paths_and_labels(facenet.get_dataset(self.dataset_dir))
+        self.assertEqual(list(labels), expected_labels)
+        self.assertEqual(sorted(dataset_index.get_paths(image_indices)), sorted(image_paths))
+        for image_index, label in zip(image_indices, labels):
+            self.assertEqual(os.path.basename(os.path.dirname(dataset_index.get_path(image_index))), 
+                dataset_index.class_names[label])
+        image_indices, labels = facenet.get_image_indices_and_labels([])
+        self.assertEqual((image_indices.size, labels.size), (0, 0))
+
+    def testRebuildWhenDatasetChanges(self):
+        facenet.load_dataset_index(self.dataset_dir, self.index_filename)
+        # An image added to a class directory
+        self.touch(os.path.join(self.dataset_dir, 'a', 'a_new.png'))
+        self.setMtime(os.path.join(self.dataset_dir, 'a'))
+        dataset_index = facenet.load_dataset_index(self.dataset_dir, self.index_filename)
+        self.assertEqual(self.nrof_builds, 2)
+        self.assertEqual(len(dataset_index), 10)
+        self.assertSameDataset(dataset_index)
+        # A new class
+        os.makedirs(os.path.join(self.dataset_dir, 'd'))
+        self.touch(os.path.join(self.dataset_dir, 'd', 'd_0000.png'))
+        self.setMtime(self.dataset_dir)
+        dataset_index = facenet.load_dataset_index(self.dataset_dir, self.index_filename)
+        self.assertEqual(self.nrof_builds, 3)
+        self.assertIn('d', dataset_index.class_names)
+        self.assertSameDataset(dataset_index)
+        facenet.load_dataset_index(self.dataset_dir, self.index_filename)
+        self.assertEqual(self.nrof_builds, 3)
+
+    def testWithoutScandir(self):
+        # os.scandir is not available before Python 3.5
+        scandir = getattr(os, 'scandir', None)
+        if scandir is not None:
+            del os.scandir
+        try:
+            dataset_index = facenet.build_dataset_index(self.dataset_dir)
+        finally:
+            if scandir is not None:
+                os.scandir = scandir
+        self.assertEqual(dataset_index.class_names, ['a', 'b', u'cé', 'empty'])
+        self.assertSameDataset(dataset_index)
+
+    def setMtime(self, path):
+        # Make sure that the change is seen also on file systems with a coarse mtime
+        mtime = os.path.getmtime(path) + 10.0
+        os.utime(path, (mtime, mtime))
+
+if __name__ == "__main__":
+    unittest.main()
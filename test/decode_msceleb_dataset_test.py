@@ -0,0 +1,78 @@
+# MIT License
+# 
+# Copyright (c) 2016 David Sandberg
+# 
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+# 
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+# 
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+import unittest
+import tempfile
+import os
+import shutil
+import base64
+import cv2
+import numpy as np
+import decode_msceleb_dataset
+
+class DecodeMscelebDatasetTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        np.random.seed(seed=666)
+        self.image = np.random.randint(0, 256, size=(12, 10, 3)).astype(np.uint8)
+        image_data = base64.b64encode(cv2.imencode('.png', self.image)[1].tobytes())
+        self.lines = []
+        for i in range(50):
+            # Records of different lengths, so that the ranges start and end at all kinds of positions
+            name = b'name_%d' % i + b'x'*np.random.randint(0, 40)
+            self.lines.append(b'\t'.join([b'm.%04d' % (i//5), name, b'%d' % i, b'http://a/%d' % i, b'FaceId-%d' % i, image_data]) + b'\n')
+        self.lines[10] = b'm.0002\ttruncated\n'
+        self.lines[20] = b'\n'
+        self.tsv_filename = os.path.join(self.tmp_dir, 'records.tsv')
+        with open(self.tsv_filename, 'wb') as f:
+            f.writelines(self.lines)
+        
+    @classmethod
+    def tearDownClass(self):
+        # Recursively remove the temporary directory
+        shutil.rmtree(self.tmp_dir)
+
+    def testReadRecords(self):
+        file_size = os.path.getsize(self.tsv_filename)
+        line_ends = np.cumsum([len(line) for line in self.lines])
+        for chunk_size in [1, 2, 7, 100, 333, line_ends[0], line_ends[1]-line_ends[0], file_size-1, file_size, file_size+1]:
+            byte_ranges = decode_msceleb_dataset.get_byte_ranges([self.tsv_filename], int(chunk_size))
+            lines = [line for filename, start, end in byte_ranges
+                for line in decode_msceleb_dataset.read_records(filename, start, end)]
+            self.assertEqual(lines, self.lines)
+        # Ranges that start and end at line boundaries
+        boundaries = [0] + list(line_ends[0:50:7]) + [file_size]
+        lines = [line for start, end in zip(boundaries[:-1], boundaries[1:])
+            for line in decode_msceleb_dataset.read_records(self.tsv_filename, start, end)]
+        self.assertEqual(lines, self.lines)
+
+    def testDecodeRecord(self):
+        class_dir, img_name, img = decode_msceleb_dataset.decode_record(self.lines[3], None)
+        self.assertEqual((class_dir, img_name), ('m.0000', self.lines[3].split(b'\t')[1].decode('utf-8') + '-FaceId-3'))
+        np.testing.assert_array_equal(img, self.image)
+        for line in (self.lines[10], self.lines[20], b'm.0001\ta\t1\turl\tFaceId-1\tnot base64!\n'):
+            self.assertIsNone(decode_msceleb_dataset.decode_record(line, None)[2])
+
+if __name__ == "__main__":
+    unittest.main()
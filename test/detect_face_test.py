@@ -0,0 +1,241 @@
+# MIT License
+# 
+# Copyright (c) 2016 David Sandberg
+# 
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+# 
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+# 
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+import unittest
+import tempfile
+import os
+import tensorflow as tf
+import numpy as np
+from scipy import misc
+import detect_face
+
+def per_box_crop(img, total_boxes, size):
+    h, w = img.shape[0:2]
+    numbox = total_boxes.shape[0]
+    dy, edy, dx, edx, y, ey, x, ex, tmpw, tmph = detect_face.pad(total_boxes.copy(), w, h)
+    tempimg = np.zeros((size,size,3,numbox))
+    for k in range(0,numbox):
+        tmp = np.zeros((int(tmph[k]),int(tmpw[k]),3))
+        tmp[dy[k]-1:edy[k],dx[k]-1:edx[k],:] = img[y[k]-1:ey[k],x[k]-1:ex[k],:]
+        tempimg[:,:,:,k] = detect_face.imresample(tmp, (size, size))
+    tempimg = (tempimg-127.5)*0.0078125
+    return np.transpose(tempimg, (3,1,0,2))
+
+class DetectFaceTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.img = misc.imread('data/images/Anthony_Hopkins_0001.jpg', mode='RGB')
+        cls.minsize = 20
+        cls.threshold = [ 0.6, 0.7, 0.7 ]
+        cls.factor = 0.709
+        # The networks are shared by the tests that do not need a graph of their own
+        cls.graph = tf.Graph()
+        with cls.graph.as_default():
+            cls.sess = tf.Session()
+            cls.mtcnn = detect_face.create_mtcnn(cls.sess, None)
+        pnet, rnet, onet = cls.mtcnn
+        cls.expected_boxes, cls.expected_points = detect_face.detect_face(cls.img, cls.minsize, pnet, rnet, onet,
+                                                                          cls.threshold, cls.factor)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.sess.close()
+
+    def setUp(self):
+        self.pnet, self.rnet, self.onet = self.mtcnn
+
+    def detect(self, img, **kwargs):
+        return detect_face.detect_face(img, self.minsize, self.pnet, self.rnet, self.onet, self.threshold, self.factor, **kwargs)
+
+    def bulk_detect(self, images, **kwargs):
+        return detect_face.bulk_detect_face(images, 0.1, self.pnet, self.rnet, self.onet, self.threshold, self.factor, **kwargs)
+
+    def assertBulkEqual(self, result, expected):
+        for r, e in zip(result, expected):
+            if e is None:
+                self.assertIsNone(r)
+            else:
+                np.testing.assert_allclose(r[0], e[0], atol=1e-4)
+                np.testing.assert_allclose(r[1], e[1], atol=1e-4)
+  
+    def testCropAndResize(self):
+        h, w = self.img.shape[0:2]
+        np.random.seed(seed=666)
+        nrof_boxes = 50
+        bw = np.random.randint(30, 120, nrof_boxes)
+        x1 = np.random.randint(-10, w-bw+10)
+        y1 = np.random.randint(-10, h-bw+10)
+        total_boxes = np.transpose(np.vstack([x1, y1, x1+bw-1, y1+bw-1])).astype(np.int32)
+        
+        with self.graph.as_default():
+            # The second function gets a uniquified scope
+            crop_funs = [detect_face.create_crop_and_resize(self.sess, row_major=row_major) for row_major in (False, True)]
+        for crop_fun, row_major in zip(crop_funs, (False, True)):
+            for size in (24, 48):
+                patches = crop_fun(self.img, total_boxes, size)
+                if row_major:
+                    patches = np.transpose(patches, (0,2,1,3))
+                expected = per_box_crop(self.img, total_boxes, size)
+                self.assertEqual(patches.shape, expected.shape)
+                # Area interpolation is approximated by supersampling so allow for about
+                # three gray levels of mean absolute difference per patch
+                mean_diff = np.mean(np.abs(patches-expected), axis=(1,2,3))
+                self.assertLess(np.max(mean_diff), 3.0*0.0078125)
+
+    def testCropResizeFloat32(self):
+        total_boxes = np.array([[-10, 20, 89, 119], [100, 100, 111, 111], [200, 150, 299, 249]], dtype=np.float64)
+        buffers = {}
+        for size in (24, 48):
+            patches = detect_face.crop_resize_float32(self.img, total_boxes, size, buffers)
+            self.assertEqual(patches.dtype, np.float32)
+            expected = per_box_crop(self.img, total_boxes, size)
+            np.testing.assert_allclose(np.transpose(patches, (0,2,1,3)), expected, atol=1e-5)
+
+    def testTiledDetector(self):
+        # A budget that splits the first pyramid images into several tiles
+        boxes, points = detect_face.detect_face_tiled(self.img, self.minsize, self.pnet, self.rnet, self.onet,
+            self.threshold, self.factor, memory_budget=2*1024*1024)
+        self.assertEqual(boxes.shape, self.expected_boxes.shape)
+        np.testing.assert_allclose(boxes[:,0:4], self.expected_boxes[:,0:4], atol=4.0)
+        np.testing.assert_allclose(points, self.expected_points, atol=4.0)
+        with self.assertRaises(ValueError):
+            detect_face.detect_face_tiled(self.img, self.minsize, self.pnet, self.rnet, self.onet,
+                self.threshold, self.factor, memory_budget=1024)
+
+    def testImagePyramid(self):
+        img = detect_face.imresample(self.img, (1000, 1000))
+        pyramid = detect_face.ImagePyramid(img, 20, 0.709)
+        self.assertEqual(len(pyramid), len(detect_face.scale_pyramid(1000, 1000, 20, 0.709)))
+        for scale, level in zip(pyramid.scales, pyramid.levels):
+            hs = int(np.ceil(1000*scale))
+            expected = detect_face.imresample(img, (hs, hs))
+            self.assertEqual(level.shape, expected.shape)
+            self.assertLess(np.mean(np.abs(level.astype(np.float32)-expected)), 1.0)
+        with self.assertRaises(ValueError):
+            detect_face.detect_face(img, 40, None, None, None, [ 0.6, 0.7, 0.7 ], 0.709, pyramid=pyramid)
+
+    def testBoxesOnlyAndRefineLandmarks(self):
+        boxes, points = self.detect(self.img, boxes_only=True)
+        self.assertEqual(points.size, 0)
+        self.assertGreaterEqual(boxes.shape[0], self.expected_boxes.shape[0])
+        # Landmarks for boxes from the full detection should come out (almost) the same
+        boxes, points = detect_face.refine_landmarks(self.img, self.expected_boxes, self.onet)
+        self.assertEqual(boxes.shape, self.expected_boxes.shape)
+        np.testing.assert_allclose(points, self.expected_points, atol=4.0)
+
+    def testDetectionStats(self):
+        collector = detect_face.StatsCollector()
+        boxes, _ = self.detect(self.img, stats_collector=collector)
+        np.testing.assert_array_equal(boxes, self.expected_boxes)
+        bulk_boxes, _ = self.bulk_detect([self.img], stats_collector=collector)[0]
+
+        self.assertEqual(collector.nrof_images, 2)
+        self.assertEqual(collector.nrof_faces, boxes.shape[0]+bulk_boxes.shape[0])
+        steps = ['pnet_nms', 'rnet', 'rnet_nms', 'onet', 'onet_nms']
+        counts = [collector.stage_candidates[step] for step in steps]
+        self.assertEqual(counts, sorted(counts, reverse=True))
+        self.assertGreater(collector.pnet_candidates, collector.stage_candidates['pnet_nms'])
+        self.assertGreater(collector.times['pnet'], 0.0)
+
+    def testBulkStageBatching(self):
+        images = [self.img, self.img[20:200,10:230,:], np.full((60,60,3), 128, np.uint8)]
+        expected = self.bulk_detect(images)
+        self.assertBulkEqual(self.bulk_detect(images, max_stage_batch=7), expected)
+        collector = detect_face.StatsCollector()
+        self.bulk_detect(images, max_pnet_candidates=5, stats_collector=collector)
+        self.assertLessEqual(collector.stage_candidates['rnet'], 5*len(images))
+
+    def testBulkCanvas(self):
+        images = [self.img, self.img[20:200,10:230,:], self.img[5:240,30:190,:], np.full((60,60,3), 128, np.uint8)]
+        expected = self.bulk_detect(images)
+        for growth in (1.25, 2.0):
+            self.assertBulkEqual(self.bulk_detect(images, pnet_canvas_growth=growth), expected)
+        sizes = [detect_face.pnet_canvas_size(n, 1.25) for n in range(12, 1000)]
+        self.assertEqual(sizes, sorted(sizes))
+        self.assertTrue(all(size >= n and size % 2 == 0 for n, size in zip(range(12, 1000), sizes)))
+        self.assertLessEqual(len(set(sizes)), 25)
+        with self.assertRaises(ValueError):
+            detect_face.pnet_canvas_size(100, 1.0)
+
+    def testFrozenMtcnn(self):
+        frozen_file = os.path.join(tempfile.mkdtemp(), 'mtcnn.pb')
+        with tf.Graph().as_default():
+            with tf.Session() as sess:
+                output_graph_def = detect_face.freeze_mtcnn(sess, None)
+        with tf.gfile.GFile(frozen_file, 'wb') as f:
+            f.write(output_graph_def.SerializeToString())
+        with tf.Graph().as_default():
+            with tf.Session() as sess:
+                pnet, rnet, onet = detect_face.create_mtcnn(sess, frozen_file)
+                boxes, points = detect_face.detect_face(self.img, self.minsize, pnet, rnet, onet, self.threshold, self.factor)
+                np.testing.assert_allclose(boxes, self.expected_boxes, atol=1e-3)
+                np.testing.assert_allclose(points, self.expected_points, atol=1e-3)
+            with tf.Session() as sess:
+                with self.assertRaises(ValueError):
+                    detect_face.create_mtcnn_fused(sess, frozen_file)
+
+    def testFusedDetector(self):
+        with tf.Graph().as_default():
+            with tf.Session() as sess:
+                fused_fun = detect_face.create_mtcnn_fused(sess, None)
+                boxes, points = fused_fun(self.img, self.minsize, self.threshold, self.factor)
+        self.assertEqual(boxes.shape, self.expected_boxes.shape)
+        self.assertEqual(points.shape, self.expected_points.shape)
+        # The resampling differs slightly from the numpy implementation
+        np.testing.assert_allclose(boxes[:,0:4], self.expected_boxes[:,0:4], atol=4.0)
+        np.testing.assert_allclose(points, self.expected_points, atol=4.0)
+
+    def testRowMajorWeights(self):
+        np.random.seed(seed=666)
+        image = np.random.uniform(-1.0, 1.0, (1, 37, 53, 3))
+        patches24 = np.random.uniform(-1.0, 1.0, (5, 24, 24, 3))
+        patches48 = np.random.uniform(-1.0, 1.0, (5, 48, 48, 3))
+        outs = []
+        for row_major in (False, True):
+            with tf.Graph().as_default():
+                with tf.Session() as sess:
+                    pnet, rnet, onet = detect_face.create_mtcnn(sess, None, row_major=row_major)
+                    transpose = (lambda x : x) if row_major else (lambda x : np.transpose(x, (0,2,1,3)))
+                    pnet_out = [transpose(out) for out in pnet(transpose(image))]
+                    outs.append(pnet_out + list(rnet(transpose(patches24))) + list(onet(transpose(patches48))))
+        for out, row_major_out in zip(*outs):
+            np.testing.assert_allclose(out, row_major_out, rtol=1e-4, atol=1e-5)
+
+    def testFastNms(self):
+        np.random.seed(seed=666)
+        nrof_boxes = 3000
+        # Clusters of overlapping boxes of different sizes and some scattered boxes
+        centers = np.random.uniform(0, 1000, (20, 2))
+        xy1 = np.fix(np.repeat(centers, nrof_boxes//20, axis=0) + np.random.normal(0, 10, (nrof_boxes, 2)))
+        xy1[::10,:] = np.fix(np.random.uniform(0, 1000, (nrof_boxes//10, 2)))
+        size = np.fix(np.random.uniform(12, 200, (nrof_boxes, 1)))
+        boxes = np.hstack([xy1, xy1+size-1, np.random.uniform(size=(nrof_boxes, 1))])
+        
+        for method, threshold in (('Union', 0.5), ('Union', 0.7), ('Min', 0.7)):
+            pick = detect_face.fast_nms(boxes, threshold, method)
+            expected_pick = detect_face.nms(boxes, threshold, method)
+            np.testing.assert_array_equal(pick, expected_pick)
+        self.assertEqual(detect_face.fast_nms(np.empty((0,5)), 0.5, 'Union').size, 0)
+                      
+if __name__ == "__main__":
+    unittest.main()
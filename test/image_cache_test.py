@@ -0,0 +1,117 @@
+# MIT License
+# 
+# Copyright (c) 2016 David Sandberg
+# 
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+# 
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+# 
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+import unittest
+import tempfile
+import os
+import shutil
+import threading
+import multiprocessing.pool
+import numpy as np
+from scipy import misc
+import facenet
+
+class ImageCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.cache_dir = os.path.join(self.tmp_dir, 'cache')
+        np.random.seed(seed=666)
+        self.images = np.random.randint(0, 256, size=(40, 16, 16, 3)).astype(np.uint8)
+        self.image_paths = [os.path.join(self.tmp_dir, '%03d.png' % i) for i in range(len(self.images))]
+        for path, image in zip(self.image_paths, self.images):
+            misc.imsave(path, image)
+        # Count the images that are decoded
+        self.decoded_paths = []
+        self.lock = threading.Lock()
+        self.read_rgb_image = facenet.read_rgb_image
+        def read_rgb_image(path):
+            with self.lock:
+                self.decoded_paths.append(path)
+            return self.read_rgb_image(path)
+        facenet.read_rgb_image = read_rgb_image
+
+    def tearDown(self):
+        facenet.read_rgb_image = self.read_rgb_image
+        shutil.rmtree(self.tmp_dir)
+
+    def testCacheHits(self):
+        facenet.ImageCache(self.cache_dir, self.image_paths, nrof_threads=4)
+        self.assertEqual(sorted(set(self.decoded_paths)), self.image_paths)
+        del self.decoded_paths[:]
+        image_cache = facenet.ImageCache(self.cache_dir, self.image_paths, nrof_threads=4)
+        for path, image in zip(self.image_paths, self.images):
+            np.testing.assert_array_equal(image_cache.read(path), image)
+            np.testing.assert_array_equal(image_cache.read(path.encode('utf-8')), image)
+        self.assertEqual(self.decoded_paths, [])
+        # Images that are not in the cache are decoded
+        uncached_path = os.path.join(self.tmp_dir, 'uncached.png')
+        misc.imsave(uncached_path, self.images[0])
+        np.testing.assert_array_equal(image_cache.read(uncached_path), self.images[0])
+        self.assertEqual(self.decoded_paths, [uncached_path])
+
+    def testMtimeInvalidation(self):
+        facenet.ImageCache(self.cache_dir, self.image_paths, nrof_threads=4)
+        del self.decoded_paths[:]
+        changed_path = self.image_paths[7]
+        changed_image = 255 - self.images[7]
+        misc.imsave(changed_path, changed_image)
+        mtime = os.path.getmtime(changed_path) + 10.0
+        os.utime(changed_path, (mtime, mtime))
+        image_cache = facenet.ImageCache(self.cache_dir, self.image_paths, nrof_threads=4)
+        self.assertEqual(self.decoded_paths, [changed_path])
+        np.testing.assert_array_equal(image_cache.read(changed_path), changed_image)
+        np.testing.assert_array_equal(image_cache.read(self.image_paths[6]), self.images[6])
+        # A different number of images rebuilds the cache
+        del self.decoded_paths[:]
+        image_cache = facenet.ImageCache(self.cache_dir, self.image_paths[0:30], nrof_threads=4)
+        self.assertEqual(image_cache.images.shape, (30, 16, 16, 3))
+        self.assertEqual(sorted(set(self.decoded_paths)), self.image_paths[0:30])
+        # All images must have the same shape
+        misc.imsave(self.image_paths[3], np.zeros((17, 16, 3), np.uint8))
+        with self.assertRaises(ValueError):
+            facenet.ImageCache(self.cache_dir, self.image_paths[0:30], nrof_threads=4)
+
+    def testCacheInPackedDataset(self):
+        # The cache can be kept in the directory of a packed dataset without touching its index
+        packed_index_filename = os.path.join(self.tmp_dir, facenet.PACKED_INDEX_FILENAME)
+        with open(packed_index_filename, 'w') as f:
+            f.write('a\tpack_00000_00000.npy#0\ta/1.png\t0\t0\t16\t16\n')
+        facenet.ImageCache(self.tmp_dir, self.image_paths, nrof_threads=4)
+        image_cache = facenet.ImageCache(self.tmp_dir, self.image_paths, nrof_threads=4)
+        np.testing.assert_array_equal(image_cache.images, self.images)
+        with open(packed_index_filename, 'r') as f:
+            self.assertEqual(f.read(), 'a\tpack_00000_00000.npy#0\ta/1.png\t0\t0\t16\t16\n')
+
+    def testConcurrentFill(self):
+        image_cache = facenet.ImageCache(self.cache_dir, self.image_paths, nrof_threads=8)
+        self.assertEqual(sorted(set(self.decoded_paths)), self.image_paths)
+        np.testing.assert_array_equal(image_cache.images, self.images)
+        pool = multiprocessing.pool.ThreadPool(8)
+        try:
+            images = pool.map(image_cache.read, self.image_paths*4)
+        finally:
+            pool.close()
+        np.testing.assert_array_equal(np.stack(images), np.concatenate([self.images]*4))
+
+if __name__ == "__main__":
+    unittest.main()
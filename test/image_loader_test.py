@@ -0,0 +1,89 @@
+# MIT License
+# 
+# Copyright (c) 2016 David Sandberg
+# 
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+# 
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+# 
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+import unittest
+import tempfile
+import os
+import shutil
+import numpy as np
+from scipy import misc
+import facenet
+
+class ImageLoaderTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        np.random.seed(seed=666)
+        self.images = np.random.randint(0, 256, size=(20, 32, 32, 3)).astype(np.uint8)
+        self.images[5,:] = 17  # Constant image, which has the adjusted std
+        self.image_paths = [os.path.join(self.tmp_dir, '%03d.png' % i) for i in range(len(self.images))]
+        for path, image in zip(self.image_paths, self.images):
+            misc.imsave(path, image)
+        # A gray scale image is converted to RGB
+        self.image_paths.append(os.path.join(self.tmp_dir, 'gray.png'))
+        misc.imsave(self.image_paths[-1], self.images[0,:,:,0])
+        
+    @classmethod
+    def tearDownClass(self):
+        # Recursively remove the temporary directory
+        shutil.rmtree(self.tmp_dir)
+
+    def testFloat32(self):
+        expected = facenet.load_data(self.image_paths, False, False, 32)
+        image_loader = facenet.ImageLoader(32, nrof_threads=4)
+        try:
+            images = image_loader.load(self.image_paths)
+            self.assertEqual(images.dtype, np.float32)
+            np.testing.assert_allclose(images, expected, rtol=0, atol=1e-5)
+            # The buffer is reused for smaller batches
+            images = image_loader.load(self.image_paths[3:10])
+            self.assertEqual(images.shape, (7, 32, 32, 3))
+            np.testing.assert_allclose(images, expected[3:10], rtol=0, atol=1e-5)
+        finally:
+            image_loader.close()
+
+    def testNoPrewhiten(self):
+        expected = facenet.load_data(self.image_paths, False, False, 32, do_prewhiten=False)
+        image_loader = facenet.ImageLoader(32, nrof_threads=4, do_prewhiten=False)
+        try:
+            images = image_loader.load(self.image_paths)
+            self.assertEqual(images.dtype, np.float32)
+            np.testing.assert_array_equal(images, expected)
+        finally:
+            image_loader.close()
+
+    def testUint8(self):
+        image_loader = facenet.ImageLoader(24, nrof_threads=4, do_prewhiten=False, dtype=np.uint8)
+        try:
+            images = image_loader.load(self.image_paths)
+            self.assertEqual(images.dtype, np.uint8)
+            # Images larger than image_size are center cropped
+            np.testing.assert_array_equal(images[0:20], self.images[:,4:28,4:28,:])
+            np.testing.assert_array_equal(images[20], np.stack([self.images[0,4:28,4:28,0]]*3, axis=2))
+        finally:
+            image_loader.close()
+        with self.assertRaises(ValueError):
+            facenet.ImageLoader(24, dtype=np.uint8)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,181 @@
+# MIT License
+# 
+# Copyright (c) 2016 David Sandberg
+# 
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+# 
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+# 
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+import unittest
+import tempfile
+import os
+import shutil
+import numpy as np
+import facenet
+import align.manifest
+import align.align_dataset_mtcnn as align_dataset_mtcnn
+
+class ManifestTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.manifest_filename = os.path.join(self.tmp_dir, 'manifest.sqlite')
+        self.output_dir = os.path.join(self.tmp_dir, 'aligned')
+        os.makedirs(os.path.join(self.output_dir, 'a'))
+        os.makedirs(os.path.join(self.tmp_dir, 'a'))
+        self.image_paths = []
+        for name in ('aligned', 'no_face', 'unreadable', 'new'):
+            image_path = os.path.join(self.tmp_dir, 'a', name + '.jpg')
+            with open(image_path, 'w') as f:
+                f.write(name)
+            self.image_paths.append(image_path)
+        self.boxes = np.array([[1, 2, 30, 40], [50, 60, 70, 80]], np.int32)
+        self.landmarks = np.arange(20, dtype=np.float32).reshape((2, 10))
+
+    def tearDown(self):
+        # Recursively remove the temporary directory
+        shutil.rmtree(self.tmp_dir)
+
+    def recordImages(self, manifest):
+        manifest.record(self.image_paths[0], align.manifest.ALIGNED, self.boxes, self.landmarks)
+        manifest.record(self.image_paths[1], align.manifest.NO_FACE)
+        manifest.record(self.image_paths[2], align.manifest.UNREADABLE)
+
+    def getOutputFilename(self, image_path):
+        filename = os.path.splitext(os.path.basename(image_path))[0]
+        return os.path.join(self.output_dir, 'a', filename + '.png')
+
+    def getImagesToAlign(self, argv):
+        manifest = align.manifest.AlignmentManifest(self.manifest_filename)
+        manifest_entries = manifest.load()
+        manifest.close()
+        args = align_dataset_mtcnn.parse_arguments([self.tmp_dir, self.output_dir, '--manifest', self.manifest_filename] + argv)
+        return [os.path.basename(image_path) for image_path in self.image_paths
+                if align_dataset_mtcnn.needs_alignment(image_path, self.getOutputFilename(image_path), manifest_entries, args)]
+
+    def testRecordAndLoad(self):
+        manifest = align.manifest.AlignmentManifest(self.manifest_filename)
+        self.recordImages(manifest)
+        manifest.close()
+        manifest = align.manifest.AlignmentManifest(self.manifest_filename)
+        entries = manifest.load()
+        self.assertEqual(sorted(entries), sorted(self.image_paths[0:3]))
+        stat = os.stat(self.image_paths[0])
+        self.assertEqual(entries[self.image_paths[0]], (stat.st_mtime, stat.st_size, align.manifest.ALIGNED))
+        self.assertEqual(entries[self.image_paths[1]][2], align.manifest.NO_FACE)
+        self.assertEqual(entries[self.image_paths[2]][2], align.manifest.UNREADABLE)
+        status, boxes, landmarks = manifest.get_faces(self.image_paths[0])
+        self.assertEqual(status, align.manifest.ALIGNED)
+        np.testing.assert_array_equal(boxes, self.boxes)
+        np.testing.assert_array_equal(landmarks, self.landmarks)
+        status, boxes, landmarks = manifest.get_faces(self.image_paths[1])
+        self.assertEqual((status, boxes.shape, landmarks.shape), (align.manifest.NO_FACE, (0, 4), (0, 10)))
+        self.assertIsNone(manifest.get_faces(self.image_paths[3]))
+        # Images that can not be stat'ed are recorded with mtime and size 0
+        manifest.record(os.path.join(self.tmp_dir, 'missing.jpg'), align.manifest.UNREADABLE)
+        self.assertEqual(manifest.load()[os.path.join(self.tmp_dir, 'missing.jpg')], (0.0, 0, align.manifest.UNREADABLE))
+        manifest.close()
+
+    def testReopenAfterCommit(self):
+        manifest = align.manifest.AlignmentManifest(self.manifest_filename, commit_interval=100)
+        self.recordImages(manifest)
+        manifest.commit()
+        manifest.record(self.image_paths[3], align.manifest.NO_FACE)
+        # A run that is interrupted now has the committed rows, even if there are less than commit_interval
+        reopened = align.manifest.AlignmentManifest(self.manifest_filename)
+        self.assertEqual(sorted(reopened.load()), sorted(self.image_paths[0:3]))
+        reopened.close()
+        manifest.close()
+        reopened = align.manifest.AlignmentManifest(self.manifest_filename)
+        self.assertEqual(sorted(reopened.load()), sorted(self.image_paths))
+        reopened.close()
+        # The rows are committed every commit_interval rows
+        os.remove(self.manifest_filename)
+        manifest = align.manifest.AlignmentManifest(self.manifest_filename, commit_interval=2)
+        self.recordImages(manifest)
+        reopened = align.manifest.AlignmentManifest(self.manifest_filename)
+        self.assertEqual(sorted(reopened.load()), sorted(self.image_paths[0:2]))
+        reopened.close()
+        manifest.close()
+
+    def testNeedsAlignment(self):
+        manifest = align.manifest.AlignmentManifest(self.manifest_filename)
+        self.recordImages(manifest)
+        manifest.close()
+        self.assertEqual(self.getImagesToAlign([]), ['new.jpg'])
+        # Only the images that failed are aligned again, but not the ones that are new
+        self.assertEqual(self.getImagesToAlign(['--reprocess_failed']), ['no_face.jpg', 'unreadable.jpg'])
+
+    def testValidateManifest(self):
+        manifest = align.manifest.AlignmentManifest(self.manifest_filename)
+        self.recordImages(manifest)
+        manifest.close()
+        # The thumbnail of the aligned image is missing
+        self.assertEqual(self.getImagesToAlign([]), ['new.jpg'])
+        self.assertEqual(self.getImagesToAlign(['--validate_manifest']), ['aligned.jpg', 'new.jpg'])
+        with open(self.getOutputFilename(self.image_paths[0]), 'w') as f:
+            f.write('thumbnail')
+        self.assertEqual(self.getImagesToAlign(['--validate_manifest']), ['new.jpg'])
+        # An image that has changed since it was aligned
+        with open(self.image_paths[1], 'w') as f:
+            f.write('changed image')
+        self.assertEqual(self.getImagesToAlign(['--validate_manifest']), ['no_face.jpg', 'new.jpg'])
+
+    def testPackedRecordedAfterFlush(self):
+        manifest = align.manifest.AlignmentManifest(self.manifest_filename)
+        writer = facenet.PackedShardWriter(self.output_dir, 'pack_00000', os.path.join(self.output_dir, 'index.txt'),
+            (4, 4, 3), shard_size=3)
+        faces = [(None, np.zeros((4, 4, 3), np.uint8), box, landmarks) for box, landmarks in zip(self.boxes, self.landmarks)]
+        for image_path in self.image_paths[0:2]:
+            align_dataset_mtcnn.pack_faces(writer, image_path, self.getOutputFilename(image_path), faces)
+            align_dataset_mtcnn.record_faces(manifest, image_path, faces, writer)
+        # The faces of the second image do not fit in the first shard, which is written when they are added
+        self.assertEqual(list(manifest.load()), [self.image_paths[0]])
+        self.assertEqual(align_dataset_mtcnn.get_packed_source_paths(self.output_dir), set(self.image_paths[0:1]))
+        align_dataset_mtcnn.record_faces(manifest, self.image_paths[2], [], writer)
+        self.assertEqual(sorted(manifest.load()), [self.image_paths[0], self.image_paths[2]])
+        writer.close()
+        self.assertEqual(sorted(manifest.load()), sorted(self.image_paths[0:3]))
+        status, boxes, landmarks = manifest.get_faces(self.image_paths[1])
+        self.assertEqual(status, align.manifest.ALIGNED)
+        np.testing.assert_array_equal(boxes, self.boxes)
+        manifest.close()
+
+    def testPackedNeedsAlignment(self):
+        writer = facenet.PackedShardWriter(self.output_dir, 'pack_00000', os.path.join(self.output_dir, 'index.txt'),
+            (4, 4, 3), shard_size=1)
+        for image_path in self.image_paths[0:2]:
+            writer.add(np.zeros((4, 4, 3), np.uint8), 'a', image_path, self.boxes[0])
+        writer.close()
+        packed_source_paths = align_dataset_mtcnn.get_packed_source_paths(self.output_dir)
+        args = align_dataset_mtcnn.parse_arguments([self.tmp_dir, self.output_dir, '--output_format', 'packed'])
+        # Without a manifest the images in the packed index are skipped
+        self.assertEqual([align_dataset_mtcnn.needs_alignment(image_path, self.getOutputFilename(image_path), None, args,
+            packed_source_paths) for image_path in self.image_paths], [False, False, True, True])
+        # Also with a manifest that misses the rows of the last shard
+        manifest = align.manifest.AlignmentManifest(self.manifest_filename)
+        manifest.record(self.image_paths[0], align.manifest.ALIGNED, self.boxes[0:1], self.landmarks[0:1])
+        manifest.record(self.image_paths[2], align.manifest.ALIGNED, self.boxes[0:1], self.landmarks[0:1])
+        manifest_entries = manifest.load()
+        manifest.close()
+        for validate_manifest, expected in ((False, [False, False, False, True]), (True, [False, False, True, True])):
+            args.validate_manifest = validate_manifest
+            self.assertEqual([align_dataset_mtcnn.needs_alignment(image_path, self.getOutputFilename(image_path),
+                manifest_entries, args, packed_source_paths) for image_path in self.image_paths], expected)
+
+if __name__ == "__main__":
+    unittest.main()
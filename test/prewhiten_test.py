@@ -0,0 +1,63 @@
+# MIT License
+# 
+# Copyright (c) 2016 David Sandberg
+# 
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+# 
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+# 
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+import unittest
+import tensorflow as tf
+import numpy as np
+import facenet
+
+class PrewhitenTest(unittest.TestCase):
+
+    def setUp(self):
+        np.random.seed(seed=666)
+        self.images = np.random.randint(0, 256, size=(8, 40, 40, 3)).astype(np.uint8)
+        self.images[3,:] = 17  # Constant image, which has the adjusted std
+        self.expected = np.stack([facenet.prewhiten(image) for image in self.images])
+
+    def testPrewhitenBatch(self):
+        images = facenet.prewhiten_batch(self.images)
+        self.assertEqual(images.dtype, np.float32)
+        np.testing.assert_allclose(images, self.expected, rtol=0, atol=1e-5)
+
+    def testPrewhitenBatchInPlace(self):
+        images = self.images.astype(np.float32)
+        out = facenet.prewhiten_batch(images, out=images)
+        self.assertTrue(out is images)
+        np.testing.assert_allclose(images, self.expected, rtol=0, atol=1e-5)
+
+    def testPrewhitenBatchInvalidOut(self):
+        for out in (np.empty((8, 40, 40, 3), np.float64),
+                    np.empty((8, 40, 40, 4), np.float32),
+                    np.empty((8, 40, 40, 6), np.float32)[:,:,:,0:3]):
+            with self.assertRaises(ValueError):
+                facenet.prewhiten_batch(self.images, out=out)
+
+    def testPrewhitenOp(self):
+        with tf.Graph().as_default():
+            images_placeholder = tf.placeholder(tf.uint8, shape=(None, None, None, 3))
+            prewhitened = facenet.prewhiten_op(images_placeholder)
+            with tf.Session() as sess:
+                images = sess.run(prewhitened, feed_dict={images_placeholder: self.images})
+        np.testing.assert_allclose(images, self.expected, rtol=0, atol=1e-5)
+
+if __name__ == "__main__":
+    unittest.main()
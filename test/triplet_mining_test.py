@@ -0,0 +1,106 @@
+# MIT License
+# 
+# Copyright (c) 2016 David Sandberg
+# 
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+# 
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+# 
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+import unittest
+import numpy as np
+import triplet_mining
+import train_tripletloss
+
+class TripletMiningTest(unittest.TestCase):
+
+    def setUp(self):
+        np.random.seed(seed=666)
+        self.nrof_images_per_class = [5, 1, 4, 6, 3]
+        self.labels = np.repeat(np.arange(len(self.nrof_images_per_class)), self.nrof_images_per_class)
+        embeddings = np.random.normal(size=(len(self.labels), 8))
+        self.embeddings = embeddings / np.linalg.norm(embeddings, axis=1, keepdims=True)
+        self.dists = np.sum(np.square(self.embeddings[:,None,:] - self.embeddings[None,:,:]), 2)
+        self.alpha = 0.5
+
+    def testPairwiseSquaredDistances(self):
+        dists = triplet_mining.pairwise_squared_distances(self.embeddings)
+        np.testing.assert_allclose(dists, self.dists, rtol=0, atol=1e-12)
+
+    def testRandomViolating(self):
+        triplets, nrof_pairs = triplet_mining.select_triplets(self.embeddings, self.nrof_images_per_class, self.alpha,
+            triplet_mining.RANDOM_VIOLATING)
+        image_indices = list(range(len(self.labels)))
+        reference_triplets, reference_nrof_pairs, _ = train_tripletloss.select_triplets(self.embeddings, self.nrof_images_per_class,
+            image_indices, len(self.nrof_images_per_class), self.alpha)
+        self.assertEqual(nrof_pairs, reference_nrof_pairs)
+        # The negatives are random, but the same anchor-positive pairs must get a triplet
+        self.assertEqual(sorted((a, p) for a, p, _ in triplets), sorted((a, p) for a, p, _ in reference_triplets))
+        for a, p, n in triplets:
+            self.assertLess(a, p)
+            self.assertEqual(self.labels[a], self.labels[p])
+            self.assertNotEqual(self.labels[a], self.labels[n])
+            self.assertLess(self.dists[a,n] - self.dists[a,p], self.alpha)
+
+    def testSemiHard(self):
+        triplets, _ = triplet_mining.select_triplets(self.embeddings, self.nrof_images_per_class, self.alpha,
+            triplet_mining.SEMI_HARD)
+        self.assertGreater(len(triplets), 0)
+        for a, p, n in triplets:
+            self.assertNotEqual(self.labels[a], self.labels[n])
+            self.assertGreater(self.dists[a,n], self.dists[a,p])
+            self.assertLess(self.dists[a,n] - self.dists[a,p], self.alpha)
+
+    def testBatchHard(self):
+        triplets, _ = triplet_mining.select_triplets(self.embeddings, self.nrof_images_per_class, self.alpha,
+            triplet_mining.BATCH_HARD)
+        # Every image of a class with more than one image is an anchor once
+        self.assertEqual(sorted(triplets[:,0]), [i for i in range(len(self.labels)) if self.nrof_images_per_class[self.labels[i]]>1])
+        for a, p, n in triplets:
+            same_class = self.labels==self.labels[a]
+            self.assertEqual(self.dists[a,p], np.max(self.dists[a,same_class]))
+            self.assertEqual(self.dists[a,n], np.min(self.dists[a,~same_class]))
+
+    def testBatchAll(self):
+        expected = set()
+        for a in range(len(self.labels)):
+            for p in range(a+1, len(self.labels)):
+                for n in range(len(self.labels)):
+                    if (self.labels[a]==self.labels[p] and self.labels[a]!=self.labels[n] and 
+                            self.dists[a,n] - self.dists[a,p] < self.alpha):
+                        expected.add((a, p, n))
+        triplets, _ = triplet_mining.select_triplets(self.embeddings, self.nrof_images_per_class, self.alpha,
+            triplet_mining.BATCH_ALL)
+        self.assertEqual(set(map(tuple, triplets)), expected)
+        self.assertEqual(len(triplets), len(expected))
+        triplets, _ = triplet_mining.select_triplets(self.embeddings, self.nrof_images_per_class, self.alpha,
+            triplet_mining.BATCH_ALL, max_nrof_triplets=10)
+        self.assertEqual(len(set(map(tuple, triplets))), 10)
+        self.assertTrue(set(map(tuple, triplets)) <= expected)
+
+    def testMaxNrofTriplets(self):
+        for strategy in triplet_mining.STRATEGIES:
+            all_triplets, _ = triplet_mining.select_triplets(self.embeddings, self.nrof_images_per_class, self.alpha,
+                strategy)
+            triplets, _ = triplet_mining.select_triplets(self.embeddings, self.nrof_images_per_class, self.alpha,
+                strategy, max_nrof_triplets=3)
+            self.assertEqual(len(triplets), 3)
+            self.assertEqual(len(set(map(tuple, triplets))), 3)
+            if strategy==triplet_mining.BATCH_HARD:
+                self.assertTrue(set(map(tuple, triplets)) <= set(map(tuple, all_triplets)))
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,50 @@
+import align.detect_face
+import argparse
+import os
+import sys
+import tempfile
+import time
+import tensorflow as tf
+from scipy import misc
+
+def create_and_detect(model_path, img, args):
+    start_time = time.time()
+    with tf.Graph().as_default():
+        with tf.Session() as sess:
+            pnet, rnet, onet = align.detect_face.create_mtcnn(sess, model_path)
+            create_time = time.time() - start_time
+            align.detect_face.detect_face(img, args.minsize, pnet, rnet, onet, [0.6, 0.7, 0.7], args.factor)
+    return create_time, time.time() - start_time
+
+def main(args):
+    img = misc.imread(args.image, mode='RGB')
+    frozen_file = os.path.join(tempfile.mkdtemp(), 'mtcnn.pb')
+    with tf.Graph().as_default():
+        with tf.Session() as sess:
+            output_graph_def = align.detect_face.freeze_mtcnn(sess, args.model_dir)
+    with tf.gfile.GFile(frozen_file, 'wb') as f:
+        f.write(output_graph_def.SerializeToString())
+
+    for name, model_path in (('Numpy weights', args.model_dir), ('Frozen graph', frozen_file)):
+        times = [create_and_detect(model_path, img, args) for _ in range(args.nrof_runs)]
+        print('%s: create_mtcnn %.1f ms  create_mtcnn + first detect_face %.1f ms' % (name,
+            1000*sum(t[0] for t in times)/len(times), 1000*sum(t[1] for t in times)/len(times)))
+
+
+def parse_arguments(argv):
+    parser = argparse.ArgumentParser()
+    parser.add_argument('image', type=str, 
+        help='Image to run the first detection on')
+    parser.add_argument('--model_dir', type=str,
+        help='Directory containing det1.npy, det2.npy and det3.npy', default=None)
+    parser.add_argument('--minsize', type=int,
+        help='Minimum size of the faces', default=20)
+    parser.add_argument('--factor', type=float,
+        help='Scale factor between the pyramid levels', default=0.709)
+    parser.add_argument('--nrof_runs', type=int,
+        help='Number of times to create the detector', default=5)
+    return parser.parse_args(argv)
+
+
+if __name__ == '__main__':
+    main(parse_arguments(sys.argv[1:]))
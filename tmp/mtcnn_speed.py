@@ -0,0 +1,64 @@
+import align.detect_face
+import argparse
+import sys
+import time
+import numpy as np
+import tensorflow as tf
+from scipy import misc
+try:
+    import tracemalloc
+except ImportError:
+    # tracemalloc is only available in Python 3.4 and later
+    tracemalloc = None
+
+def max_abs_diff(a, b):
+    return np.max(np.abs(a-b)) if a.size > 0 else 0.0
+
+def main(args):
+
+    img = misc.imread(args.image, mode='RGB')
+    minsize = 20
+    threshold = [ 0.6, 0.7, 0.7 ]
+    factor = 0.709
+
+    with tf.Graph().as_default():
+        sess = tf.Session()
+        with sess.as_default():
+            pnet, rnet, onet = align.detect_face.create_mtcnn(sess, None)
+            expected_boxes, expected_points = align.detect_face.detect_face(img, minsize, pnet, rnet, onet, threshold, factor)
+            for float32 in (False, True):
+                # Warm up
+                align.detect_face.detect_face(img, minsize, pnet, rnet, onet, threshold, factor, float32=float32)
+                t = np.zeros((args.nrof_runs))
+                if tracemalloc:
+                    tracemalloc.start()
+                for i in range(args.nrof_runs):
+                    start_time = time.time()
+                    bounding_boxes, _ = align.detect_face.detect_face(img, minsize, pnet, rnet, onet, threshold, factor, float32=float32)
+                    t[i] = time.time() - start_time
+                if tracemalloc:
+                    _, peak = tracemalloc.get_traced_memory()
+                    tracemalloc.stop()
+                    peak_memory = '%.1f MB' % (peak/1024.0/1024.0)
+                else:
+                    peak_memory = 'n/a'
+                bounding_boxes, points = align.detect_face.detect_face(img, minsize, pnet, rnet, onet, threshold, factor, float32=float32)
+                if bounding_boxes.shape == expected_boxes.shape:
+                    diff = '%.2g' % max(max_abs_diff(bounding_boxes, expected_boxes), max_abs_diff(points, expected_points))
+                else:
+                    diff = 'different number of faces'
+                print('float32: %-5s  Faces: %d  Avg: %.1f ms  Std: %.1f ms  Peak numpy memory: %s  Max diff: %s' % (float32, 
+                    bounding_boxes.shape[0], np.mean(t)*1000, np.std(t)*1000, peak_memory, diff))
+
+
+def parse_arguments(argv):
+    parser = argparse.ArgumentParser()
+    parser.add_argument('image', type=str, 
+        help='Image to run the detector on')
+    parser.add_argument('--nrof_runs', type=int,
+        help='Number of times to run the detector', default=20)
+    return parser.parse_args(argv)
+
+
+if __name__ == '__main__':
+    main(parse_arguments(sys.argv[1:]))
@@ -0,0 +1,46 @@
+import align.detect_face
+import argparse
+import sys
+import time
+import numpy as np
+
+def main(args):
+
+    np.random.seed(seed=args.seed)
+    # Clusters of overlapping candidate windows around the faces and scattered false positives
+    nrof_clustered = args.nrof_boxes*3//4
+    centers = np.random.uniform(0, args.image_size, (args.nrof_faces, 2))
+    face_size = np.random.uniform(24, 256, (args.nrof_faces, 1))
+    face_index = np.random.randint(0, args.nrof_faces, nrof_clustered)
+    xy1 = centers[face_index,:] + np.random.normal(0, 1, (nrof_clustered, 2))*face_size[face_index,:]*0.15
+    size = face_size[face_index,:]*np.exp(np.random.normal(0, 0.2, (nrof_clustered, 1)))
+    xy1 = np.vstack([xy1, np.random.uniform(0, args.image_size, (args.nrof_boxes-nrof_clustered, 2))])
+    size = np.vstack([size, np.random.uniform(12, 256, (args.nrof_boxes-nrof_clustered, 1))])
+    boxes = np.hstack([np.fix(xy1), np.fix(xy1+size), np.random.uniform(size=(args.nrof_boxes, 1))])
+
+    for method, threshold in (('Union', 0.5), ('Union', 0.7), ('Min', 0.7)):
+        start_time = time.time()
+        pick = align.detect_face.nms(boxes, threshold, method)
+        nms_time = time.time() - start_time
+        start_time = time.time()
+        fast_pick = align.detect_face.fast_nms(boxes, threshold, method)
+        fast_nms_time = time.time() - start_time
+        print('%-5s %.1f  Boxes: %d  Picked: %d  nms: %.1f ms  fast_nms: %.1f ms  Equal: %s' % (method, threshold,
+            args.nrof_boxes, len(pick), nms_time*1000, fast_nms_time*1000, np.array_equal(pick, fast_pick)))
+
+
+def parse_arguments(argv):
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--nrof_boxes', type=int,
+        help='Number of candidate boxes', default=20000)
+    parser.add_argument('--nrof_faces', type=int,
+        help='Number of faces that the candidates are clustered around', default=50)
+    parser.add_argument('--image_size', type=int,
+        help='Size of the (square) image that the boxes are spread over', default=3840)
+    parser.add_argument('--seed', type=int,
+        help='Random seed', default=666)
+    return parser.parse_args(argv)
+
+
+if __name__ == '__main__':
+    main(parse_arguments(sys.argv[1:]))
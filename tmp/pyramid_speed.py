@@ -0,0 +1,49 @@
+import align.detect_face
+import argparse
+import sys
+import time
+import numpy as np
+from scipy import misc
+
+def main(args):
+
+    img = misc.imread(args.image, mode='RGB')
+    if args.megapixels:
+        s = np.sqrt(args.megapixels*1e6/(img.shape[0]*img.shape[1]))
+        img = align.detect_face.imresample(img, (int(img.shape[0]*s), int(img.shape[1]*s)))
+    h, w = img.shape[0:2]
+    print('Image size: %dx%d' % (w, h))
+
+    start_time = time.time()
+    for _ in range(args.nrof_runs):
+        scales = align.detect_face.scale_pyramid(h, w, args.minsize, args.factor)
+        levels = [align.detect_face.imresample(img, (int(np.ceil(h*scale)), int(np.ceil(w*scale)))) for scale in scales]
+    direct_time = (time.time() - start_time) / args.nrof_runs
+
+    start_time = time.time()
+    for _ in range(args.nrof_runs):
+        pyramid = align.detect_face.ImagePyramid(img, args.minsize, args.factor)
+    incremental_time = (time.time() - start_time) / args.nrof_runs
+
+    diff = [np.mean(np.abs(a.astype(np.float32)-b)) for a, b in zip(levels, pyramid.levels)]
+    print('Levels: %d  Direct: %.1f ms  Incremental: %.1f ms  Speedup: %.1fx  Max mean abs diff: %.2f' % (len(pyramid), 
+        direct_time*1000, incremental_time*1000, direct_time/incremental_time, np.max(diff)))
+
+
+def parse_arguments(argv):
+    parser = argparse.ArgumentParser()
+    parser.add_argument('image', type=str, 
+        help='Image to build the pyramid for')
+    parser.add_argument('--megapixels', type=float,
+        help='Resize the image to this number of megapixels first', default=12.0)
+    parser.add_argument('--minsize', type=int,
+        help='Minimum size of the faces', default=20)
+    parser.add_argument('--factor', type=float,
+        help='Scale factor between the pyramid levels', default=0.709)
+    parser.add_argument('--nrof_runs', type=int,
+        help='Number of times to build the pyramid', default=5)
+    return parser.parse_args(argv)
+
+
+if __name__ == '__main__':
+    main(parse_arguments(sys.argv[1:]))
@@ -0,0 +1,54 @@
+import facenet
+import argparse
+import sys
+import time
+import numpy as np
+import tensorflow as tf
+
+def py_func_rotate(image):
+    rotated = tf.py_func(facenet.random_rotate_image, [image], tf.uint8)
+    rotated.set_shape(image.get_shape())
+    return rotated
+
+def measure(rotate_fun, image, args):
+    with tf.Graph().as_default():
+        dataset = tf.data.Dataset.from_tensors(image).repeat(args.nrof_images)
+        dataset = dataset.map(rotate_fun, num_parallel_calls=args.nrof_threads)
+        dataset = dataset.batch(args.batch_size).prefetch(2)
+        image_batch = dataset.make_one_shot_iterator().get_next()
+        with tf.Session() as sess:
+            sess.run(image_batch)  # Warm up
+            nrof_images = args.batch_size
+            start_time = time.time()
+            try:
+                while True:
+                    nrof_images += sess.run(image_batch).shape[0]
+            except tf.errors.OutOfRangeError:
+                pass
+            duration = time.time() - start_time
+    return (nrof_images - args.batch_size) / duration
+
+def main(args):
+    np.random.seed(args.seed)
+    image = np.random.randint(0, 256, (args.image_size, args.image_size, 3)).astype(np.uint8)
+    for name, rotate_fun in (('py_func (scipy imrotate)', py_func_rotate), ('tf.contrib.image.rotate', facenet.random_rotate_image_op)):
+        print('%s: %.1f images/s with %d threads' % (name, measure(rotate_fun, image, args), args.nrof_threads))
+
+
+def parse_arguments(argv):
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--image_size', type=int,
+        help='Size of the rotated images', default=182)
+    parser.add_argument('--nrof_images', type=int,
+        help='Number of images to rotate per run', default=10000)
+    parser.add_argument('--nrof_threads', type=int,
+        help='Number of parallel map calls', default=32)
+    parser.add_argument('--batch_size', type=int,
+        help='Number of images per batch', default=90)
+    parser.add_argument('--seed', type=int,
+        help='Random seed', default=666)
+    return parser.parse_args(argv)
+
+
+if __name__ == '__main__':
+    main(parse_arguments(sys.argv[1:]))